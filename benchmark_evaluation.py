@@ -0,0 +1,210 @@
+"""
+Parity checks and timings for the R-peak evaluation code.
+
+The parity checks compare the fast implementations against the original
+loop versions on the peaks saved by `rr_peak_detection.py` in the peak
+store in `results/rr_detection`.
+"""
+import os
+import tempfile
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+from tqdm import tqdm
+from jf import jf_analysis
+from jf.jf_analysis import nearest_diff, nearest_diff_loop
+from jf.sensitivity_analysis import evaluate as sens
+from jf.evaluation import evaluate, evaluate_batch
+from jf.util import flatten
+from utils import subjects, experiments, methods_names
+from peak_store import PeakStore
+import rr_peak_detection
+
+read_path = Path(__file__).resolve().parent / 'results/rr_detection'
+
+
+def load_pairs(setup):
+    """Yield (subject, experiment, method, detected, annotated) saved peaks."""
+    store = PeakStore(setup, read_path)
+    for s in subjects:
+        for experiment in experiments:
+            try:
+                annotated_peaks = store.read(s, experiment, 'annotated')
+            except KeyError:
+                continue
+            for method in methods_names:
+                try:
+                    detected_peaks = store.read(s, experiment, method)
+                except KeyError:
+                    continue
+                if len(detected_peaks) == 0:
+                    continue
+                yield s, experiment, method, detected_peaks, annotated_peaks
+
+
+def check_nearest_diff_parity(setup):
+    """Compare nearest_diff against nearest_diff_loop on the GUDb results."""
+    n_checked, n_failed = 0, 0
+    for s, experiment, method, detected, annotated in tqdm(
+            list(load_pairs(setup)), desc=f'Parity {setup}'):
+        fast = np.asarray(nearest_diff(annotated, detected))
+        slow = np.asarray(nearest_diff_loop(annotated, detected))
+        n_checked += 1
+        if not np.array_equal(fast, slow):
+            n_failed += 1
+            tqdm.write(f'Mismatch for subject {s}, condition {experiment}, '
+                       f'method {method}')
+    print(f'{setup}: {n_checked} recordings checked, {n_failed} mismatches')
+    return n_failed
+
+
+def synthetic_peaks(n_beats, fs=250, seed=0):
+    """Annotated and jittered detected peaks for a recording of n_beats."""
+    rng = np.random.default_rng(seed)
+    rr = rng.normal(0.8 * fs, 0.05 * fs, n_beats).astype(int)
+    annotated = np.cumsum(rr)
+    detected = annotated + rng.integers(-3, 4, n_beats)
+    keep = rng.random(n_beats) > 0.01  # missed beats
+    extra = rng.integers(0, annotated[-1], n_beats // 100)  # spurious beats
+    detected = np.sort(np.concatenate([detected[keep], extra]))
+    return detected, annotated
+
+
+def time_nearest_diff(beats=(1000, 5000, 20000, 100000)):
+    """Time nearest_diff against the loop version on synthetic recordings."""
+    for n_beats in beats:
+        detected, annotated = synthetic_peaks(n_beats)
+        t0 = perf_counter()
+        nearest_diff(annotated, detected)
+        t_fast = perf_counter() - t0
+        if n_beats <= 5000:
+            t0 = perf_counter()
+            nearest_diff_loop(annotated, detected)
+            t_loop = f'{perf_counter() - t0:9.3f} s'
+        else:
+            t_loop = '  skipped'
+        print(f'{n_beats:7d} beats: sorted {t_fast:9.4f} s, loop {t_loop}')
+
+
+def check_sensitivity_parity(setup, tol=25):
+    """Compare both modes of the sensitivity evaluation on the GUDb results."""
+    n_checked, n_failed = 0, 0
+    for s, experiment, method, detected, annotated in tqdm(
+            list(load_pairs(setup)), desc=f'Sensitivity {setup}'):
+        n_checked += 1
+        if sens(detected, annotated, tol) != sens(detected, annotated, tol,
+                                                  vectorized=False):
+            n_failed += 1
+            tqdm.write(f'Mismatch for subject {s}, condition {experiment}, '
+                       f'method {method}')
+    print(f'{setup}: {n_checked} recordings checked, {n_failed} mismatches')
+    return n_failed
+
+
+def time_sensitivity(beats=(1000, 5000, 20000), tol=25):
+    """Time the vectorized sensitivity evaluation against the loop version."""
+    for n_beats in beats:
+        detected, annotated = synthetic_peaks(n_beats)
+        t0 = perf_counter()
+        sens(detected, annotated, tol)
+        t_fast = perf_counter() - t0
+        t0 = perf_counter()
+        sens(detected, annotated, tol, vectorized=False)
+        t_loop = perf_counter() - t0
+        print(f'{n_beats:7d} beats: vectorized {t_fast:9.4f} s, '
+              f'loop {t_loop:9.3f} s ({t_loop / t_fast:6.1f}x)')
+
+
+def check_batch_without_annotations(fs=250, tol=25):
+    """
+    evaluate_batch on records without annotations: alone they give NaN
+    rows, next to a record with annotations that one matches evaluate.
+    """
+    detected, annotated = synthetic_peaks(300, fs)
+    empty = np.array([], dtype=annotated.dtype)
+    n_failed = 0
+    result = evaluate_batch(*flatten([detected, detected]),
+                            *flatten([empty, empty]), fs, tol)
+    n_failed += not result.isna().all(axis=None)
+    result = evaluate_batch(*flatten([detected, detected]),
+                            *flatten([empty, annotated]), fs, tol)
+    single = evaluate(detected, annotated, fs, tol)
+    n_failed += not result.iloc[0].isna().all()
+    n_failed += not all(np.isclose(result.iloc[1][k], getattr(single, k))
+                        for k in result.columns)
+    print(f'Batches without annotations: {n_failed} failures')
+    return n_failed
+
+
+def check_jf_without_detections(fs=250, tol=25):
+    """
+    evaluate when no detection is left after the JF trimming: no pairs,
+    jf_tp = jf_fp = 0, jf_fn the trimmed annotations, f1 = 0 and nan
+    jitter and jf, the same as evaluate_batch, instead of an error.
+    """
+    _, annotated = synthetic_peaks(300, fs)
+    detected = annotated[:3]  # all before the first JF annotation
+    result = evaluate(detected, annotated, fs, tol)
+    n_trimmed = len(annotated[jf_analysis.a:jf_analysis.b + 1])
+    n_failed = int(not (result.jf_tp == 0 and result.jf_fp == 0 and
+                        result.jf_fn == n_trimmed and result.f1 == 0 and
+                        np.isnan(result.jitter) and np.isnan(result.jf)))
+    batch = evaluate_batch(*flatten([detected]), *flatten([annotated]), fs,
+                           tol).iloc[0]
+    n_failed += not all(np.isclose(batch[k], getattr(result, k),
+                                   equal_nan=True) for k in batch.index)
+    print(f'JF without detections after trimming: {n_failed} failures')
+    return n_failed
+
+
+def time_batch(records=(10, 100, 1000), n_beats=300, fs=250, tol=25):
+    """Time evaluate_batch against one evaluate call per recording."""
+    for n_records in records:
+        pairs = [synthetic_peaks(n_beats, fs, seed) for seed in range(n_records)]
+        detected, annotated = zip(*pairs)
+        t0 = perf_counter()
+        for det, anno in pairs:
+            evaluate(det, anno, fs, tol)
+        t_loop = perf_counter() - t0
+        t0 = perf_counter()
+        evaluate_batch(*flatten(detected), *flatten(annotated), fs, tol)
+        t_batch = perf_counter() - t0
+        print(f'{n_records:5d} recordings: batch {t_batch:8.4f} s, '
+              f'per recording {t_loop:8.4f} s')
+
+
+def time_detection_scaling(setup='einthoven', jobs=(1, 2, 4, 8, 16, 32)):
+    """
+    Times rr_peak_detection.run_detection with an increasing number of
+    processes. Needs the GUDb cache (gudb_cache.py). The peaks and tables
+    are written to a temporary directory, so the results in
+    results/rr_detection are left as they are.
+    """
+    jobs = [j for j in jobs if j <= os.cpu_count()]
+    times = {}
+    save_path = rr_peak_detection.save_path
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            rr_peak_detection.save_path = Path(tmp)
+            for n_jobs in jobs:
+                t0 = perf_counter()
+                rr_peak_detection.run_detection(setup, n_jobs)
+                times[n_jobs] = perf_counter() - t0
+    finally:
+        rr_peak_detection.save_path = save_path
+    for n_jobs, t in times.items():
+        print(f'{n_jobs:3d} processes: {t:8.1f} s, '
+              f'speed-up {times[jobs[0]] / t:5.1f}x')
+
+
+if __name__ == '__main__':
+    check_nearest_diff_parity('einthoven')
+    check_nearest_diff_parity('chest_strap')
+    time_nearest_diff()
+    check_sensitivity_parity('einthoven')
+    check_sensitivity_parity('chest_strap')
+    time_sensitivity()
+    check_batch_without_annotations()
+    check_jf_without_detections()
+    time_batch()
+    time_detection_scaling()
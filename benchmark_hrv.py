@@ -0,0 +1,155 @@
+"""
+Parity checks and timings of the HRV code against neurokit2.
+
+The parity checks compare the in-project HRV functions against neurokit2 on
+the peaks saved by `rr_peak_detection.py` in the peak store in
+`results/rr_detection`.
+"""
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas as pd
+import neurokit2 as nk
+from tqdm import tqdm
+from sampen import sample_entropy
+from hrv_time import hrv_time
+from hrv_frequency import hrv_frequency
+from peak_store import PeakStore
+
+read_path = Path(__file__).resolve().parent / 'results/rr_detection'
+FS = 250
+
+
+def load_peaks(setup):
+    """Yield (subject, experiment, method, peaks) of all stored peaks."""
+    store = PeakStore(setup, read_path)
+    for s, experiment, method in store.keys():
+        peaks = store.read(s, experiment, method)
+        if len(peaks) < 10:
+            continue
+        yield s, experiment, method, peaks
+
+
+def load_rri(setup):
+    """Yield (subject, experiment, method, rri) of all stored peaks."""
+    for s, experiment, method, peaks in load_peaks(setup):
+        yield s, experiment, method, np.diff(peaks) / FS * 1000
+
+
+def synthetic_rri(n_beats, fs=FS, seed=0, sd=0.05):
+    """
+    RR intervals in ms of n_beats from peaks sampled at fs. A slow drift of
+    the heart rate, respiratory sinus arrhythmia and beat-to-beat noise of
+    `sd` seconds give 50-200 distinct values, as the GUDb recordings.
+    """
+    rng = np.random.default_rng(seed)
+    t = np.arange(n_beats)
+    rr = (0.8 * fs + 0.06 * fs * np.sin(2 * np.pi * 3 * t / n_beats) +
+          0.02 * fs * np.sin(2 * np.pi * 0.25 * t))
+    rr = np.round(rr + rng.normal(0, sd * fs, n_beats))
+    return rr / fs * 1000
+
+
+def check_sampen_parity(setup):
+    """Compare sample_entropy against nk.entropy_sample on the GUDb results."""
+    n_checked, n_failed = 0, 0
+    for s, experiment, method, rri in tqdm(list(load_rri(setup)),
+                                           desc=f'SampEn {setup}'):
+        tolerance = 0.2 * np.std(rri, ddof=1)
+        reference, _ = nk.entropy_sample(rri, delay=1, dimension=2,
+                                         tolerance=tolerance)
+        n_checked += 1
+        if not np.isclose(sample_entropy(rri), reference, equal_nan=True):
+            n_failed += 1
+            tqdm.write(f'Mismatch for subject {s}, condition {experiment}, '
+                       f'method {method}')
+    print(f'{setup}: {n_checked} recordings checked, {n_failed} mismatches')
+    return n_failed
+
+
+def check_parity(setup, batch, reference, rtol, atol=1e-12):
+    """
+    Compare a batched HRV function against neurokit2 on the GUDb results.
+
+    batch: function of a list of peak arrays and fs, e.g. hrv_time
+    reference: neurokit2 function of the peaks of one recording and fs,
+    returning a one-row DataFrame with (at least) the columns of `batch`;
+    its ValueErrors are expected to give rows of nan in `batch`
+    rtol, atol: tolerances of np.isclose
+
+    returns the number of recordings with a mismatch.
+    """
+    records = list(load_peaks(setup))
+    fast = batch([peaks for *_, peaks in records], fs=FS)
+    mismatches = pd.Series(0, index=fast.columns)
+    n_failed = 0
+    for row, (s, experiment, method, peaks) in zip(
+            tqdm(fast.to_numpy(dtype=float), desc=f'{batch.__name__} {setup}'),
+            records):
+        try:
+            expected = reference(peaks, FS)[fast.columns].to_numpy(
+                dtype=float)[0]
+        except ValueError:
+            expected = np.full(len(row), np.nan)
+        bad = ~np.isclose(row, expected, rtol=rtol, atol=atol, equal_nan=True)
+        if bad.any():
+            n_failed += 1
+            mismatches += bad
+            tqdm.write(f'Mismatch for subject {s}, condition {experiment}, '
+                       f'method {method}: {list(fast.columns[bad])}')
+    print(f'{setup}: {len(records)} recordings checked, {n_failed} '
+          f'mismatches')
+    if n_failed:
+        print(mismatches[mismatches > 0].to_string())
+    return n_failed
+
+
+def neurokit_time(peaks, fs):
+    """nk.hrv_time and the Poincaré columns of nk.hrv_nonlinear."""
+    return pd.concat([nk.hrv_time(peaks, fs), nk.hrv_nonlinear(peaks, fs)],
+                     axis=1)
+
+
+def check_time_parity(setup, rtol=1e-9):
+    """Compare hrv_time against nk.hrv_time and nk.hrv_nonlinear."""
+    return check_parity(setup, hrv_time, neurokit_time, rtol)
+
+
+def check_frequency_parity(setup, rtol=1e-8):
+    """Compare hrv_frequency against nk.hrv_frequency."""
+    return check_parity(setup, hrv_frequency, nk.hrv_frequency, rtol)
+
+
+def time_sampen(beats=(150, 300, 1000, 3000, 10000, 30000, 100000),
+                max_reference=30000, sd=0.05):
+    """
+    Time sample_entropy against nk.entropy_sample on synthetic RR series.
+    neurokit2 is only timed up to max_reference beats.
+    """
+    for n_beats in beats:
+        rri = synthetic_rri(n_beats, sd=sd)
+        tolerance = 0.2 * np.std(rri, ddof=1)
+        t0 = perf_counter()
+        fast = sample_entropy(rri)
+        t_fast = perf_counter() - t0
+        if n_beats <= max_reference:
+            t0 = perf_counter()
+            reference, _ = nk.entropy_sample(rri, delay=1, dimension=2,
+                                             tolerance=tolerance)
+            t_nk = perf_counter() - t0
+            check = 'ok' if np.isclose(fast, reference) else 'MISMATCH'
+            t_nk = f'{t_nk:9.3f} s ({t_nk / t_fast:6.1f}x) {check}'
+        else:
+            t_nk = '  skipped'
+        print(f'{n_beats:7d} beats ({len(np.unique(rri)):4d} values): '
+              f'sampen {t_fast:9.4f} s, neurokit2 {t_nk}')
+
+
+if __name__ == '__main__':
+    check_time_parity('einthoven')
+    check_time_parity('chest_strap')
+    check_frequency_parity('einthoven')
+    check_frequency_parity('chest_strap')
+    check_sampen_parity('einthoven')
+    check_sampen_parity('chest_strap')
+    time_sampen()
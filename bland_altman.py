@@ -0,0 +1,172 @@
+"""
+Bland-Altman agreement of the detected HRV with the annotated HRV, for every
+(method, experiment, metric) at once.
+
+This replaces make_ba_plots of R/ccc.R, which filters the table and calls
+SimplyAgree once per cell. The differences are annotated - detected, as
+SimplyAgree::agreement_limit(x='annotated', y='estimated'). The limits of
+agreement are the classic ones of Bland and Altman (1999):
+
+- bias = mean of the differences, sd = their standard deviation (n - 1)
+- lower and upper LoA = bias -/+ z sd, z the normal quantile of agree_level
+- the CI of the bias is bias +/- t sd / sqrt(n), and the CI of each LoA is
+  LoA +/- t sd sqrt(1/n + z^2 / (2 (n - 1))), t the quantile of the t
+  distribution with n - 1 degrees of freedom
+
+Pairs are formed as in ccc.py, and all groups are reduced in one pass over
+the pairs sorted by group.
+
+Running this script writes datahrv/bland_altman_{setup}_df.csv; with
+--figures it also saves the Bland-Altman plots of every experiment and
+metric in figures/bland_altman, one panel per method, as the R script.
+"""
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import norm, t as student
+from ccc import data_path, grouped_pairs, group_sums, group_table
+from utils import export_metrics
+
+figures_path = Path(__file__).resolve().parent / 'figures/bland_altman'
+ba_columns = ['method', 'experiment', 'metric', 'n', 'bias', 'sd',
+              'lower_loa', 'upper_loa', 'bias_lower_ci', 'bias_upper_ci',
+              'lower_loa_lower_ci', 'lower_loa_upper_ci',
+              'upper_loa_lower_ci', 'upper_loa_upper_ci']
+# Setup names in the titles of the figures, as the R script
+setup_labels = {'chest_strap': 'chest strap', 'einthoven': 'loose cables'}
+
+
+def limits_of_agreement(x, y, group, n_groups, conf_level=0.95,
+                        agree_level=0.95):
+    """
+    Bland-Altman statistics of the differences x - y of every group and
+    column.
+
+    x, y: paired values, one row per pair and one column per metric. NaN
+    values leave their pair out of that column.
+    group: group index of every pair, from 0 to n_groups - 1
+
+    returns a dict of the names of ba_columns from 'n' on to arrays of shape
+    (n_groups, n_columns).
+    """
+    order = np.argsort(group, kind='stable')
+    group = group[order]
+    d = x[order] - y[order]
+    ok = ~np.isnan(d)
+    # A shift of the differences by their overall mean keeps the sum of
+    # squares small
+    shift = np.nan_to_num(np.nanmean(d, axis=0)) if ok.any() else 0
+    d = np.where(ok, d - shift, 0)
+
+    present = np.flatnonzero(np.bincount(group, minlength=n_groups))
+    starts = np.searchsorted(group, present)
+    shape = (n_groups, d.shape[1])
+    n, s1, s2 = (np.zeros(shape) for _ in range(3))
+    for total, values in ((n, ok.astype(float)), (s1, d), (s2, d * d)):
+        total[present] = group_sums(values, starts)
+
+    z = norm.ppf(1 - (1 - agree_level) / 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = s1 / n
+        sd = np.sqrt(np.maximum(s2 - s1 * mean, 0) / (n - 1))
+        bias = mean + shift
+        tq = student.ppf(1 - (1 - conf_level) / 2, n - 1)
+        se_bias = sd / np.sqrt(n)
+        se_loa = sd * np.sqrt(1 / n + z**2 / (2 * (n - 1)))
+    out = {'n': n.astype(int), 'bias': bias, 'sd': sd,
+           'lower_loa': bias - z * sd, 'upper_loa': bias + z * sd,
+           'bias_lower_ci': bias - tq * se_bias,
+           'bias_upper_ci': bias + tq * se_bias}
+    for loa in ('lower_loa', 'upper_loa'):
+        out[f'{loa}_lower_ci'] = out[loa] - tq * se_loa
+        out[f'{loa}_upper_ci'] = out[loa] + tq * se_loa
+    return out
+
+
+def compute_bland_altman(df, metrics=export_metrics, skip_methods=(),
+                         skip_experiments=(), conf_level=0.95,
+                         agree_level=0.95):
+    """
+    Bland-Altman statistics of every method, experiment and metric of a
+    table of HRV results, as ccc.compute_ccc.
+
+    returns a DataFrame with the columns of ba_columns, one row per
+    (method, experiment, metric).
+    """
+    metrics = list(metrics)
+    methods, experiments, group, _, x, y = grouped_pairs(df, metrics,
+                                                         skip_methods,
+                                                         skip_experiments)
+    stats = limits_of_agreement(x, y, group, len(methods) * len(experiments),
+                                conf_level, agree_level)
+    return group_table(methods, experiments, group, metrics, stats)
+
+
+def plot_bland_altman(df, ba, setup, experiment, metric, ncols=4):
+    """
+    Bland-Altman plots of one experiment and metric, one panel per method.
+    df: table of HRV results, ba: its compute_bland_altman table
+    """
+    import matplotlib.pyplot as plt
+    rows = ba[(ba['experiment'] == experiment) & (ba['metric'] == metric)]
+    name = metric.split('_')[1]
+    nrows = -(-len(rows) // ncols)
+    fig, axs = plt.subplots(nrows, ncols, figsize=(24, 10), squeeze=False)
+    ref = df[(df['method'] == 'Annotated') & (df['experiment'] == experiment)]
+    for ax, row in zip(axs.ravel(), rows.itertuples()):
+        det = df[(df['method'] == row.method) & (df['experiment'] == experiment)]
+        pairs = ref.merge(det, on='subject_idx', suffixes=('_x', '_y'))
+        x, y = pairs[f'{metric}_x'], pairs[f'{metric}_y']
+        ax.scatter((x + y) / 2, x - y, s=30, alpha=0.6, color='k')
+        ax.axhline(row.bias, color='k')
+        ax.axhline(row.lower_loa, color='k', linestyle='--')
+        ax.axhline(row.upper_loa, color='k', linestyle='--')
+        ax.set_xlabel(f'Average of {name}')
+        ax.set_ylabel(f'{name} Difference')
+        ax.set_title(f'Agreement using {row.method}')
+        ax.grid(alpha=0.3)
+    for ax in axs.ravel()[len(rows):]:
+        ax.set_visible(False)
+    fig.suptitle(f'Bland–Altman plots for setup {setup_labels.get(setup, setup)}, '
+                 f'condition {experiment} and metric {name}')
+    fig.tight_layout()
+    return fig
+
+
+def save_bland_altman(setup, fn_data, skip_methods=(), skip_experiments=(),
+                      figures=False):
+    """
+    Writes the Bland-Altman table of a setup, and with `figures` the plots
+    of every experiment and metric.
+    """
+    df = pd.read_csv(fn_data)
+    ba = compute_bland_altman(df, skip_methods=skip_methods,
+                              skip_experiments=skip_experiments)
+    fn = data_path / f'bland_altman_{setup}_df.csv'
+    ba.to_csv(fn, index=False)
+    print('Bland-Altman data saved in', fn)
+    if figures:
+        import matplotlib.pyplot as plt
+        figures_path.mkdir(parents=True, exist_ok=True)
+        for metric in pd.unique(ba['metric']):
+            for experiment in pd.unique(ba['experiment']):
+                fig = plot_bland_altman(df, ba, setup, experiment, metric)
+                fig.savefig(figures_path / f'bland_altman_{setup}_{experiment}_'
+                                           f'{metric.split("_")[1]}.pdf')
+                plt.close(fig)
+        print('Bland-Altman plots saved in', figures_path)
+    return ba
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--figures', action='store_true',
+                        help='also save the Bland-Altman plots')
+    args = parser.parse_args()
+    save_bland_altman('chest_strap',
+                      data_path / 'chest_strap_setup_subset_HRV_notEngzee.csv',
+                      skip_methods=['Engzee'], figures=args.figures)
+    save_bland_altman('einthoven',
+                      data_path / 'einthoven_subset_HRV_not_jogging_with_Engzee.csv',
+                      skip_experiments=['jogging'], figures=args.figures)
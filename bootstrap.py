@@ -0,0 +1,212 @@
+"""
+Bootstrap confidence intervals of the CCC and of the mean JF of every
+(method, experiment).
+
+Resampling is clustered by subject: a resample draws subjects with
+replacement and takes all rows of every drawn subject, so the rows of a
+subject (its pairs in every method) stay together. All statistics used here
+are functions of sums over the rows of a group, so the rows are first
+reduced to a table of per-subject sums of every group, and a whole chunk of
+resamples is one matrix product: the resample indices are drawn as one
+integer matrix (resamples x subjects), turned into counts of every subject,
+and counts @ table gives the sums of every resample, group and metric at
+once. The statistic is then evaluated with broadcasting over all of them.
+
+Chunks of resamples have their own seeds, spawned from one seed, so the
+results do not depend on the number of processes. The intervals are
+percentile intervals.
+
+Running this script writes datahrv/ccc_bootstrap_{setup}_df.csv, with the
+columns of ccc.py, and datahrv/jf_bootstrap_{setup}_df.csv.
+"""
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+import pandas as pd
+from ccc import (concordance, data_path, group_sums, group_table,
+                 grouped_pairs)
+from utils import export_metrics
+
+jf_path = Path(__file__).resolve().parent / 'results/rr_detection'
+
+
+def resample_counts(rng, n_resamples, n_clusters):
+    """
+    Number of times every cluster is drawn in every resample, an array of
+    shape (n_resamples, n_clusters).
+    """
+    idx = rng.integers(0, n_clusters, size=(n_resamples, n_clusters))
+    idx += np.arange(n_resamples)[:, None] * n_clusters
+    counts = np.bincount(idx.ravel(), minlength=n_resamples * n_clusters)
+    return counts.reshape(n_resamples, n_clusters).astype(float)
+
+
+def cluster_table(values, group, cluster, n_groups, n_clusters):
+    """
+    Sums of the rows of `values` of every cluster and group, an array of
+    shape (n_clusters, n_groups) + values.shape[1:].
+    """
+    key = cluster * n_groups + group
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    present = np.flatnonzero(np.bincount(key, minlength=n_clusters * n_groups))
+    table = np.zeros((n_clusters * n_groups,) + values.shape[1:])
+    table[present] = group_sums(values[order], np.searchsorted(key, present))
+    return table.reshape((n_clusters, n_groups) + values.shape[1:])
+
+
+def bootstrap_chunk(task):
+    """Statistic of n_resamples resamples of a cluster table."""
+    table, statistic, n_resamples, seed = task
+    rng = np.random.default_rng(seed)
+    counts = resample_counts(rng, n_resamples, len(table))
+    sums = counts @ table.reshape(len(table), -1)
+    return statistic(sums.reshape((n_resamples,) + table.shape[1:]))
+
+
+def bootstrap(table, statistic, n_resamples=10000, seed=0, jobs=1, chunk=1000):
+    """
+    Bootstrap replicates of a statistic of grouped sums.
+
+    table: per-cluster sums, see cluster_table
+    statistic: function of the sums of a resample, an array of shape
+    (n_resamples,) + table.shape[1:], with one value per resample; it must
+    be a module-level function when jobs > 1
+    jobs: processes of the pool; None, 0 or 1 runs in this process
+    chunk: resamples drawn at once, which bounds the memory
+
+    returns the replicates, one row per resample.
+    """
+    sizes = [min(chunk, n_resamples - start)
+             for start in range(0, n_resamples, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(table, statistic, size, s) for size, s in zip(sizes, seeds)]
+    if jobs is None or jobs <= 1:
+        replicates = list(map(bootstrap_chunk, tasks))
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            replicates = list(executor.map(bootstrap_chunk, tasks))
+    return np.concatenate(replicates)
+
+
+def percentile_ci(replicates, conf_level=0.95):
+    """Lower and upper percentile intervals of bootstrap replicates."""
+    alpha = 1 - conf_level
+    with np.errstate(invalid='ignore'):
+        lower, upper = np.nanquantile(replicates, [alpha / 2, 1 - alpha / 2],
+                                      axis=0)
+    return lower, upper
+
+
+def ccc_statistic(sums):
+    """CCC of the sums of k, x, y, x², y² and xy along the second last axis."""
+    return concordance(*np.moveaxis(sums, -2, 0))
+
+
+def mean_statistic(sums):
+    """Mean from the sums of k and x along the second last axis."""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return sums[..., 1, :] / sums[..., 0, :]
+
+
+def bootstrap_ccc(df, metrics=export_metrics, skip_methods=(),
+                  skip_experiments=(), n_resamples=10000, conf_level=0.95,
+                  seed=0, jobs=1):
+    """
+    CCC and its bootstrap confidence interval of every method, experiment
+    and metric of a table of HRV results, as ccc.compute_ccc. Subjects are
+    drawn with all their pairs.
+
+    returns a DataFrame with the columns of ccc.ccc_columns.
+    """
+    metrics = list(metrics)
+    methods, experiments, group, subjects, x, y = grouped_pairs(
+        df, metrics, skip_methods, skip_experiments)
+    n_groups = len(methods) * len(experiments)
+    ok = ~(np.isnan(x) | np.isnan(y))
+    # The CCC does not change with a common shift of x and y
+    shift = np.nan_to_num(np.nanmean(np.where(ok, x, np.nan), axis=0))
+    x = np.where(ok, x - shift, 0)
+    y = np.where(ok, y - shift, 0)
+    values = np.stack([ok.astype(float), x, y, x * x, y * y, x * y], axis=1)
+    cluster, clusters = pd.factorize(subjects)
+    table = cluster_table(values, group, cluster, n_groups, len(clusters))
+
+    replicates = bootstrap(table, ccc_statistic, n_resamples, seed, jobs)
+    lower, upper = percentile_ci(replicates, conf_level)
+    ccc = ccc_statistic(table.sum(axis=0))
+    return group_table(methods, experiments, group, metrics,
+                       {'ccc': ccc, 'ccc_lower_ci': lower,
+                        'ccc_upper_ci': upper})
+
+
+def bootstrap_jf(jf_df, skip_methods=(), skip_experiments=(),
+                 n_resamples=10000, conf_level=0.95, seed=0, jobs=1):
+    """
+    Mean JF and its bootstrap confidence interval of every method and
+    experiment of a sensitivity_jf table (columns method, experiment,
+    subject_idx and JF). Subjects are drawn with all their rows.
+
+    returns a DataFrame with the columns method, experiment, JF,
+    JF_lower_ci and JF_upper_ci.
+    """
+    jf_df = jf_df[~jf_df['method'].isin(skip_methods) &
+                  ~jf_df['experiment'].isin(skip_experiments)]
+    methods = pd.unique(jf_df['method'])
+    experiments = pd.unique(jf_df['experiment'])
+    group = (pd.Categorical(jf_df['method'], categories=methods).codes *
+             len(experiments) +
+             pd.Categorical(jf_df['experiment'], categories=experiments).codes)
+    jf = jf_df[['JF']].to_numpy(dtype=float)
+    ok = ~np.isnan(jf)
+    values = np.stack([ok.astype(float), np.where(ok, jf, 0)], axis=1)
+    cluster, clusters = pd.factorize(jf_df['subject_idx'])
+    table = cluster_table(values, group, cluster,
+                          len(methods) * len(experiments), len(clusters))
+
+    replicates = bootstrap(table, mean_statistic, n_resamples, seed, jobs)
+    lower, upper = percentile_ci(replicates, conf_level)
+    out = group_table(methods, experiments, group, ['JF'],
+                      {'JF': mean_statistic(table.sum(axis=0)),
+                       'JF_lower_ci': lower, 'JF_upper_ci': upper})
+    return out.drop(columns='metric')
+
+
+def save_bootstrap(setup, fn_data, skip_methods=(), skip_experiments=(),
+                   n_resamples=10000, seed=0, jobs=1):
+    """Writes the bootstrap CIs of the CCC and of the mean JF of a setup."""
+    t0 = perf_counter()
+    ccc = bootstrap_ccc(pd.read_csv(fn_data), skip_methods=skip_methods,
+                        skip_experiments=skip_experiments,
+                        n_resamples=n_resamples, seed=seed, jobs=jobs)
+    fn = data_path / f'ccc_bootstrap_{setup}_df.csv'
+    ccc.to_csv(fn, index=False)
+    print('CCC bootstrap saved in', fn)
+
+    jf_df = pd.read_csv(jf_path / f'sensitivity_jf_{setup}.csv')
+    jf = bootstrap_jf(jf_df, skip_methods, skip_experiments, n_resamples,
+                      seed=seed, jobs=jobs)
+    fn = data_path / f'jf_bootstrap_{setup}_df.csv'
+    jf.to_csv(fn, index=False)
+    print('JF bootstrap saved in', fn)
+    print(f'{n_resamples} resamples of setup {setup} in '
+          f'{perf_counter() - t0:.1f} s')
+    return ccc, jf
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--resamples', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--jobs', type=int, default=1)
+    args = parser.parse_args()
+    save_bootstrap('chest_strap',
+                   data_path / 'chest_strap_setup_subset_HRV_notEngzee.csv',
+                   skip_methods=['Engzee'], n_resamples=args.resamples,
+                   seed=args.seed, jobs=args.jobs)
+    save_bootstrap('einthoven',
+                   data_path / 'einthoven_subset_HRV_not_jogging_with_Engzee.csv',
+                   skip_experiments=['jogging'], n_resamples=args.resamples,
+                   seed=args.seed, jobs=args.jobs)
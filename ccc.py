@@ -0,0 +1,180 @@
+"""
+Lin's concordance correlation coefficient (CCC) of the detected HRV against
+the annotated HRV, for every (method, experiment, metric) at once.
+
+This replaces the loop of R/ccc.R, which calls SimplyAgree::jmvagree once
+per cell. The estimate and its confidence interval are the ones of
+jmvagree (Lin 1989, 2000): population moments, the asymptotic standard error
+of Lin and the interval computed on the Fisher z (atanh) scale. Every
+detected row is paired with the annotated row of the same subject and
+experiment (see paired_hrv.py), and pairs where either value is missing are
+left out, per metric. All groups are reduced together with np.add.reduceat
+over the pairs sorted by group.
+
+Running this script writes datahrv/ccc_{setup}_df.csv, with the columns
+method, experiment, metric, ccc, ccc_lower_ci and ccc_upper_ci of the R
+script.
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+from paired_hrv import PairedHRV
+from utils import export_metrics
+
+data_path = Path(__file__).resolve().parent / 'datahrv'
+ccc_columns = ['method', 'experiment', 'metric', 'ccc', 'ccc_lower_ci',
+               'ccc_upper_ci']
+
+
+def group_sums(values, starts):
+    """Sums of the rows of `values` in every group, rows sorted by group."""
+    if len(values) == 0:
+        return np.zeros((0,) + values.shape[1:])
+    return np.add.reduceat(values, starts, axis=0)
+
+
+def lin_ccc(x, y, group, n_groups, conf_level=0.95):
+    """
+    CCC and its confidence interval of every group and column.
+
+    x, y: paired values, one row per pair and one column per metric. NaN
+    values leave their pair out of that column.
+    group: group index of every pair, from 0 to n_groups - 1
+
+    returns ccc, lower and upper, arrays of shape (n_groups, n_columns).
+    """
+    order = np.argsort(group, kind='stable')
+    group = group[order]
+    ok = ~(np.isnan(x[order]) | np.isnan(y[order]))
+    # The CCC does not change with a common shift of x and y, which keeps
+    # the sums of squares small
+    shift = np.nanmean(np.where(ok, x[order], np.nan), axis=0)
+    shift = np.nan_to_num(shift)
+    x = np.where(ok, x[order] - shift, 0)
+    y = np.where(ok, y[order] - shift, 0)
+
+    present = np.flatnonzero(np.bincount(group, minlength=n_groups))
+    starts = np.searchsorted(group, present)
+    shape = (n_groups, x.shape[1])
+    k, sx, sy, sxx, syy, sxy = (np.zeros(shape) for _ in range(6))
+    for total, values in ((k, ok.astype(float)), (sx, x), (sy, y),
+                          (sxx, x * x), (syy, y * y), (sxy, x * y)):
+        total[present] = group_sums(values, starts)
+    return ccc_from_sums(k, sx, sy, sxx, syy, sxy, conf_level)
+
+
+def moments(k, sx, sy, sxx, syy, sxy):
+    """
+    Means, variances and covariance from the number of pairs k and the sums
+    of x, y, x², y² and xy, with divisor k as jmvagree.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        xb, yb = sx / k, sy / k
+        return xb, yb, sxx / k - xb**2, syy / k - yb**2, sxy / k - xb * yb
+
+
+def concordance(k, sx, sy, sxx, syy, sxy):
+    """CCC alone from the sums, without its confidence interval."""
+    xb, yb, vx, vy, cov = moments(k, sx, sy, sxx, syy, sxy)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 2 * cov / (vx + vy + (yb - xb)**2)
+
+
+def ccc_from_sums(k, sx, sy, sxx, syy, sxy, conf_level=0.95):
+    """
+    CCC and its confidence interval from the number of pairs k and the sums
+    of x, y, x², y² and xy, arrays of any (common) shape.
+    """
+    xb, yb, vx, vy, cov = moments(k, sx, sy, sxx, syy, sxy)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        r = cov / np.sqrt(vx * vy)
+        p = 2 * cov / (vx + vy + (yb - xb)**2)
+        u = (yb - xb) / (vx * vy)**0.25
+        sep = np.sqrt(((1 - r**2) * p**2 * (1 - p**2) / r**2 +
+                       2 * p**3 * (1 - p) * u**2 / r -
+                       0.5 * p**4 * u**4 / r**2) / (k - 2))
+        z = norm.ppf(1 - (1 - conf_level) / 2)
+        t = np.arctanh(p)
+        se_t = sep / (1 - p**2)
+        lower = np.tanh(t - z * se_t)
+        upper = np.tanh(t + z * se_t)
+    return p, lower, upper
+
+
+def grouped_pairs(data, metrics, skip_methods=(), skip_experiments=()):
+    """
+    Pairs of detected and annotated values with the index of their (method,
+    experiment) group. data: a table of HRV results or its PairedHRV.
+
+    returns methods, experiments, group, subjects, x and y, where pair i
+    belongs to methods[group[i] // len(experiments)] and
+    experiments[group[i] % len(experiments)] and to the subject subjects[i],
+    and x and y are the annotated and detected values, one column per
+    metric. Methods and experiments keep the order in which they first
+    appear in the table.
+    """
+    if not isinstance(data, PairedHRV):
+        data = PairedHRV(data, metrics)
+    group, subjects, x, y = data.select(list(metrics), skip_methods,
+                                        skip_experiments)
+    return data.methods, data.experiments, group, subjects, x, y
+
+
+def group_table(methods, experiments, group, metrics, columns):
+    """
+    Tidy table with one row per (method, experiment, metric) of the groups
+    that have pairs. columns: dict of name to an array of shape
+    (n_groups, n_metrics).
+    """
+    present = np.unique(group)
+    n_metrics = len(metrics)
+    table = {'method': np.repeat(methods[present // len(experiments)],
+                                 n_metrics),
+             'experiment': np.repeat(experiments[present % len(experiments)],
+                                     n_metrics),
+             'metric': np.tile(metrics, len(present))}
+    table.update({name: values[present].ravel()
+                  for name, values in columns.items()})
+    return pd.DataFrame(table)
+
+
+def compute_ccc(df, metrics=export_metrics, skip_methods=(),
+                skip_experiments=(), conf_level=0.95):
+    """
+    CCC of every method, experiment and metric of a table of HRV results
+    with the columns subject_idx, method, experiment and the metrics, as
+    written by export_HRV.py, or of its PairedHRV.
+
+    returns a DataFrame with the columns of ccc_columns, one row per
+    (method, experiment, metric), methods and experiments in the order they
+    first appear in `df`.
+    """
+    metrics = list(metrics)
+    methods, experiments, group, _, x, y = grouped_pairs(df, metrics,
+                                                         skip_methods,
+                                                         skip_experiments)
+    ccc, lower, upper = lin_ccc(x, y, group, len(methods) * len(experiments),
+                                conf_level)
+    return group_table(methods, experiments, group, metrics,
+                       {'ccc': ccc, 'ccc_lower_ci': lower,
+                        'ccc_upper_ci': upper})
+
+
+def save_ccc(setup, fn_data, skip_methods=(), skip_experiments=()):
+    df = pd.read_csv(fn_data)
+    ccc = compute_ccc(df, skip_methods=skip_methods,
+                      skip_experiments=skip_experiments)
+    fn = data_path / f'ccc_{setup}_df.csv'
+    ccc.to_csv(fn, index=False)
+    print('CCC data saved in', fn)
+    return ccc
+
+
+if __name__ == '__main__':
+    save_ccc('chest_strap',
+             data_path / 'chest_strap_setup_subset_HRV_notEngzee.csv',
+             skip_methods=['Engzee'])
+    save_ccc('einthoven',
+             data_path / 'einthoven_subset_HRV_not_jogging_with_Engzee.csv',
+             skip_experiments=['jogging'])
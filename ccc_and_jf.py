@@ -1,41 +1,80 @@
 """
 Shows the relationship between CCC and JF.
 """
+import os
 from pathlib import Path
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
-import statsmodels.api as sm
 
 metrics = ['HRV_MeanNN', 'HRV_SDNN', 'HRV_RMSSD', 'HRV_SDSD', 'HRV_CVSD',
            'HRV_CVNN', 'HRV_TINN', 'HRV_HTI', 'HRV_SDRMSSD', 'HRV_pNN20',
            'HRV_pNN50', 'HRV_IQRNN', 'HRV_LF', 'HRV_HF', 'HRV_LFHF',
            'HRV_LFn', 'HRV_HFn', 'HRV_LnHF', 'HRV_SD1', 'HRV_SD2',
            'HRV_SD1SD2', 'HRV_SampEn', 'HRV_TP']
+loaded = {}  # setup: (modification times of its tables, load_setup table)
+
+
+def load_setup(setup):
+    """
+    CCC of every method, experiment and metric of a setup with the mean JF
+    of the method and experiment in the column 'JF'. The JF and CCC tables
+    are read and merged once; later calls reuse the result until one of the
+    tables is modified.
+    """
+    jf_fn = f'results/rr_detection/sensitivity_jf_{setup}.csv'
+    ccc_fn = f'datahrv/ccc_{setup}_df.csv'
+    mtimes = (os.stat(jf_fn).st_mtime_ns, os.stat(ccc_fn).st_mtime_ns)
+    if setup not in loaded or loaded[setup][0] != mtimes:
+        jf_df = pd.read_csv(jf_fn)
+        ccc_df = pd.read_csv(ccc_fn)
+
+        if setup == 'chest_strap':
+            jf_df = jf_df.query('method != "Engzee"')
+        if setup == 'einthoven':
+            jf_df = jf_df.query('experiment != "jogging"')
+
+        jf_mean = jf_df.groupby(['method','experiment'])['JF'].mean()
+        loaded[setup] = mtimes, ccc_df.merge(jf_mean.reset_index(),
+                                             on=['method', 'experiment'])
+    return loaded[setup][1]
+
 
 def get_data(setup, metric):
-    jf_df = pd.read_csv(f'results/rr_detection/sensitivity_jf_{setup}.csv')
-    ccc_df = pd.read_csv(f'datahrv/ccc_{setup}_df.csv')
+    data = load_setup(setup)
+    return data[data['metric'] == metric].reset_index(drop=True)
 
-    if setup == 'chest_strap':
-        jf_df = jf_df.query('method != "Engzee"')
-    if setup == 'einthoven':
-        jf_df = jf_df.query('experiment != "jogging"')
 
-    jf_mean = jf_df.groupby(['method','experiment'])['JF'].mean()
-    ccc_metric_df = ccc_df.query('metric == @metric')
-    ccc_metric_df = ccc_metric_df.merge(jf_mean.reset_index(),
-                                        on=['method', 'experiment'])
-    return ccc_metric_df
+def split_metrics(data):
+    """Rows of every metric of a load_setup table, as a dict."""
+    return dict(tuple(data.groupby('metric', sort=False)))
 
 
-def compute_rsquared(df):
-    Y = df['ccc']
-    X = df['JF']
-    X = sm.add_constant(X)
-    model = sm.OLS(Y, X)
-    results = model.fit()
-    return results.rsquared
+def regressions(data):
+    """
+    Least-squares line of the CCC on the JF of every metric of a load_setup
+    table, from the sums of each metric, as an OLS fit with a constant.
+
+    returns a DataFrame indexed by metric with the columns slope, intercept
+    and rsquared.
+    """
+    codes, names = pd.factorize(data['metric'])
+    x = data['JF'].to_numpy(dtype=float)
+    y = data['ccc'].to_numpy(dtype=float)
+
+    def sums(values):
+        return np.bincount(codes, weights=values, minlength=len(names))
+
+    n = sums(np.ones_like(x))
+    x_mean, y_mean = sums(x) / n, sums(y) / n
+    dx, dy = x - x_mean[codes], y - y_mean[codes]
+    sxx, syy, sxy = sums(dx * dx), sums(dy * dy), sums(dx * dy)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = sxy / sxx
+        rsquared = sxy**2 / (sxx * syy)
+    return pd.DataFrame({'slope': slope, 'intercept': y_mean - slope * x_mean,
+                         'rsquared': rsquared}, index=names)
 
 
 def plot_regressions(setup):
@@ -47,16 +86,17 @@ def plot_regressions(setup):
     rows, cols = 6, 4
     fig, axs = plt.subplots(rows, cols, layout='constrained',
                             figsize=(8.3, 10.2))
+    if isinstance(setup, str):
+        data = load_setup(setup)
+    else:
+        data = pd.concat([load_setup(setup[0]), load_setup(setup[1])])
+    by_metric = split_metrics(data)
+    rsquared = regressions(data)['rsquared']
     for metric, ax in zip(metrics, axs.flat):
-        if isinstance(setup, str):
-            df = get_data(setup, metric)
-        else:
-            df = pd.concat([get_data(setup[0], metric),
-                            get_data(setup[1], metric)])
+        df = by_metric[metric]
         sns.regplot(data=df, x='JF', y='ccc', ci=None, ax=ax, label=metric,
                     scatter_kws={'s': 10})
-        rsquared = compute_rsquared(df)
-        title = rf'{metric.split("_")[1]} ($R^2$: {rsquared:.2f})'
+        title = rf'{metric.split("_")[1]} ($R^2$: {rsquared[metric]:.2f})'
         ax.set_title(title)
 
 
@@ -85,20 +125,22 @@ def plot_both_regressions():
     rows, cols = 6, 4
     fig, axs = plt.subplots(rows, cols, layout='constrained',
                             figsize=(8.3, 10.2))
+    chest = split_metrics(load_setup('chest_strap'))
+    einthoven = split_metrics(load_setup('einthoven'))
+    rsquared_chest = regressions(load_setup('chest_strap'))['rsquared']
+    rsquared_einthoven = regressions(load_setup('einthoven'))['rsquared']
     for metric, ax in zip(metrics, axs.flat):
-        df = get_data('chest_strap', metric)
+        df = chest[metric]
         sns.regplot(data=df, x='JF', y='ccc', ci=None, ax=ax,
                     scatter_kws={'s': 10}, label='Chest strap',
                     color=sns.color_palette()[0])
-        rsquared_chest = compute_rsquared(df)
-        df = get_data('einthoven', metric)
+        df = einthoven[metric]
         sns.regplot(data=df, x='JF', y='ccc', ci=None, ax=ax,
                     scatter_kws={'s': 10}, label='Loose cables',
                     color=sns.color_palette()[1])
-        rsquared_einthoven = compute_rsquared(df)
 
-        title = (rf'{metric.split("_")[1]} ($R^2$: {rsquared_chest:.2f}, '
-                 f'{rsquared_einthoven:.2f})')
+        title = (rf'{metric.split("_")[1]} ($R^2$: {rsquared_chest[metric]:.2f}, '
+                 f'{rsquared_einthoven[metric]:.2f})')
         ax.set_title(title, fontsize=10)
 
     for i in range(rows):
@@ -120,7 +162,8 @@ def plot_both_regressions():
     return fig
 
 
-if __name__ == '__main__':
+def save_figures():
+    """Saves the CCC-JF regression figures in figures/."""
     plt.close('all')
     figs = []
     figs.append(plot_regressions('chest_strap'))
@@ -134,4 +177,7 @@ if __name__ == '__main__':
         print('Saving figure as', fn)
         fig.savefig(save_path / fn)
 
+
+if __name__ == '__main__':
+    save_figures()
     plt.show()
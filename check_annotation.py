@@ -2,7 +2,7 @@
 Print subject, setup, and condition for which there are no annotations.
 """
 
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 from tqdm import tqdm
 
 
@@ -12,7 +12,7 @@ subjects = range(nsubjects)
 
 for s in tqdm(subjects, desc='Subject'):
     for experiment in tqdm(experiments, desc='Setup', leave=False):
-        ecg = GUDb(s, experiment)
+        ecg = CachedGUDb(s, experiment)
         if not ecg.anno_cables_exists:
             tqdm.write(f'Subject {s:2d}, setup Einthoven, condition {experiment}: '
                        'no annotations')
@@ -2,60 +2,173 @@
 Compute HRV for all subjects, conditions, methods, and setups.
 """
 # %% Import libraries and ecg_class
+import os
 from pathlib import Path
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
-import neurokit2 as nk
 from tqdm import tqdm
-from utils import read_info, make_peaks_file_name, subjects
+from utils import read_info, subjects, ResultBuilder, export_metrics
+from jf.util import flatten
+from peak_store import PeakStore
+from hrv_metrics import hrv, neurokit_hrv, plan
+from reference_hrv import ReferenceMemo
 
 
-def compute_hrv(setup, methods_names):
-    df_det_hrv = pd.DataFrame()
-    df_ann_hrv = pd.DataFrame()
+def hrv_task(task):
+    """
+    Computes the HRV metrics of one (subject, experiment, method) task with
+    neurokit2 and its wall time. HRV errors of detected peaks give None;
+    errors of annotated peaks are raised. Used by the process pool.
+    """
+    s, experiment, method, peaks, fs, metrics = task
+    t0 = perf_counter()
+    try:
+        hrv = neurokit_hrv(peaks, fs, metrics)
+    except (ValueError, ZeroDivisionError):
+        if method == 'Annotated':
+            raise
+        hrv = None
+    return hrv, perf_counter() - t0
 
-    for s in tqdm(subjects, desc='Subject'):
-        for experiment in tqdm(experiments, desc='Condition'):
 
-            ann_file = read_path / make_peaks_file_name(s, setup, experiment, 'annotated')
+def native_results(tasks, metrics):
+    """
+    Computes the HRV metrics of all tasks at once with hrv_metrics.hrv.
+    Gives (hrv, wall_time) per task like hrv_task, with the wall time of
+    the batch shared evenly among the tasks.
+    """
+    t0 = perf_counter()
+    peaks, offsets = flatten([task[3] for task in tasks])
+    table = hrv(peaks, offsets, FS, metrics)
+    wall_time = (perf_counter() - t0) / max(len(tasks), 1)
+    results = []
+    for task, row in zip(tasks, table.to_dict('records')):
+        if np.all(np.isnan(list(row.values()))):
+            if task[2] == 'Annotated':
+                raise ValueError(f'Invalid annotated peaks of subject '
+                                 f'{task[0]}, condition {task[1]}')
+            row = None
+        results.append((row, wall_time))
+    return results
+
+
+def compute_hrv(setup, methods_names, jobs=1, engine='neurokit',
+                metrics=export_metrics, memo=None):
+    """
+    Computes the HRV of the annotated and detected peaks of a setup. With
+    jobs > 1 the (subject, experiment, method) tasks run in a pool of `jobs`
+    processes, and jobs=None, 0 or 1 runs them in this process; rows keep
+    the order of the serial run. The wall time of
+    every task is saved in {setup}_HRV_timing.csv.
+
+    metrics: HRV_ names of the metrics to compute, by default the ones that
+    export_HRV.py keeps. Only the domains they need are computed (see
+    hrv_metrics.plan); None computes every metric of the engine.
+    engine='neurokit' runs the neurokit2 function of every needed domain
+    for every task. engine='native' computes all tasks at once in this
+    process with the in-project engine of hrv_metrics.hrv.
+
+    The HRV of the annotated peaks is taken from the reference memo
+    (reference_hrv.ReferenceMemo, by default the one in results/HRV) and
+    only computed, and stored, when it is missing or the annotations
+    changed.
+    """
+    if engine not in ('neurokit', 'native'):
+        raise ValueError(f'Unknown HRV engine {engine}')
+    if metrics is not None:
+        plan(metrics, engine)  # fail early on unknown metrics
+    det_hrv_rows = ResultBuilder()
+    ann_hrv_rows = ResultBuilder()
+    timing_rows = ResultBuilder()
+    store = PeakStore(setup, read_path)
+    if memo is None:
+        memo = ReferenceMemo()
+
+    tasks = []
+    for s in subjects:
+        for experiment in experiments:
+
             try:
-                annotated_peaks = np.load(ann_file)
-            except FileNotFoundError:
+                annotated_peaks = store.read(s, experiment, 'annotated')
+            except KeyError:
                 tqdm.write(f'Skip subject {s}, experiemnt {experiment}.')
                 continue
+            tasks.append((s, experiment, 'Annotated', annotated_peaks, FS,
+                          metrics))
 
-            # Compute HRV
-            ann_hrv = nk.hrv(annotated_peaks, FS)
-            ann_hrv['method'] = 'Annotated'
-            ann_hrv['experiment'] = experiment
-            ann_hrv['subject_idx'] = s
-
-            df_ann_hrv = pd.concat([df_ann_hrv, ann_hrv])
-
-            for method in tqdm(methods_names, desc='Method', leave=False):
-                det_file = read_path / make_peaks_file_name(s, setup, experiment, method)
+            for method in methods_names:
                 try:
-                    detected_peaks = np.load(det_file)
-                except FileNotFoundError:
+                    detected_peaks = store.read(s, experiment, method)
+                except KeyError:
                     tqdm.write(f'skip subject {s}: {method}')
                     continue
-                try:
-                    det_hrv = nk.hrv(detected_peaks, FS)
-                    det_hrv['method'] = method
-                    det_hrv['experiment'] = experiment
-                    det_hrv['subject_idx'] = s
-                except (ValueError, ZeroDivisionError):
-                    tqdm.write(f'Error computing HRV for subject {s}, '
-                               f'condition {experiment}, method {method}')
-                else:
-                    df_det_hrv = pd.concat([df_det_hrv, det_hrv])
-
-    df_det_hrv = pd.concat([df_det_hrv, df_ann_hrv], axis=0)
-    df_det_hrv = df_det_hrv.reset_index(drop=True)
+                tasks.append((s, experiment, method, detected_peaks, FS,
+                              metrics))
+
+    # Reference HRV already in the memo
+    memoized = {}
+    for i, (s, experiment, method, peaks, fs, _) in enumerate(tasks):
+        if method == 'Annotated':
+            hrv = memo.get(setup, s, experiment, peaks, fs, metrics, engine)
+            if hrv is not None:
+                memoized[i] = hrv
+    todo = [task for i, task in enumerate(tasks) if i not in memoized]
+
+    # Compute HRV
+    executor = None
+    if engine == 'native':
+        results = native_results(todo, metrics)
+    elif jobs is None or jobs <= 1:
+        results = map(hrv_task, todo)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(hrv_task, todo, chunksize=1)
+    results = iter(results)
+
+    try:
+        for i, task in enumerate(tqdm(tasks, desc='HRV')):
+            s, experiment, method, peaks, fs, _ = task
+            if i in memoized:
+                hrv, wall_time = memoized[i], 0.0
+            else:
+                hrv, wall_time = next(results)
+                if method == 'Annotated':
+                    if isinstance(hrv, pd.DataFrame):
+                        hrv = hrv.iloc[0].to_dict()
+                    memo.put(setup, s, experiment, peaks, fs, metrics, hrv,
+                             engine)
+            timing_rows.add_row(method=method, experiment=experiment,
+                                subject_idx=s, wall_time=wall_time)
+            if hrv is None:
+                tqdm.write(f'Error computing HRV for subject {s}, '
+                           f'condition {experiment}, method {method}')
+            elif method == 'Annotated':
+                ann_hrv_rows.add_row(hrv, method=method,
+                                     experiment=experiment, subject_idx=s)
+            else:
+                det_hrv_rows.add_row(hrv, method=method,
+                                     experiment=experiment, subject_idx=s)
+    finally:
+        if executor is not None:
+            # Also stops the pool when an annotated task raised
+            executor.shutdown(cancel_futures=True)
+
+    det_hrv_rows.extend(ann_hrv_rows)
+    df_det_hrv = det_hrv_rows.to_frame()
     fn = save_path / f'{setup}_HRV_results.csv'
     df_det_hrv.to_csv(fn)
     print('Results saved in', fn)
 
+    timing = timing_rows.to_frame()
+    timing.to_csv(save_path / f'{setup}_HRV_timing.csv', index=False)
+    n_annotated = sum(task[2] == 'Annotated' for task in tasks)
+    print(f'Reference HRV of {n_annotated} recordings, {len(memoized)} '
+          f'from the memo')
+    print(f'HRV of {len(timing)} tasks: {timing["wall_time"].sum():.1f} s '
+          f'in total, {timing["wall_time"].max():.2f} s for the slowest task')
+
 
 if __name__ == '__main__':
     parent_path = Path(__file__).resolve().parent
@@ -65,6 +178,9 @@ if __name__ == '__main__':
     experiments = info['experiments']
     methods_names = np.array(info['methods_names'])
     FS = 250  # This should be inside the info file
-    compute_hrv('einthoven', methods_names)
+    jobs = os.cpu_count()
+    engine = 'neurokit'  # 'native' uses the in-project HRV engine
+    metrics = export_metrics  # None computes every metric
+    compute_hrv('einthoven', methods_names, jobs, engine, metrics)
     methods_names = np.array(info['methods_names'])
-    compute_hrv('chest_strap', methods_names)
+    compute_hrv('chest_strap', methods_names, jobs, engine, metrics)
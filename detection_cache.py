@@ -0,0 +1,142 @@
+"""
+Content-addressed cache of R-peak detections.
+
+The detections are stored on disk keyed by a hash of the ECG samples, the
+detector name, the sampling rate and the py-ecg-detectors version, so running
+the same detector on the same signal again (in another script or when
+regenerating plots) skips the detection. When the cache grows beyond
+`max_bytes` the least recently used entries are removed.
+"""
+import hashlib
+import os
+from importlib.metadata import version, PackageNotFoundError
+from pathlib import Path
+import numpy as np
+from ecgdetectors import Detectors
+
+cache_path = Path(__file__).resolve().parent / 'detection_cache'
+
+try:
+    detectors_version = version('py-ecg-detectors')
+except PackageNotFoundError:
+    detectors_version = 'unknown'
+
+
+def detection_key(data, detector_name, fs):
+    """Hash of the signal, detector name, sampling rate and library version."""
+    data = np.ascontiguousarray(data)
+    h = hashlib.sha256()
+    h.update(f'{detector_name}|{fs}|{detectors_version}|'
+             f'{data.dtype.str}|{data.shape}|'.encode())
+    h.update(memoryview(data).cast('B'))
+    return h.hexdigest()
+
+
+class DetectionCache:
+    """
+    On-disk store of detections with size-based LRU eviction. Every entry is
+    a .npy file named after its key; its modification time is the last use.
+    `hits` and `misses` count the lookups of this instance only: instances
+    in pool workers keep their own counts, which the caller has to add up
+    (rr_peak_detection.run_detection does).
+    """
+
+    def __init__(self, cache_dir=cache_path, max_bytes=2**30):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.size = sum(f.stat().st_size for f in self.cache_dir.glob('*.npy'))
+
+    def path(self, key):
+        return self.cache_dir / f'{key}.npy'
+
+    def get(self, key):
+        """Returns the cached peaks of `key` or None."""
+        fn = self.path(key)
+        try:
+            peaks = np.load(fn)
+            os.utime(fn)  # mark as recently used
+        except (FileNotFoundError, ValueError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return peaks
+
+    def put(self, key, peaks):
+        fn = self.path(key)
+        tmp = fn.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            np.save(f, np.asarray(peaks))
+        try:
+            old_size = fn.stat().st_size  # an existing entry is replaced
+        except FileNotFoundError:
+            old_size = 0
+        os.replace(tmp, fn)  # atomic, safe with several processes
+        self.size += fn.stat().st_size - old_size
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until under max_bytes."""
+        entries = []
+        for f in self.cache_dir.glob('*.npy'):
+            try:
+                st = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, f))
+        entries.sort()
+        self.size = sum(e[1] for e in entries)
+        for _, size, f in entries:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+            self.size -= size
+
+    def clear(self):
+        for f in self.cache_dir.glob('*.npy'):
+            f.unlink()
+        self.size = 0
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size_bytes': self.size}
+
+    def cached(self, detector, fs, name=None):
+        """
+        Wraps a detector function so its results are looked up in the cache
+        before running it.
+        """
+        name = detector.__name__ if name is None else name
+
+        def cached_detector(data):
+            key = detection_key(data, name, fs)
+            peaks = self.get(key)
+            if peaks is None:
+                peaks = np.asarray(detector(data))
+                self.put(key, peaks)
+            return peaks
+
+        cached_detector.__name__ = name
+        return cached_detector
+
+
+class CachedDetectors(Detectors):
+    """
+    ecgdetectors.Detectors whose detector methods go through a
+    DetectionCache. The cache is available as the `cache` attribute.
+    """
+
+    def __init__(self, sampling_frequency, cache=None):
+        super().__init__(sampling_frequency)
+        self.cache = DetectionCache() if cache is None else cache
+        for name, detector in self.detector_list:
+            setattr(self, detector.__name__,
+                    self.cache.cached(detector, sampling_frequency))
+        self.detector_list = [[name, getattr(self, detector.__name__)]
+                              for name, detector in self.detector_list]
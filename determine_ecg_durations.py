@@ -4,12 +4,12 @@ Show the duration of the ECGs for all subjects, setups, and conditions.
 from pathlib import Path
 import numpy as np
 from tqdm import tqdm
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 import pandas as pd
 
 
 def duration_single_case(s, experiment, setup):
-    ecg = GUDb(s, experiment)
+    ecg = CachedGUDb(s, experiment)
 
     if setup == 'Einthoven':
         # annotated = ecg.anno_cables_exists
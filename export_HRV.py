@@ -5,18 +5,50 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
+from utils import export_metrics
+from reference_hrv import ReferenceMemo
+from peak_store import PeakStore
 
 save_path = Path(__file__).resolve().parent /  'results/HRV'
 
-def export_hrv(setup):
+def export_hrv(setup, memo=None, store=None, fs=250, engine='neurokit'):
+    """
+    The annotated rows of the HRV results are the values computed, or taken
+    from the reference memo, by compute_hrv.py. Rows without values are
+    filled from the memo entries of `engine` that still match the annotated
+    peaks in `store` (by default the PeakStore of the setup); rows with
+    values must agree with such an entry, otherwise a ValueError is raised.
+    The rows keep their order.
+    """
     hrv_metrics = pd.read_csv(save_path / f'{setup}_HRV_results.csv')
-    subset = hrv_metrics[['subject_idx', 'method', 'experiment', 'HRV_MeanNN',
-                          'HRV_SDNN', 'HRV_RMSSD', 'HRV_SDSD', 'HRV_CVSD',
-                          'HRV_CVNN', 'HRV_TINN', 'HRV_HTI', 'HRV_SDRMSSD',
-                          'HRV_pNN20', 'HRV_pNN50', 'HRV_IQRNN', 'HRV_LF',
-                          'HRV_HF', 'HRV_LFHF', 'HRV_LFn', 'HRV_HFn', 'HRV_LnHF',
-                          'HRV_SD1', 'HRV_SD2', 'HRV_SD1SD2', 'HRV_SampEn',
-                          'HRV_TP']]
+    memo = ReferenceMemo() if memo is None else memo
+    store = PeakStore(setup) if store is None else store
+    reference = memo.table(setup, export_metrics, store, fs, engine)
+    annotated = hrv_metrics.index[hrv_metrics['method'] == 'Annotated']
+    keys = ['subject_idx', 'experiment']
+    memoized = hrv_metrics.loc[annotated, keys].merge(
+        reference, on=keys, how='left', indicator=True)
+    found = (memoized['_merge'] == 'both').to_numpy()
+    fresh = hrv_metrics.loc[annotated, export_metrics].to_numpy(dtype=float)
+    memo_values = memoized[export_metrics].to_numpy(dtype=float)
+    computed = ~np.isnan(fresh).all(axis=1)
+
+    both = found & computed
+    agree = np.isclose(fresh[both], memo_values[both], rtol=1e-9, atol=0,
+                       equal_nan=True).all(axis=1)
+    if not agree.all():
+        stale = memoized.loc[both, keys][~agree]
+        raise ValueError(f'The reference memo of setup {setup} disagrees '
+                         f'with the HRV results for\n{stale.to_string()}')
+
+    fill = found & ~computed
+    if fill.any():
+        hrv_metrics[export_metrics] = hrv_metrics[export_metrics].astype(float)
+        hrv_metrics.loc[annotated[fill], export_metrics] = memo_values[fill]
+    print(f'Annotated HRV of {fill.sum()} of {len(annotated)} recordings '
+          'from the reference memo')
+    subset = hrv_metrics[['subject_idx', 'method', 'experiment'] +
+                         export_metrics]
     if setup == 'einthoven':
         subset = subset[subset['experiment'] != 'jogging']
     if setup == 'chest_strap':
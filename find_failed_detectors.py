@@ -2,9 +2,9 @@
 Finds detectors that fails to detect 10 or more R peaks.
 """
 from pathlib import Path
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 import matplotlib.pyplot as plt
-from ecgdetectors import Detectors
+from detection_cache import CachedDetectors
 from jf.jf_analysis import evaluate as jf
 from jf.sensitivity_analysis import evaluate as sens
 import pandas as pd
@@ -19,12 +19,12 @@ def check_all(setup):
     """
     df = []
     count = 0
-    experiments = GUDb.experiments
-    detectors = Detectors(FS)
+    experiments = CachedGUDb.experiments
+    detectors = CachedDetectors(FS)
     print('Checking all subjects and conditions for setup', setup)
     for experiment in tqdm(experiments, desc='Condition'):
         for subject in tqdm(range(25), desc='Subject', leave=True):
-            ecg = GUDb(subject, experiment)
+            ecg = CachedGUDb(subject, experiment)
 
             if setup == 'chest_strap':
                 data = ecg.cs_V2_V1 * 1000
@@ -59,6 +59,7 @@ def check_all(setup):
                         tqdm.write(f'Total annotated peaks: {len(annotated_peaks)}')
                         count += 1
 
+    print('Detection cache:', detectors.cache.stats())
     df = pd.DataFrame.from_dict(df)
     print(f'Number of recordings without detections: {count}')
     df = df[df['detected_peaks'] < 10]
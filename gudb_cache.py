@@ -0,0 +1,128 @@
+"""
+Local binary cache of the GUDb recordings.
+
+`ecg_gudb_database.GUDb` downloads and parses the TSV files of a recording
+every time it is constructed. Running this script once stores every channel
+and annotation of every recording as a `.npy` file in `gudb_cache/`, plus an
+`index.json` with the annotation flags and lengths. `CachedGUDb` is a drop-in
+replacement for `GUDb` that opens the channels with `np.load(mmap_mode='r')`,
+so the pipeline runs offline and loading a recording costs no copies.
+Recordings missing from the cache are downloaded and stored on first use.
+"""
+import json
+from pathlib import Path
+import numpy as np
+from ecg_gudb_database import GUDb
+from tqdm import tqdm
+
+cache_path = Path(__file__).resolve().parent / 'gudb_cache'
+channels = ['cs_V2_V1', 'einthoven_II', 'einthoven_III', 'acc_x', 'acc_y',
+            'acc_z']
+annotations = ['anno_cs', 'anno_cables']
+
+
+def record_path(subject, experiment, cache_dir=cache_path):
+    return Path(cache_dir) / f'subject_{subject:02d}' / experiment
+
+
+def read_index(cache_dir=cache_path):
+    """Returns the index of the cache, keyed by 'subject/experiment'."""
+    fn = Path(cache_dir) / 'index.json'
+    try:
+        with open(fn) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_index(index, cache_dir=cache_path):
+    fn = Path(cache_dir) / 'index.json'
+    tmp = fn.with_suffix('.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    tmp.replace(fn)
+
+
+def ingest_record(subject, experiment, cache_dir=cache_path, index=None,
+                  **gudb_kwargs):
+    """
+    Downloads one recording with GUDb and stores its channels and
+    annotations in the cache. Returns the index entry of the recording.
+    """
+    ecg = GUDb(subject, experiment, **gudb_kwargs)
+    path = record_path(subject, experiment, cache_dir)
+    path.mkdir(parents=True, exist_ok=True)
+    for channel in channels:
+        np.save(path / f'{channel}.npy',
+                np.ascontiguousarray(getattr(ecg, channel)))
+    entry = {'n_samples': len(ecg.cs_V2_V1)}
+    for anno in annotations:
+        exists = getattr(ecg, f'{anno}_exists')
+        entry[f'{anno}_exists'] = exists
+        if exists:
+            np.save(path / f'{anno}.npy', getattr(ecg, anno))
+
+    if index is None:
+        index = read_index(cache_dir)
+        index[f'{subject}/{experiment}'] = entry
+        write_index(index, cache_dir)
+    else:
+        index[f'{subject}/{experiment}'] = entry
+    return entry
+
+
+def ingest(cache_dir=cache_path, subjects=range(GUDb.total_subjects),
+           experiments=GUDb.experiments, overwrite=False, **gudb_kwargs):
+    """
+    Stores all recordings in the cache. Recordings already in the cache are
+    skipped unless `overwrite` is True.
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    index = read_index(cache_dir)
+    for s in tqdm(subjects, desc='Subject'):
+        for experiment in tqdm(experiments, desc='Condition', leave=False):
+            if not overwrite and f'{s}/{experiment}' in index:
+                continue
+            ingest_record(s, experiment, cache_dir, index, **gudb_kwargs)
+            write_index(index, cache_dir)
+    print('GUDb cache written in', cache_dir)
+    return index
+
+
+class CachedGUDb(GUDb):
+    """
+    GUDb recording loaded from the local cache. Has the same attributes as
+    GUDb; the channels and annotations are read-only memory-mapped arrays.
+    """
+
+    def __init__(self, _subj, _experiment, cache_dir=cache_path):
+        self.subj = _subj
+        self.experiment = _experiment
+        self.cache_dir = Path(cache_dir)
+        entry = read_index(cache_dir).get(f'{_subj}/{_experiment}')
+        if entry is None:
+            entry = ingest_record(_subj, _experiment, cache_dir)
+        path = record_path(_subj, _experiment, cache_dir)
+
+        for channel in channels:
+            setattr(self, channel, np.load(path / f'{channel}.npy',
+                                           mmap_mode='r'))
+        for anno in annotations:
+            exists = entry[f'{anno}_exists']
+            setattr(self, f'{anno}_exists', exists)
+            setattr(self, anno, np.load(path / f'{anno}.npy', mmap_mode='r')
+                    if exists else False)
+
+        self.T = 1/self.fs
+
+    @property
+    def einthoven_I(self):
+        return self.einthoven_II - self.einthoven_III
+
+    @property
+    def t(self):
+        return np.linspace(0, self.T*len(self.cs_V2_V1), len(self.cs_V2_V1))
+
+
+if __name__ == '__main__':
+    ingest()
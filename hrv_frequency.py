@@ -0,0 +1,269 @@
+"""
+Frequency-domain HRV of many recordings at once.
+
+nk.hrv_frequency interpolates the tachogram of one recording at 100 Hz with
+a quadratic spline, estimates its Welch PSD and integrates the power of
+every band. Here the splines of all recordings are fitted with a single
+banded solve and evaluated on their grids in one vectorized step, the Welch
+spectra of all recordings with the same segment length come from one FFT,
+and the bands of all recordings are integrated together from cumulative
+trapezoids. The results follow neurokit2 0.2.10 with its default settings
+(normalized Welch PSD), and the columns have the HRV_ prefix of nk.hrv.
+"""
+import numpy as np
+import pandas as pd
+from scipy.linalg import solve_banded
+from scipy.signal import get_window
+from jf.util import flatten, segment_ids
+from hrv_time import rr_intervals
+
+bands = {'ULF': (0, 0.0033), 'VLF': (0.0033, 0.04), 'LF': (0.04, 0.15),
+         'HF': (0.15, 0.4), 'VHF': (0.4, 0.5)}
+frequency_metrics = list(bands) + ['TP', 'LFHF', 'LFn', 'HFn', 'LnHF']
+
+
+def segment_cumsum(values, offsets):
+    """
+    Cumulative sum within each recording, written into one flat array. Every
+    recording is summed on its own, so the result equals np.cumsum of every
+    recording bit for bit (a flat cumsum minus the totals at the starts
+    would round differently and shift the interpolation grids), and the
+    memory stays that of the values.
+    """
+    out = np.empty(len(values))
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        np.cumsum(values[start:end], out=out[start:end])
+    return out
+
+
+def spline_basis(t, l, u):
+    """
+    The three quadratic B-splines that are non-zero at u, for u in the knot
+    interval t[l] <= u <= t[l+1] (Cox-de Boor recursion). With distinct
+    data points none of the knot differences used here is zero.
+    """
+    t0, t1, t2, t3 = t[l - 1], t[l], t[l + 1], t[l + 2]
+    left = (t2 - u) / (t2 - t1)
+    right = 1 - left
+    b0 = (t2 - u) / (t2 - t0) * left
+    b2 = (u - t1) / (t3 - t1) * right
+    return b0, 1 - b0 - b2, b2
+
+
+def interpolate(x, y, offsets, rate):
+    """
+    Quadratic spline interpolation of many series at `rate` Hz, like
+    nk.signal_interpolate (scipy's interp1d with kind='quadratic') on the
+    grid np.arange(x[0], x[-1] + 1/rate, 1/rate) of each series. Every
+    series needs at least 3 points with distinct, increasing x.
+
+    returns the flat interpolated values and their offsets.
+    """
+    n = np.diff(offsets)
+    n_seg = len(n)
+    seg = segment_ids(offsets)
+    start = offsets[:-1]
+    last = offsets[1:] - 1
+
+    # Knots of make_interp_spline(x, y, k=2): x[0] and x[-1] three times and
+    # the midpoints of x without the first and the last one
+    mid = (x[1:] + x[:-1]) / 2
+    same = seg[1:] == seg[:-1]
+    mid, mid_seg = mid[same], seg[1:][same]
+    mid_local = np.arange(len(mid)) - (start - np.arange(n_seg))[mid_seg]
+    inner = (mid_local > 0) & (mid_local < n[mid_seg] - 2)
+    knot_offsets = np.zeros(n_seg + 1, dtype=np.int64)
+    knot_offsets[1:] = np.cumsum(n + 3)
+    knots = np.empty(knot_offsets[-1])
+    knot_start = knot_offsets[:-1]
+    for i in range(3):
+        knots[knot_start + i] = x[start]
+        knots[knot_offsets[1:] - 1 - i] = x[last]
+    knots[knot_start[mid_seg[inner]] + 2 + mid_local[inner]] = mid[inner]
+
+    # Knot interval of a point of series `rows`, kept within t[2]..t[n]
+    duration = x[last] - x[start]
+    span = duration.max() + 1
+    knot_seg = segment_ids(knot_offsets)
+    keys = knots - x[start][knot_seg] + knot_seg * span
+    def interval(u, rows):
+        l = np.searchsorted(keys, u - x[start][rows] + rows * span,
+                            side='right') - 1 - knot_start[rows]
+        return np.clip(l, 2, n[rows] - 1)
+
+    # Collocation matrix of all series as one block-diagonal banded system
+    l = interval(x, seg)
+    basis = spline_basis(knots, knot_start[seg] + l, x)
+    ab = np.zeros((3, len(x)))
+    row = np.arange(len(x))
+    for j, b in enumerate(basis):
+        col = start[seg] + l - 2 + j
+        band = 1 + row - col
+        ok = (band >= 0) & (band <= 2)
+        ab[band[ok], col[ok]] = b[ok]
+    coefficients = solve_banded((1, 1), ab, y)
+
+    # Grid of every series as np.arange computes it
+    step = 1 / rate
+    delta = (x[start] + step) - x[start]
+    n_grid = np.ceil((x[last] + step - x[start]) / step).astype(np.int64)
+    grid_offsets = np.zeros(n_seg + 1, dtype=np.int64)
+    grid_offsets[1:] = np.cumsum(n_grid)
+    grid_seg = segment_ids(grid_offsets)
+    u = (x[start][grid_seg] +
+         (np.arange(grid_offsets[-1]) - grid_offsets[:-1][grid_seg]) *
+         delta[grid_seg])
+
+    l = interval(u, grid_seg)
+    basis = spline_basis(knots, knot_start[grid_seg] + l, u)
+    first = start[grid_seg] + l - 2
+    values = sum(coefficients[first + j] * b for j, b in enumerate(basis))
+    # interp1d fills points past the last one with the last value
+    beyond = u > x[last][grid_seg]
+    values[beyond] = y[last][grid_seg[beyond]]
+    return values, grid_offsets
+
+
+def welch(signal, offsets, fs):
+    """
+    Normalized Welch PSD of every recording of a flat signal after
+    removing its mean, with the segment length of nk.signal_psd: half the
+    recording, hann window, 50 % overlap, no detrending and nfft twice the
+    segment length. Recordings with the same segment length share one
+    window and one FFT call.
+
+    returns a list of (rows, frequency, power) with one entry per segment
+    length, where power has one row per recording in `rows`.
+    """
+    n = np.diff(offsets)
+    seg = segment_ids(offsets)
+    # Constant detrend of every recording
+    mean = np.bincount(seg, weights=signal, minlength=len(n)) / n
+    signal = signal - mean[seg]
+    with np.errstate(divide='ignore'):
+        min_frequency = (2 * fs) / (n / 2)
+        nperseg = np.where(n > 0, (2 / min_frequency) * fs, 0).astype(np.int64)
+    nperseg = np.where(nperseg > n / 2, (n / 2).astype(np.int64), nperseg)
+
+    spectra = []
+    for length in np.unique(nperseg[nperseg > 0]):
+        rows = np.flatnonzero(nperseg == length)
+        window = get_window('hann', length)
+        step = length - length // 2
+        n_windows = (n[rows] - length // 2) // step
+        win_offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        win_offsets[1:] = np.cumsum(n_windows)
+        win_row = segment_ids(win_offsets)
+        win_index = np.arange(win_offsets[-1]) - win_offsets[:-1][win_row]
+        win_start = offsets[:-1][rows][win_row] + win_index * step
+        segments = signal[win_start[:, None] + np.arange(length)] * window
+        power = np.abs(np.fft.rfft(segments, n=2 * length, axis=1))**2
+        power = np.add.reduceat(power, win_offsets[:-1], axis=0)
+        power /= n_windows[:, None]
+        power *= 1 / (fs * (window**2).sum())
+        power[:, 1:-1] *= 2
+        power /= power.max(axis=1, keepdims=True)
+        frequency = np.fft.rfftfreq(2 * length, 1 / fs)
+        spectra.append((rows, frequency, power))
+    return spectra, min_frequency
+
+
+def band_power(frequency, power, low, high, min_frequency):
+    """
+    Power of the rows of `power` in the band low <= f < high, integrated
+    with the trapezoidal rule over the frequencies above the min_frequency
+    of every row, as nk.signal_power. The bands end at most at the
+    max_frequency of nk.hrv_frequency. A power of 0 gives nan, as neurokit2
+    does.
+
+    low, high: arrays with one entry per band
+    returns an array with one row per row of power and one column per band.
+    """
+    # Cumulative trapezoids, so every band is a difference of two entries
+    areas = (np.diff(frequency) * (power[:, 1:] + power[:, :-1]) / 2)
+    cumulative = np.zeros(power.shape)
+    cumulative[:, 1:] = np.cumsum(areas, axis=1)
+    lo = np.maximum(low[None, :], min_frequency[:, None])
+    first = np.searchsorted(frequency, lo, side='left')
+    last = np.maximum(np.searchsorted(frequency, high, side='left') - 1, first)
+    last = np.broadcast_to(last, first.shape)
+    first = np.minimum(first, power.shape[1] - 1)
+    last = np.minimum(last, power.shape[1] - 1)
+    rows = np.arange(len(power))[:, None]
+    out = cumulative[rows, last] - cumulative[rows, first]
+    return np.where(out == 0, np.nan, out)
+
+
+def frequency_domain(rri, rri_offsets, valid=None, interpolation_rate=100):
+    """
+    Frequency-domain metrics of flat RR intervals with offsets, see
+    hrv_frequency. Recordings that are not `valid`, or cannot be
+    interpolated, are nan.
+
+    returns a dict of arrays with one value per recording.
+    """
+    n_seg = len(rri_offsets) - 1
+    if valid is None:
+        valid = np.ones(n_seg, dtype=bool)
+    rri_time = segment_cumsum(rri / 1000, rri_offsets)
+
+    # Average intervals with the same time stamp, as nk.signal_interpolate
+    seg = segment_ids(rri_offsets)
+    new = np.r_[True, (rri_time[1:] != rri_time[:-1]) |
+                (seg[1:] != seg[:-1])][:len(rri)]
+    run = np.cumsum(new) - 1
+    x = rri_time[new]
+    y = np.bincount(run, weights=rri) / np.bincount(run)
+    n_points = np.bincount(seg[new], minlength=n_seg)
+
+    # Only recordings that can be interpolated are passed on
+    valid = valid & (n_points >= 3)
+    recordings = np.flatnonzero(valid)
+    keep = valid[seg[new]]
+    x, y = x[keep], y[keep]
+    x_offsets = np.zeros(len(recordings) + 1, dtype=np.int64)
+    x_offsets[1:] = np.cumsum(n_points[recordings])
+
+    out = np.full((n_seg, len(bands)), np.nan)
+    if len(recordings):
+        signal, signal_offsets = interpolate(x, y, x_offsets,
+                                             interpolation_rate)
+        spectra, min_frequency = welch(signal, signal_offsets,
+                                       interpolation_rate)
+        low = np.array([b[0] for b in bands.values()])
+        high = np.array([b[1] for b in bands.values()])
+        for rows, frequency, power in spectra:
+            out[recordings[rows]] = band_power(frequency, power, low, high,
+                                               min_frequency[rows])
+
+    table = {name: out[:, i] for i, name in enumerate(bands)}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        table['TP'] = np.where(valid, np.nansum(out, axis=1), np.nan)
+        table['LFHF'] = table['LF'] / table['HF']
+        table['LFn'] = table['LF'] / table['TP']
+        table['HFn'] = table['HF'] / table['TP']
+        table['LnHF'] = np.log(table['HF'])
+    return table
+
+
+def hrv_frequency(peaks, offsets=None, fs=250, interpolation_rate=100):
+    """
+    Frequency-domain HRV of many recordings, as nk.hrv_frequency with its
+    default arguments.
+
+    peaks: flat array of the peaks of all recordings in samples, with
+    `offsets` as given by jf.util.flatten. A list of peak arrays can be given
+    instead, with offsets=None.
+    fs: sampling rate of the peaks
+    interpolation_rate: rate in Hz of the interpolated tachogram
+
+    returns a DataFrame with one row per recording and the columns
+    HRV_ULF, HRV_VLF, HRV_LF, HRV_HF, HRV_VHF, HRV_TP, HRV_LFHF, HRV_LFn,
+    HRV_HFn and HRV_LnHF. Recordings with decreasing peaks or fewer than
+    four peaks give rows of nan.
+    """
+    if offsets is None:
+        peaks, offsets = flatten(peaks)
+    rri, rri_offsets, increasing = rr_intervals(peaks, offsets, fs)
+    table = frequency_domain(rri, rri_offsets, increasing, interpolation_rate)
+    return pd.DataFrame({f'HRV_{k}': v for k, v in table.items()})
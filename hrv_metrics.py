@@ -0,0 +1,148 @@
+"""
+Computes a selected set of HRV metrics.
+
+The caller passes the HRV_ column names it needs (by default the metrics
+exported by export_HRV.py) and plan() finds the domains they belong to. Only
+those domains are computed, and they share their intermediates: the RR
+intervals are computed once for all domains, the interpolated tachogram and
+the PSD once for all frequency metrics, and the sorted intervals and the
+histogram only when a metric needs them (see hrv_time.metric_groups).
+
+hrv() computes the metrics with the in-project engine for many recordings at
+once; neurokit_hrv() calls only the neurokit2 functions of the needed domains
+for one recording, and computes the Poincaré metrics from the RR intervals.
+"""
+import numpy as np
+import pandas as pd
+import neurokit2 as nk
+from jf.util import flatten
+from utils import export_metrics
+from hrv_time import rr_intervals, time_domain, time_metrics, poincare_metrics
+from hrv_frequency import frequency_domain, frequency_metrics
+from sampen import segment_sample_entropy
+
+# Metrics of every domain of the in-project engine
+domains = {
+    'time': [f'HRV_{m}' for m in time_metrics],
+    'frequency': [f'HRV_{m}' for m in frequency_metrics],
+    'poincare': [f'HRV_{m}' for m in poincare_metrics],
+    'sampen': ['HRV_SampEn']}
+all_metrics = [m for names in domains.values() for m in names]
+# Time-domain metrics of nk.hrv_time that the in-project engine leaves out
+neurokit_time = [f'HRV_{m}{w}' for m in ('SDANN', 'SDNNI') for w in (1, 2, 5)]
+# Other columns of nk.hrv_nonlinear in neurokit2 0.2.10
+dfa = ['Width', 'Peak', 'Mean', 'Max', 'Delta', 'Asymmetry', 'Fluctuation',
+       'Increment']
+neurokit_nonlinear = (
+    ['HRV_PIP', 'HRV_IALS', 'HRV_PSS', 'HRV_PAS', 'HRV_GI', 'HRV_SI',
+     'HRV_AI', 'HRV_PI'] +
+    [f'HRV_{m}{side}' for m in ('C1', 'SD1', 'C2', 'SD2', 'C', 'SDNN')
+     for side in ('d', 'a')] +
+    [name for alpha in ('alpha1', 'alpha2') for name in
+     [f'HRV_DFA_{alpha}'] + [f'HRV_MFDFA_{alpha}_{m}' for m in dfa]] +
+    ['HRV_ApEn', 'HRV_ShanEn', 'HRV_FuzzyEn', 'HRV_MSEn', 'HRV_CMSEn',
+     'HRV_RCMSEn', 'HRV_CD', 'HRV_HFD', 'HRV_KFD', 'HRV_LZC'])
+
+
+def plan(metrics=export_metrics, engine='native'):
+    """
+    Domains needed for `metrics`, in the order of nk.hrv.
+
+    A ValueError is raised for metrics the engine does not compute:
+    engine='native' computes the metrics of `domains`, engine='neurokit'
+    also those of neurokit_time and neurokit_nonlinear. With
+    engine='neurokit' the Poincaré metrics come from the RR intervals and
+    SampEn from nk.entropy_sample, and only the other nonlinear metrics
+    need nk.hrv_nonlinear, which then also gives these.
+    """
+    needed = set()
+    for metric in metrics:
+        domain = next((d for d, names in domains.items() if metric in names),
+                      None)
+        if engine == 'neurokit':
+            if metric in neurokit_time:
+                domain = 'time'
+            elif metric in neurokit_nonlinear:
+                domain = 'nonlinear'
+        if domain is None:
+            raise ValueError(f'{metric} is not computed by the {engine} '
+                             'engine')
+        needed.add(domain)
+    if 'nonlinear' in needed:
+        needed -= {'poincare', 'sampen'}
+    order = ['time', 'frequency', 'poincare', 'nonlinear', 'sampen']
+    return [d for d in order if d in needed]
+
+
+def hrv(peaks, offsets=None, fs=250, metrics=export_metrics):
+    """
+    HRV metrics of many recordings with the in-project engine.
+
+    peaks: flat array of the peaks of all recordings in samples, with
+    `offsets` as given by jf.util.flatten. A list of peak arrays can be given
+    instead, with offsets=None.
+    fs: sampling rate
+    metrics: HRV_ names of the metrics to compute, None for all_metrics
+
+    returns a DataFrame with one row per recording and one column per
+    metric, in the order of `metrics`. Recordings for which nk.hrv would
+    raise in one of the needed domains give rows of nan.
+    """
+    if metrics is None:
+        metrics = all_metrics
+    needed = plan(metrics, 'native')
+    if offsets is None:
+        peaks, offsets = flatten(peaks)
+    rri, rri_offsets, valid = rr_intervals(peaks, offsets, fs)
+    n = np.diff(rri_offsets)
+    table = {}
+
+    if 'time' in needed or 'poincare' in needed:
+        names = [m[len('HRV_'):] for m in metrics]
+        table.update({f'HRV_{k}': v for k, v in
+                      time_domain(rri, rri_offsets, names).items()})
+        valid = valid & (n >= 2)
+    if 'frequency' in needed:
+        frequency = frequency_domain(rri, rri_offsets, valid)
+        table.update({f'HRV_{k}': v for k, v in frequency.items()})
+        valid = valid & ~np.isnan(frequency['TP'])
+    if 'sampen' in needed:
+        table['HRV_SampEn'] = segment_sample_entropy(rri, rri_offsets)
+        valid = valid & (n > 2)
+
+    return pd.DataFrame({m: np.where(valid, table[m], np.nan)
+                         for m in metrics})
+
+
+def neurokit_hrv(peaks, fs, metrics=export_metrics):
+    """
+    HRV metrics of one recording with neurokit2, calling only the functions
+    of the needed domains instead of nk.hrv, and nk.hrv_nonlinear only for
+    metrics other than the Poincaré metrics and SampEn. metrics=None
+    returns nk.hrv.
+    """
+    if metrics is None:
+        return nk.hrv(peaks, fs)
+    needed = plan(metrics, 'neurokit')
+    parts = []
+    if 'time' in needed:
+        parts.append(nk.hrv_time(peaks, fs))
+    if 'frequency' in needed:
+        parts.append(nk.hrv_frequency(peaks, fs))
+    rri = np.diff(peaks) / fs * 1000
+    if 'poincare' in needed:
+        # Same values as nk.hrv_nonlinear, which raises for these recordings
+        if len(rri) < 2 or np.any(rri < 0):
+            raise ValueError('Too few or decreasing peaks for the Poincaré '
+                             'plot')
+        names = [m[len('HRV_'):] for m in metrics if m in domains['poincare']]
+        poincare = time_domain(rri, np.array([0, len(rri)]), names)
+        parts.append(pd.DataFrame({f'HRV_{m}': poincare[m] for m in names}))
+    if 'nonlinear' in needed:
+        parts.append(nk.hrv_nonlinear(peaks, fs))
+    if 'sampen' in needed:
+        tolerance = 0.2 * np.std(rri, ddof=1)
+        sampen, _ = nk.entropy_sample(rri, delay=1, dimension=2,
+                                      tolerance=tolerance)
+        parts.append(pd.DataFrame({'HRV_SampEn': [sampen]}))
+    return pd.concat(parts, axis=1)[list(metrics)]
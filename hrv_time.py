@@ -0,0 +1,288 @@
+"""
+Time-domain and Poincaré HRV of many recordings at once.
+
+`nk.hrv` computes the HRV of one recording at a time. The functions here take
+the peaks of many recordings as one flat array with offsets (see
+jf.util.flatten), so that every metric is a handful of NumPy reductions over
+all recordings. The definitions follow neurokit2 0.2.10 (`nk.hrv_time` and
+the Poincaré part of `nk.hrv_nonlinear`), including the HRV_ prefix of the
+column names. SDANN and SDNNI are not computed: they need recordings of at
+least 2.5 minutes and are nan for GUDb.
+"""
+import numpy as np
+import pandas as pd
+from jf.util import flatten, segment_ids, segment_argsort
+
+binsize = 1000 / 128  # histogram bin of HTI and TINN in ms, as in neurokit2
+tinn_min_error = 2**14
+
+time_metrics = ['MeanNN', 'SDNN', 'RMSSD', 'SDSD', 'CVNN', 'CVSD', 'MedianNN',
+                'MadNN', 'MCVNN', 'IQRNN', 'SDRMSSD', 'Prc20NN', 'Prc80NN',
+                'pNN50', 'pNN20', 'MinNN', 'MaxNN', 'HTI', 'TINN']
+poincare_metrics = ['SD1', 'SD2', 'SD1SD2', 'S', 'CSI', 'CVI', 'CSI_Modified']
+
+
+def rr_intervals(peaks, offsets, fs):
+    """
+    RR intervals in ms of every recording of flat peaks with offsets.
+
+    returns the flat intervals, their offsets and a boolean array that is
+    False for recordings whose peaks decrease (nk.hrv raises for those).
+    """
+    peaks = np.asarray(peaks)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    seg = segment_ids(offsets)
+    same = seg[1:] == seg[:-1]
+    diff = np.diff(peaks)
+    increasing = np.ones(len(offsets) - 1, dtype=bool)
+    increasing[seg[1:][same & (diff < 0)]] = False
+    rri = diff[same] / fs * 1000
+    rri_offsets = np.zeros(len(offsets), dtype=np.int64)
+    rri_offsets[1:] = np.cumsum(np.maximum(np.diff(offsets) - 1, 0))
+    return rri, rri_offsets, increasing
+
+
+def segment_sum(values, seg, n_seg):
+    return np.bincount(seg, weights=values, minlength=n_seg)
+
+
+def segment_std(values, seg, n_seg, mean=None):
+    """Standard deviation with ddof=1 of each recording, nan if n < 2."""
+    n = np.bincount(seg, minlength=n_seg)
+    if mean is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = segment_sum(values, seg, n_seg) / n
+    ss = segment_sum((values - mean[seg])**2, seg, n_seg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 1, np.sqrt(ss / (n - 1)), np.nan)
+
+
+def segment_percentile(sorted_values, offsets, q):
+    """
+    Percentile q of each recording of a flat array sorted within
+    recordings, with the linear interpolation of np.percentile.
+    """
+    n = np.diff(offsets)
+    out = np.full(len(n), np.nan)
+    ok = n > 0
+    pos = q / 100 * (n[ok] - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.minimum(lo + 1, n[ok] - 1)
+    t = pos - lo
+    a = sorted_values[offsets[:-1][ok] + lo]
+    b = sorted_values[offsets[:-1][ok] + hi]
+    # Same lerp as numpy, exact at both ends
+    out[ok] = np.where(t >= 0.5, b - (b - a) * (1 - t), a + (b - a) * t)
+    return out
+
+
+def segment_tinn_hti(rri, offsets, seg, max_rri, min_rri):
+    """
+    HTI and TINN of every recording from its RR histogram with bins of
+    `binsize` ms starting at 0, as nk.hrv_time.
+
+    The TINN search of neurokit2 fits a triangle N-X-M to the histogram,
+    where X is the highest bin. Its loop over M is not reset between values
+    of N, so only the first bin edge above min(rri) is used as N; the error
+    of the triangle splits into a left part that only depends on N and a
+    right part that only depends on M. Both are computed for all recordings
+    at once with prefix sums over the histograms.
+    """
+    n_seg = len(offsets) - 1
+    ok = np.diff(offsets) > 0
+    # Bins of np.histogram(rri, np.arange(0, max + binsize, binsize))
+    n_edges = np.where(ok, np.ceil((np.where(ok, max_rri, 0) + binsize) / binsize),
+                       2).astype(np.int64)
+    n_bins = n_edges - 1
+    bin_offsets = np.zeros(n_seg + 1, dtype=np.int64)
+    bin_offsets[1:] = np.cumsum(n_bins)
+    k = np.minimum(np.floor(rri / binsize).astype(np.int64), n_bins[seg] - 1)
+    y = np.bincount(bin_offsets[:-1][seg] + k,
+                    minlength=bin_offsets[-1]).astype(float)
+
+    y_max = np.maximum.reduceat(y, bin_offsets[:-1]) if len(y) else np.zeros(n_seg)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hti = np.where(ok, np.diff(offsets) / y_max, np.nan)
+
+    # First bin of the maximum of each histogram
+    bin_seg = segment_ids(bin_offsets)
+    local = np.arange(len(y)) - bin_offsets[:-1][bin_seg]
+    at_max = np.flatnonzero(y == y_max[bin_seg])
+    first = np.r_[True, bin_seg[at_max][1:] != bin_seg[at_max][:-1]][:len(at_max)]
+    x_idx = np.zeros(n_seg, dtype=np.int64)
+    x_idx[bin_seg[at_max[first]]] = local[at_max[first]]
+
+    # N: first edge strictly above min(rri)
+    n_idx = np.floor(min_rri / binsize).astype(np.int64) + 1
+    n_idx = np.where(n_idx * binsize - min_rri <= 0, n_idx + 1, n_idx)
+    n_idx = np.where((n_idx - 1) * binsize - min_rri > 0, n_idx - 1, n_idx)
+
+    # Prefix sums of y, y*k and y**2 with a leading zero per recording
+    p_offsets = bin_offsets + np.arange(n_seg + 1)
+    def prefix(v):
+        p = np.zeros(len(y) + n_seg)
+        p[np.arange(len(y)) + bin_seg + 1] = v
+        p = np.cumsum(p)
+        # Restart every recording from zero
+        return p - np.repeat(p[p_offsets[:-1]], n_bins + 1)
+    p0, p1, p2 = prefix(y), prefix(y * local), prefix(y**2)
+    def range_sums(start, stop, rows):
+        """Sums of y, y*k and y**2 over bins start..stop-1 of rows."""
+        base = p_offsets[:-1][rows]
+        return [p[base + stop] - p[base + start] for p in (p0, p1, p2)]
+
+    Y = y_max
+    X = x_idx
+    sq = lambda d: (d - 1) * d * (2 * d - 1) / 6  # sum of t**2, t < d
+
+    # Left error: bins N..X-1 against the line from (N, 0) to (X, Y)
+    e = X - n_idx
+    has_left = ok & (e > 0) & (n_idx < n_edges)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        s0, s1, s2 = range_sums(np.where(has_left, n_idx, 0),
+                                np.where(has_left, X, 0), np.arange(n_seg))
+        left = s2 - 2 * Y / e * (s1 - n_idx * s0) + Y**2 / e**2 * sq(e)
+
+    # Right error for every candidate M = X+1 .. with M*binsize < max(rri)
+    m_max = np.where(has_left, np.ceil(max_rri / binsize).astype(np.int64) - 1,
+                     X)
+    m_max = np.where(m_max * binsize >= max_rri, m_max - 1, m_max)
+    m_max = np.where((m_max + 1) * binsize < max_rri, m_max + 1, m_max)
+    n_cand = np.maximum(m_max - X, 0) * has_left
+    cand_offsets = np.zeros(n_seg + 1, dtype=np.int64)
+    cand_offsets[1:] = np.cumsum(n_cand)
+    rows = segment_ids(cand_offsets)
+    m = X[rows] + 1 + np.arange(len(rows)) - cand_offsets[:-1][rows]
+    d = m - X[rows]
+    s0, s1, s2 = range_sums(X[rows] + 1, m + 1, rows)
+    right = s2 - 2 * Y[rows] / d * (m * s0 - s1) + Y[rows]**2 / d**2 * sq(d)
+
+    # First M with the smallest error, if that error is below the threshold
+    error = np.round(left[rows] + right, 6)
+    tinn = np.where(ok, 0.0, np.nan)
+    if len(error):
+        best = np.minimum.reduceat(error, cand_offsets[:-1][n_cand > 0])
+        has = np.flatnonzero(n_cand > 0)
+        is_best = np.flatnonzero(error == np.repeat(best, n_cand[has]))
+        first = np.r_[True, rows[is_best][1:] != rows[is_best][:-1]]
+        best_idx = is_best[first]
+        found = rows[best_idx]
+        below = error[best_idx] < tinn_min_error
+        tinn[found[below]] = ((m[best_idx] - n_idx[found]) * binsize)[below]
+    return hti, tinn
+
+
+metric_groups = {
+    'moments': ['MeanNN', 'SDNN', 'RMSSD', 'SDSD', 'CVNN', 'CVSD', 'SDRMSSD',
+                'pNN50', 'pNN20'],
+    'order': ['MedianNN', 'MadNN', 'MCVNN', 'IQRNN', 'Prc20NN', 'Prc80NN',
+              'MinNN', 'MaxNN'],
+    'histogram': ['HTI', 'TINN'],
+    'poincare': poincare_metrics}
+
+
+def time_domain(rri, rri_offsets, metrics=None):
+    """
+    Time-domain and Poincaré metrics of flat RR intervals with offsets, see
+    hrv_time. Only the groups of metric_groups that contain one of
+    `metrics` (names without the HRV_ prefix) are computed; None computes
+    all of them.
+
+    returns a dict of arrays with one value per recording, not masked for
+    invalid recordings.
+    """
+    need = lambda group: metrics is None or any(m in metrics
+                                                for m in metric_groups[group])
+    n_seg = len(rri_offsets) - 1
+    n = np.diff(rri_offsets)
+    seg = segment_ids(rri_offsets)
+    out = {}
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # Successive differences within recordings
+        same = seg[1:] == seg[:-1]
+        diff = np.diff(rri)[same]
+        diff_seg = seg[1:][same]
+        n_diff = np.bincount(diff_seg, minlength=n_seg)
+
+        if need('moments'):
+            mean = segment_sum(rri, seg, n_seg) / n
+            out['MeanNN'] = mean
+            out['SDNN'] = segment_std(rri, seg, n_seg, mean)
+            out['RMSSD'] = np.sqrt(segment_sum(diff**2, diff_seg, n_seg) / n_diff)
+            out['SDSD'] = segment_std(diff, diff_seg, n_seg)
+            out['CVNN'] = out['SDNN'] / out['MeanNN']
+            out['CVSD'] = out['RMSSD'] / out['MeanNN']
+            out['SDRMSSD'] = out['SDNN'] / out['RMSSD']
+            abs_diff = np.abs(diff)
+            out['pNN50'] = (np.bincount(diff_seg[abs_diff > 50], minlength=n_seg) /
+                            (n_diff + 1) * 100)
+            out['pNN20'] = (np.bincount(diff_seg[abs_diff > 20], minlength=n_seg) /
+                            (n_diff + 1) * 100)
+
+        if need('order'):
+            # Order statistics from the intervals sorted within recordings
+            s = rri[segment_argsort(rri, seg)]
+            median = segment_percentile(s, rri_offsets, 50)
+            abs_dev = np.abs(rri - median[seg])
+            abs_dev = abs_dev[segment_argsort(abs_dev, seg)]
+            out['MedianNN'] = median
+            out['MadNN'] = 1.4826 * segment_percentile(abs_dev, rri_offsets, 50)
+            out['MCVNN'] = out['MadNN'] / out['MedianNN']
+            out['IQRNN'] = (segment_percentile(s, rri_offsets, 75) -
+                            segment_percentile(s, rri_offsets, 25))
+            out['Prc20NN'] = segment_percentile(s, rri_offsets, 20)
+            out['Prc80NN'] = segment_percentile(s, rri_offsets, 80)
+            out['MinNN'] = segment_percentile(s, rri_offsets, 0)
+            out['MaxNN'] = segment_percentile(s, rri_offsets, 100)
+
+        if need('histogram'):
+            if 'MinNN' in out:
+                min_rri, max_rri = out['MinNN'], out['MaxNN']
+            else:
+                min_rri = np.full(n_seg, np.nan)
+                max_rri = np.full(n_seg, np.nan)
+                ok = n > 0
+                min_rri[ok] = np.minimum.reduceat(rri, rri_offsets[:-1][ok])
+                max_rri[ok] = np.maximum.reduceat(rri, rri_offsets[:-1][ok])
+            out['HTI'], out['TINN'] = segment_tinn_hti(rri, rri_offsets, seg,
+                                                       max_rri, min_rri)
+
+        if need('poincare'):
+            # Poincaré plot of rri[i] against rri[i+1]
+            x1 = -diff / np.sqrt(2)
+            x2 = (rri[:-1][same] + rri[1:][same]) / np.sqrt(2)
+            out['SD1'] = segment_std(x1, diff_seg, n_seg)
+            out['SD2'] = segment_std(x2, diff_seg, n_seg)
+            out['SD1SD2'] = out['SD1'] / out['SD2']
+            out['S'] = np.pi * out['SD1'] * out['SD2']
+            T = 4 * out['SD1']
+            L = 4 * out['SD2']
+            out['CSI'] = L / T
+            out['CVI'] = np.log10(L * T)
+            out['CSI_Modified'] = L**2 / T
+
+    return {k: out[k] for k in time_metrics + poincare_metrics if k in out}
+
+
+def hrv_time(peaks, offsets=None, fs=250):
+    """
+    Time-domain and Poincaré HRV of many recordings.
+
+    peaks: flat array of the peaks of all recordings in samples, with
+    `offsets` as given by jf.util.flatten. A list of peak arrays can be given
+    instead, with offsets=None.
+    fs: sampling rate
+
+    returns a DataFrame with one row per recording and the HRV_ columns of
+    nk.hrv_time and the Poincaré columns of nk.hrv_nonlinear. Recordings with
+    decreasing peaks, for which nk.hrv raises a ValueError, or with fewer
+    than three peaks give rows of nan.
+    """
+    if offsets is None:
+        peaks, offsets = flatten(peaks)
+    rri, rri_offsets, increasing = rr_intervals(peaks, offsets, fs)
+    out = time_domain(rri, rri_offsets)
+    valid = increasing & (np.diff(rri_offsets) >= 2)
+    table = {f'HRV_{k}': np.where(valid, v, np.nan) for k, v in out.items()}
+    return pd.DataFrame(table)
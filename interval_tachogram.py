@@ -5,8 +5,9 @@ from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
 import pandas as pd
-from utils import read_info, save_figs_as_pdf, make_peaks_file_name, subjects
+from utils import read_info, save_figs_as_pdf, subjects
 from tqdm import tqdm
+from peak_store import PeakStore
 
 results_path = Path(__file__).resolve().parent /  'results'
 info = read_info()
@@ -19,13 +20,13 @@ read_path = results_path / 'rr_detection'
 
 def plot_tachograms(setup):
     figs = []
+    store = PeakStore(setup, read_path)
     for s in tqdm(subjects, desc='Subject'):
         for experiment in tqdm(experiments, desc='Condition'):
             # Load annotated peaks
-            ann_file = read_path / make_peaks_file_name(s, setup, experiment, 'annotated')
             try:
-                annotated_peaks = np.load(ann_file)
-            except FileNotFoundError:
+                annotated_peaks = store.read(s, experiment, 'annotated')
+            except KeyError:
                 tqdm.write(f'Skip subject {s}, experiemnt {experiment}.')
                 continue
 
@@ -33,10 +34,9 @@ def plot_tachograms(setup):
             ann_tachogram = np.diff(annotated_peaks) / FS
 
             for method in tqdm(methods_names, desc='Method', leave=False):
-                det_file = read_path / make_peaks_file_name(s, setup, experiment, method)
                 try:
-                    detected_peaks = np.load(det_file)
-                except FileNotFoundError:
+                    detected_peaks = store.read(s, experiment, method)
+                except KeyError:
                     tqdm.write(f'skip subject {s}: {method}')
                     continue
                 det_tachogram = np.diff(detected_peaks) / FS
@@ -0,0 +1,343 @@
+"""
+Unified evaluation
+==================
+Evaluates a detector against the annotations in a single pass and returns
+the sensitivity analysis and the JF analysis together.
+The median delay is computed once and the inputs are sorted and
+deduplicated once; every annotation is then located once among the
+detections, which gives both the sensitivity windows and the JF pairs.
+evaluate_batch does the same for many (record, detector) pairs at once
+from flat arrays with offsets.
+"""
+from dataclasses import dataclass
+import numpy as np
+import pandas as pd
+from scipy import stats
+from . import util
+from . import jf_analysis
+
+
+@dataclass
+class Evaluation:
+    """
+    Metrics of one detection/annotation pair. Sensitivity and positive
+    predictivity are in %, jitter in s, delay in samples. The sensitivity
+    fields are None if no tolerance was given and the JF fields are None if
+    no sampling rate was given.
+    """
+    delay: int = None
+    sensitivity: float = None
+    ppv: float = None
+    tp: int = None
+    fp: int = None
+    fn: int = None
+    jitter: float = None
+    f1: float = None
+    jf: float = None
+    jf_tp: int = None
+    jf_fp: int = None
+    jf_fn: int = None
+
+    def jf_dict(self):
+        """Result in the format of jf_analysis.evaluate."""
+        return {jf_analysis.key_jitter: self.jitter,
+                jf_analysis.key_tp: self.jf_tp,
+                jf_analysis.key_fp: self.jf_fp,
+                jf_analysis.key_fn: self.jf_fn,
+                jf_analysis.key_f1: self.f1,
+                jf_analysis.key_jf: self.jf}
+
+    def sensitivity_tuple(self):
+        """Result in the format of sensitivity_analysis.evaluate."""
+        return (self.sensitivity, self.tp, self.fp, self.fn)
+
+
+def evaluate(detected_peaks, annotation, fs=None, tol=None, trim=True):
+    """
+    Evaluates the detected peaks against the annotated peaks.
+    detected_peaks: the timestamps of the detector in sample positions
+    annotation: the ground truth in samples
+    fs: sampling rate of the ECG file, needed for the JF analysis
+    tol: tolerance window in samples, needed for the sensitivity analysis
+    trim: trim the first and last beats for the JF analysis
+    returns an Evaluation. Without detections after the trimming the JF
+    analysis has no pairs: jf_tp and jf_fp are 0, f1 is 0 and jitter and jf
+    are nan, as in evaluate_batch (the loop version of jf_analysis raised a
+    ValueError there).
+    """
+    detected_peaks = np.asarray(detected_peaks)
+    annotation = np.asarray(annotation)
+    result = Evaluation()
+
+    # Both peak sets are sorted and deduplicated once. Duplicated detections
+    # only count through `counts`, and the first occurrence of a detection
+    # breaks the ties between two nearest detections, as util.nearest_pairs.
+    det, first_idx, counts = np.unique(detected_peaks, return_index=True,
+                                       return_counts=True)
+    anno = np.unique(annotation)
+
+    # Median delay of the detection against the annotations
+    _, delays = nearest(anno, np.arange(len(anno)), det, 0, len(anno))
+    result.delay = int(np.median(np.repeat(delays, counts)))
+
+    # Every annotation is located once among the delay corrected detections.
+    # A window [anno-tol+delay, anno+tol+delay] holds a detection when the
+    # nearest one is within tol.
+    det_posn = det - result.delay
+    pos = np.searchsorted(det_posn, anno)
+
+    if tol is not None:
+        _, dist = nearest(det_posn, first_idx, anno, 0, len(det), pos)
+        tp = int(np.count_nonzero(dist <= tol))
+        result.tp = tp
+        result.fp = len(det) - tp
+        result.fn = len(anno) - tp
+        result.sensitivity = False
+        result.ppv = False
+        if (tp + result.fn) > 0:
+            result.sensitivity = tp / (tp + result.fn) * 100.0
+        if (tp + result.fp) > 0:
+            result.ppv = tp / (tp + result.fp) * 100.0
+
+    if fs is not None:
+        evaluate_jf(result, det_posn, first_idx, counts, annotation, anno, pos,
+                    fs, trim)
+
+    return result
+
+
+def nearest(values, first_idx, queries, lo, hi, pos=None):
+    """
+    Nearest of the sorted unique `values[lo:hi]` to every query, on ties the
+    one with the smaller `first_idx`. pos: np.searchsorted(values, queries)
+    if already known.
+    returns the index in `values` and the distance of every query; no
+    queries if values[lo:hi] is empty.
+    """
+    if hi <= lo:
+        return np.array([], dtype=int), np.array([], dtype=values.dtype)
+    if pos is None:
+        pos = np.searchsorted(values, queries)
+    left = np.clip(pos - 1, lo, hi - 1)
+    right = np.clip(pos, lo, hi - 1)
+    d_left = np.abs(values[left] - queries)
+    d_right = np.abs(values[right] - queries)
+    take_right = (d_right < d_left) | ((d_right == d_left) &
+                                       (first_idx[right] < first_idx[left]))
+    return (np.where(take_right, right, left),
+            np.where(take_right, d_right, d_left))
+
+
+def evaluate_jf(result, det_posn, first_idx, counts, annotation, anno, pos,
+                fs, trim):
+    """
+    Fills the JF fields of `result`, see jf_analysis.evaluate, from the
+    matching pass of evaluate: det_posn, first_idx and counts are the
+    sorted unique delay corrected detections, anno the sorted unique
+    annotations and pos their positions in det_posn. No detections left
+    after trimming give no pairs rather than an error.
+    """
+    det_lo, det_hi = 0, len(det_posn)
+    anno_sel = slice(None)
+    n_anno = len(annotation)
+
+    # Trims 1st and last detections, as util.trim_after_detection. The kept
+    # detections and, for sorted annotations, the kept annotations are a
+    # range of the sorted arrays.
+    if trim == True:
+        a, b = jf_analysis.a, jf_analysis.b
+        det_start = int((annotation[a] + annotation[a-1]) / 2)
+        det_end = int((annotation[b] + annotation[b+1]) / 2)
+        det_lo = np.searchsorted(det_posn, det_start, side='left')
+        det_hi = np.searchsorted(det_posn, det_end, side='right')
+        trimmed = annotation[a:(b+1)]
+        n_anno = len(trimmed)
+        if len(trimmed) == 0:
+            anno_sel = slice(0, 0)
+        elif np.all(annotation[1:] >= annotation[:-1]):
+            anno_sel = slice(np.searchsorted(anno, trimmed[0], side='left'),
+                             np.searchsorted(anno, trimmed[-1], side='right'))
+        else:
+            anno_sel = np.isin(anno, trimmed)
+    n_det = int(counts[det_lo:det_hi].sum())
+
+    # Do we have enough detections?
+    if n_det <= 10:
+        warning = 'WARNING: Less than ten detections'
+        print(warning)
+
+    # Duplicated annotations choose the same detection at the same distance,
+    # so the unique annotations give the pairs of util.nearest_pairs. The
+    # nearest detection does not decrease along the sorted annotations, so
+    # the annotations sharing a detection are consecutive and only the
+    # closest of each run is kept.
+    det_idx, dist = nearest(det_posn, first_idx, anno[anno_sel], det_lo,
+                            det_hi, pos[anno_sel])
+    if len(det_idx):
+        starts = np.flatnonzero(np.r_[True, det_idx[1:] != det_idx[:-1]])
+        dist = np.minimum.reduceat(dist, starts)
+    differences_for_jitter = np.abs(dist / fs)
+
+    tp = len(differences_for_jitter)
+    result.jitter = stats.median_abs_deviation(differences_for_jitter)
+    result.jf_tp = tp
+    result.jf_fp = n_det - tp # all detections - true positive = false positive
+    result.jf_fn = n_anno - tp
+    if (tp + result.jf_fp + result.jf_fn) > 0:
+        result.f1 = (2*tp) / (2*tp + result.jf_fp + result.jf_fn)
+        result.jf = jf_analysis.score(result.jitter, result.f1)
+    else:
+        result.f1 = False
+        result.jf = False
+
+
+def evaluate_batch(detected, det_offsets, annotation, anno_offsets, fs, tol,
+                   det_record=None, labels=None, trim=True):
+    """
+    Evaluates many detections against many annotations in one vectorized
+    call. Peaks are passed as flat arrays with offsets (CSR style):
+    detection row i is detected[det_offsets[i]:det_offsets[i+1]] and
+    annotation row r is annotation[anno_offsets[r]:anno_offsets[r+1]].
+    util.flatten builds them from lists of arrays.
+
+    detected, det_offsets: detections, one row per (record, detector)
+    annotation, anno_offsets: ground truth, one row per record
+    fs: sampling rate
+    tol: tolerance window in samples for the sensitivity analysis
+    det_record: annotation row of each detection row. Defaults to one
+    detection row per annotation row.
+    labels: dict of columns with one value per detection row, e.g.
+    subject, experiment and method, copied into the result.
+    trim: trim the first and last beats for the JF analysis
+
+    returns a DataFrame with one row per detection row and the fields of
+    Evaluation as columns. Rows without detections, and JF fields of rows
+    with too few annotations to trim, are nan instead of raising.
+    """
+    detected = np.asarray(detected)
+    annotation = np.asarray(annotation)
+    det_offsets = np.asarray(det_offsets, dtype=np.int64)
+    anno_offsets = np.asarray(anno_offsets, dtype=np.int64)
+    n_rows = len(det_offsets) - 1
+    if det_record is None:
+        det_record = np.arange(n_rows)
+    det_record = np.asarray(det_record, dtype=np.int64)
+
+    # Annotations of the record of every detection row
+    anno_len = np.diff(anno_offsets)[det_record]
+    anno_row_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    anno_row_offsets[1:] = np.cumsum(anno_len)
+    gather = (np.repeat(anno_offsets[:-1][det_record] - anno_row_offsets[:-1],
+                        anno_len) + np.arange(anno_row_offsets[-1]))
+    anno = annotation[gather]
+
+    # Median delay of every row
+    delays = util.nearest_delays(detected, det_offsets, anno, anno_row_offsets)
+    delay = np.trunc(util.segment_median(delays, det_offsets))
+    valid = ~np.isnan(delay)
+    delay_int = np.where(valid, delay, 0).astype(np.int64)
+
+    table = {} if labels is None else {k: np.asarray(v) for k, v in labels.items()}
+    table['delay'] = delay
+    table.update(batch_sensitivity(detected, det_offsets, anno,
+                                   anno_row_offsets, tol, delay_int))
+    table.update(batch_jf(detected, det_offsets, anno, anno_row_offsets,
+                          fs, delay_int, trim))
+    if not valid.all():
+        for field in Evaluation.__dataclass_fields__:
+            table[field] = np.where(valid, table[field], np.nan)
+    return pd.DataFrame(table)
+
+
+def batch_sensitivity(detected, det_offsets, anno, anno_offsets, tol, delay):
+    """
+    Sensitivity fields of evaluate_batch. Annotation row i belongs to
+    detection row i.
+    """
+    det_u, det_u_offsets, _ = util.segment_unique(detected, det_offsets)
+    anno_u, anno_u_offsets, _ = util.segment_unique(anno, anno_offsets)
+    det_seg = util.segment_ids(det_u_offsets)
+    anno_seg = util.segment_ids(anno_u_offsets)
+
+    tp = np.zeros(len(delay), dtype=np.int64)
+    if len(det_u) and len(anno_u):
+        lo = min(det_u.min(), anno_u.min())
+        span = max(det_u.max(), anno_u.max()) - lo + 1
+        keys = util.segment_keys(det_u, det_seg, lo, span)
+        shift = delay[anno_seg]
+        first = det_u_offsets[:-1][anno_seg]
+        end = det_u_offsets[1:][anno_seg]
+        # Windows reaching into a neighbouring row are clipped to their own row
+        lower = np.clip(np.searchsorted(
+            keys, util.segment_keys(anno_u - tol + shift, anno_seg, lo, span),
+            side='left'), first, end)
+        upper = np.clip(np.searchsorted(
+            keys, util.segment_keys(anno_u + tol + shift, anno_seg, lo, span),
+            side='right'), first, end)
+        tp = np.bincount(anno_seg[upper > lower], minlength=len(delay))
+
+    fp = np.diff(det_u_offsets) - tp
+    fn = np.diff(anno_u_offsets) - tp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sensitivity = tp / (tp + fn) * 100.0
+        ppv = tp / (tp + fp) * 100.0
+    return {'sensitivity': sensitivity, 'ppv': ppv, 'tp': tp, 'fp': fp,
+            'fn': fn}
+
+
+def batch_jf(detected, det_offsets, anno, anno_offsets, fs, delay, trim):
+    """
+    JF fields of evaluate_batch. Annotation row i belongs to detection
+    row i.
+    """
+    n_rows = len(delay)
+    if len(anno) == 0:
+        # No row has annotations, so no row has a delay either
+        return {k: np.full(n_rows, np.nan) for k in
+                ('jitter', 'f1', 'jf', 'jf_tp', 'jf_fp', 'jf_fn')}
+    det_seg = util.segment_ids(det_offsets)
+    det_posn = detected - delay[det_seg]
+    anno_seg = util.segment_ids(anno_offsets)
+    n_anno = np.diff(anno_offsets)
+    ok = np.ones(n_rows, dtype=bool)
+
+    if trim:
+        # Vectorized util.trim_after_detection with jf_analysis.a and b
+        a, b = jf_analysis.a, jf_analysis.b
+        ok = n_anno > a
+        start = anno_offsets[:-1]
+        idx = lambda i: anno[np.clip(i, start, anno_offsets[1:] - 1)]
+        det_start = np.trunc((idx(start + a) + idx(start + a - 1)) / 2)
+        det_end = np.trunc((idx(start + n_anno + b) + idx(start + n_anno + b + 1)) / 2)
+        keep = ((det_posn >= det_start[det_seg]) &
+                (det_posn <= det_end[det_seg]) & ok[det_seg])
+        det_posn, det_seg = det_posn[keep], det_seg[keep]
+        local = np.arange(len(anno)) - start[anno_seg]
+        keep = (local >= a) & (local < n_anno[anno_seg] + b + 1) & ok[anno_seg]
+        anno, anno_seg = anno[keep], anno_seg[keep]
+
+    det_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    det_offsets[1:] = np.cumsum(np.bincount(det_seg, minlength=n_rows))
+    anno_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    anno_offsets[1:] = np.cumsum(np.bincount(anno_seg, minlength=n_rows))
+    anno_idx, _, dist = util.segment_nearest_pairs(anno, anno_offsets,
+                                                   det_posn, det_offsets)
+    pair_seg = anno_seg[anno_idx]
+    pair_offsets = np.zeros(n_rows + 1, dtype=np.int64)
+    pair_offsets[1:] = np.cumsum(np.bincount(pair_seg, minlength=n_rows))
+
+    # Median absolute deviation of the distances of every row
+    diffs = np.abs(dist / fs)
+    median = util.segment_median(diffs, pair_offsets)
+    jitter = util.segment_median(np.abs(diffs - median[pair_seg]), pair_offsets)
+
+    tp = np.diff(pair_offsets)
+    fp = np.diff(det_offsets) - tp
+    fn = np.diff(anno_offsets) - tp
+    with np.errstate(invalid='ignore', divide='ignore'):
+        f1 = (2*tp) / (2*tp + fp + fn)
+    jf = jf_analysis.score(jitter, f1)
+
+    fields = {'jitter': jitter, 'f1': f1, 'jf': jf, 'jf_tp': tp,
+              'jf_fp': fp, 'jf_fn': fn}
+    return {k: np.where(ok, v, np.nan) for k, v in fields.items()}
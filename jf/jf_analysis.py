@@ -11,7 +11,6 @@ The overall score is then: jf = Jitter/% * F1/%.
 """
 import numpy as np
 from . import util
-from scipy import stats
 
 # The jitter which gives a 50% performance. That's a 1/4 of the average
 # RMSSD which is 40ms.
@@ -29,6 +28,17 @@ key_fp = "FP" # False positives
 key_fn = "FN" # False negatives
 
 def nearest_diff(annotation, nearest_match):
+    """
+    Calculates the nearest difference between values in two arrays, keeping
+    a single annotation per matched detection (the one with the shortest
+    time difference). Uses the sorted matcher in util.nearest_pairs.
+    """
+    _, _, unique_diffs = util.nearest_pairs(annotation, nearest_match)
+    return unique_diffs
+
+
+def nearest_diff_loop(annotation, nearest_match):
+    # Reference O(N^2) version of nearest_diff, kept for parity checks.
     # Calculates the nearest difference between values in two arrays and saves
     # index and sample position of nearest
 
@@ -84,52 +94,6 @@ def evaluate(det_posn, anno_R, fs, nSamples, trim=True):
     jf[key_jf]       : JF Score
     """
 
-    # Median delay of the detection against the annotations
-    delay_correction = util.calcMedianDelay(det_posn, anno_R)
-
-    # Correction for detector delay
-    det_posn = np.array(det_posn)-int(delay_correction)
-
-    # Trims 1st and last detections
-    if trim==True:
-        det_posn, anno_R = util.trim_after_detection(det_posn, anno_R, a, b)
-
-    # Do we have enough detections?
-    if len(det_posn)<=10:
-        warning='WARNING: Less than ten detections'
-        print(warning)
-
-    # Number of annotated R peaks
-    len_anno_R = len(anno_R)
-
-    # Number of detected R peaks
-    len_det_posn = len(det_posn)
-
-    # return anno / detector pairs
-    anno_det_pairs = nearest_diff(anno_R, det_posn)
-
-    differences_for_jitter=[]
-
-    for d in anno_det_pairs:
-
-        difference = np.abs(d / fs)
-        differences_for_jitter.append(difference)
-
-    jf = {}
-
-    jf[key_jitter] = stats.median_abs_deviation(differences_for_jitter)
-    fp = len_det_posn - len(differences_for_jitter) # all detections - true positive = false positive
-    fn = len_anno_R - len(differences_for_jitter) # all detections
-    tp = len(differences_for_jitter)
-    jf[key_tp] = tp
-    jf[key_fp] = fp
-    jf[key_fn] = fn
-    if (tp + fp + fn) > 0:
-        f1 = (2*tp)/(2*tp + fp + fn)
-        jf[key_f1] = f1
-        jf[key_jf] = score(jf[key_jitter],f1)
-    else:
-        jf[key_f1] = False
-        jf[key_jf] = False
-
-    return jf
+    # Single pass evaluation shared with the sensitivity analysis
+    from .evaluation import evaluate as evaluate_all
+    return evaluate_all(det_posn, anno_R, fs=fs, trim=trim).jf_dict()
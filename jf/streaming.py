@@ -0,0 +1,325 @@
+"""
+Streaming evaluation
+====================
+Evaluates a detector while it runs on streaming ECG. Detections and
+annotations are added in chunks, peaks are matched online and the running
+TP/FP/FN, jitter and JF can be read at any moment. Only the beats that can
+still change a result are buffered, a few beats while the two streams keep
+up with each other, so the memory stays constant whatever the length of the
+recording.
+
+The results after finish() are those of evaluation.evaluate on the whole
+recording, except for the delay of the detector: it is the median delay of
+the detections up to the first JF annotation (jf_analysis.a), the beats that
+the JF analysis trims anyway, instead of the median over the whole
+recording. The jitter is exact: the distances are integer samples, so their
+median absolute deviation comes from a histogram whose size only depends on
+the largest distance.
+"""
+from collections import Counter, deque
+import numpy as np
+from . import jf_analysis
+from .evaluation import Evaluation
+
+
+def histogram_median(values, counts):
+    """Median of `values` repeated `counts` times, as np.median."""
+    order = np.argsort(values)
+    values = np.asarray(values, dtype=float)[order]
+    cumulative = np.cumsum(np.asarray(counts)[order])
+    n = cumulative[-1]
+    lo = values[np.searchsorted(cumulative, (n - 1) // 2, side='right')]
+    hi = values[np.searchsorted(cumulative, n // 2, side='right')]
+    return (lo + hi) / 2
+
+
+def histogram_mad(histogram):
+    """Median absolute deviation of the values counted in a Counter."""
+    if not histogram:
+        return np.nan
+    values = np.array(list(histogram.keys()), dtype=float)
+    counts = np.array(list(histogram.values()))
+    median = histogram_median(values, counts)
+    return histogram_median(np.abs(values - median), counts)
+
+
+class StreamingEvaluator:
+    """
+    Incremental version of evaluation.evaluate for one (record, detector).
+
+    fs: sampling rate, for the JF analysis
+    tol: tolerance window in samples for the sensitivity analysis, None to
+    skip it
+    trim: trim the first jf_analysis.a and the last annotated beats for the
+    JF analysis, as util.trim_after_detection
+
+    Both streams must be sorted. add() takes the next chunks of detections
+    and annotations in samples; `until` tells that no detection or
+    annotation before that sample is still to come, which lets beats be
+    matched while the detector finds nothing. result() gives the
+    Evaluation of the beats matched so far; finish() matches the rest and
+    gives the final Evaluation.
+    """
+
+    def __init__(self, fs, tol=None, trim=True):
+        self.fs = fs
+        self.tol = tol
+        self.trim = trim
+        self.warmup = jf_analysis.a
+        self.hold = -jf_analysis.b - 1 if trim else 0  # beats trimmed at the end
+        self.delay = None
+        self.warm_det = []
+        self.warm_anno = []
+        self.last_det = None
+        self.last_anno = None
+        self.det_known = -np.inf
+        self.finished = False
+
+        # Sensitivity analysis: unique peaks waiting for their windows
+        self.s_det = deque()
+        self.s_anno = deque()
+        self.s_last_det = None
+        self.s_last_anno = None
+        self.s_tp = 0
+        self.s_n_det = 0
+        self.s_n_anno = 0
+
+        # JF analysis: delay-corrected [value, multiplicity] detections and
+        # (index, value) annotations still to match
+        self.n_anno = 0
+        self.recent = deque(maxlen=self.hold + 1)
+        self.det_start = -np.inf
+        self.j_det = deque()
+        self.j_anno = deque()
+        self.j_n_det = 0
+        self.j_n_anno = 0
+        self.j_tp = 0
+        self.group = None  # [detection, shortest distance] of the last match
+        self.distances = Counter()
+
+    def add(self, detections=(), annotations=(), until=None):
+        """Adds the next detections and annotations, in samples."""
+        if self.finished:
+            raise ValueError('The evaluation is finished')
+        detections = np.asarray(detections, dtype=np.int64)
+        annotations = np.asarray(annotations, dtype=np.int64)
+        self.last_det = self.check_sorted(detections, self.last_det)
+        self.last_anno = self.check_sorted(annotations, self.last_anno)
+        if self.last_det is not None:
+            self.det_known = max(self.det_known, self.last_det)
+        if until is not None:
+            self.det_known = max(self.det_known, until)
+
+        if self.delay is None:
+            self.warm_det.extend(detections.tolist())
+            self.warm_anno.extend(annotations.tolist())
+            if not self.end_warmup(end=False):
+                return
+        else:
+            self.push(detections.tolist(), annotations.tolist())
+        self.resolve(end=False)
+
+    @staticmethod
+    def check_sorted(values, last):
+        if len(values) == 0:
+            return last
+        if np.any(np.diff(values) < 0) or (last is not None and values[0] < last):
+            raise ValueError('Peaks must be added in increasing order')
+        return int(values[-1])
+
+    def end_warmup(self, end):
+        """
+        Sets the delay once the detections up to the first JF annotation
+        are known, then passes the buffered peaks on.
+        """
+        if not end and (len(self.warm_anno) <= self.warmup or
+                        self.det_known <= self.warm_anno[self.warmup]):
+            return False
+        det = np.array(self.warm_det, dtype=np.int64)
+        anno = np.array(self.warm_anno, dtype=np.int64)
+        if len(anno) > self.warmup:
+            det_warm = det[det <= anno[self.warmup]]
+        else:
+            det_warm = det
+        self.delay = 0
+        if len(det_warm) and len(anno):
+            pos = np.clip(np.searchsorted(anno, det_warm), 1, max(len(anno) - 1, 1))
+            nearest = np.minimum(np.abs(det_warm - anno[pos - 1]),
+                                 np.abs(det_warm - anno[np.minimum(pos, len(anno) - 1)]))
+            self.delay = int(np.median(nearest))
+        self.push(self.warm_det, self.warm_anno)
+        self.warm_det, self.warm_anno = None, None
+        return True
+
+    def push(self, detections, annotations):
+        for d in detections:
+            if self.s_last_det != d:
+                self.s_det.append(d)
+                self.s_n_det += 1
+                self.s_last_det = d
+        for a in annotations:
+            if self.s_last_anno != a:
+                self.s_anno.append(a)
+                self.s_n_anno += 1
+                self.s_last_anno = a
+
+        for a in annotations:
+            i = self.n_anno
+            self.n_anno += 1
+            self.recent.append(a)
+            if not self.trim or i >= self.warmup:
+                self.j_anno.append((i, a))
+            if self.trim and i == self.warmup:
+                self.det_start = int((a + self.recent[-2]) / 2)
+        for d in detections:
+            d -= self.delay
+            if d < self.det_start:
+                continue
+            if self.j_det and self.j_det[-1][0] == d:
+                self.j_det[-1][1] += 1
+            else:
+                self.j_det.append([d, 1])
+
+    def resolve(self, end):
+        """Matches every beat whose match cannot change any more."""
+        if self.tol is not None:
+            self.resolve_sensitivity(end)
+        self.resolve_jf(end)
+
+    def resolve_sensitivity(self, end):
+        # An annotation is a TP if a detection is in its shifted window
+        while self.s_anno:
+            u = self.s_anno[0]
+            lo = u - self.tol + self.delay
+            hi = u + self.tol + self.delay
+            if not end and self.det_known < hi:
+                break
+            self.s_anno.popleft()
+            while self.s_det and self.s_det[0] < lo:
+                self.s_det.popleft()
+            if self.s_det and self.s_det[0] <= hi:
+                self.s_tp += 1
+        # Later annotations only have later windows
+        if self.s_last_anno is not None:
+            lo = (self.s_anno[0] if self.s_anno else self.s_last_anno) - self.tol + self.delay
+            while self.s_det and self.s_det[0] < lo:
+                self.s_det.popleft()
+
+    def release_detection(self):
+        self.j_n_det += self.j_det.popleft()[1]
+
+    def kept_until(self, end):
+        """
+        Detections up to this one survive the final trim of the last beats,
+        whatever the number of annotations still to come.
+        """
+        if end or not self.trim:
+            return np.inf
+        if len(self.recent) <= self.hold:
+            return -np.inf
+        return int((self.recent[0] + self.recent[1]) / 2)
+
+    def resolve_jf(self, end):
+        det_known = self.det_known - self.delay
+        kept = self.kept_until(end)
+        while self.j_anno:
+            i, a = self.j_anno[0]
+            if not end and self.n_anno - 1 - i < self.hold:
+                break  # could be one of the trimmed last beats
+            # Detections before the nearest one to a are not nearest to
+            # any later annotation either
+            while len(self.j_det) > 1 and self.j_det[1][0] <= a:
+                self.release_detection()
+            if not self.j_det:
+                if not end:
+                    break
+                nearest = None
+            elif self.j_det[0][0] > a:
+                nearest = self.j_det[0][0]
+            elif len(self.j_det) > 1:
+                pred, succ = self.j_det[0][0], self.j_det[1][0]
+                nearest = pred if a - pred <= succ - a else succ
+            elif end or det_known > 2 * a - self.j_det[0][0]:
+                nearest = self.j_det[0][0]  # no closer detection can come
+            else:
+                break
+            if nearest is not None and nearest > kept:
+                break  # the detection could still be trimmed
+            self.j_anno.popleft()
+            self.j_n_anno += 1
+            if nearest is not None:
+                self.match(nearest, abs(nearest - a))
+
+        if not self.j_anno and self.last_anno is not None:
+            # Only detections from the one nearest to the last annotation on
+            # can still be matched
+            while (len(self.j_det) > 1 and
+                   self.j_det[1][0] <= min(self.last_anno, kept)):
+                self.release_detection()
+
+    def match(self, detection, distance):
+        """Keeps the closest annotation of every detection."""
+        if self.group is not None and self.group[0] == detection:
+            self.group[1] = min(self.group[1], distance)
+            return
+        self.close_group()
+        self.group = [detection, distance]
+
+    def close_group(self):
+        if self.group is not None:
+            self.j_tp += 1
+            self.distances[self.group[1]] += 1
+            self.group = None
+
+    def finish(self):
+        """Matches the remaining beats and returns the final Evaluation."""
+        if not self.finished:
+            if self.delay is None:
+                self.end_warmup(end=True)
+            if self.trim:
+                # The last beats are trimmed, as util.trim_after_detection
+                last = self.n_anno + jf_analysis.b
+                while self.j_anno and self.j_anno[-1][0] > last:
+                    self.j_anno.pop()
+                if len(self.recent) == self.hold + 1:
+                    det_end = int((self.recent[0] + self.recent[1]) / 2)
+                    while self.j_det and self.j_det[-1][0] > det_end:
+                        self.j_det.pop()
+            self.resolve(end=True)
+            while self.j_det:
+                self.release_detection()
+            self.close_group()
+            self.finished = True
+        return self.result()
+
+    def result(self):
+        """Evaluation of the beats matched so far."""
+        result = Evaluation(delay=self.delay)
+        if self.tol is not None:
+            tp = self.s_tp
+            n_det = self.s_n_det - len(self.s_det)
+            n_anno = self.s_n_anno - len(self.s_anno)
+            if self.finished:
+                n_det = self.s_n_det
+            result.tp, result.fp, result.fn = tp, n_det - tp, n_anno - tp
+            result.sensitivity = tp / (tp + result.fn) * 100.0 if tp + result.fn > 0 else False
+            result.ppv = tp / (tp + result.fp) * 100.0 if tp + result.fp > 0 else False
+
+        distances = self.distances.copy()
+        tp = self.j_tp
+        if self.group is not None:
+            distances[self.group[1]] += 1
+            tp += 1
+        if self.trim and self.finished and self.n_anno <= self.warmup:
+            return result  # too few annotations to trim
+        result.jitter = histogram_mad({d / self.fs: c for d, c in distances.items()})
+        result.jf_tp = tp
+        result.jf_fp = self.j_n_det - tp
+        result.jf_fn = self.j_n_anno - tp
+        if tp + result.jf_fp + result.jf_fn > 0:
+            result.f1 = (2*tp) / (2*tp + result.jf_fp + result.jf_fn)
+            result.jf = jf_analysis.score(result.jitter, result.f1)
+        else:
+            result.f1 = False
+            result.jf = False
+        return result
@@ -8,17 +8,141 @@ introduce.
 """
 def calcMedianDelay(detected_peaks, anno):
 
-    r_peaks = []
+    return median_delay(detected_peaks, anno)
 
-    for i in detected_peaks:
-        d = np.abs(i-anno)
-        ii = np.argmin(d)
-        r_peaks.append(d[ii])
 
-    m = int(np.median(r_peaks))
+def median_delay(detected_peaks, anno, return_delays=False):
+    """
+    Median distance between each detection and its nearest annotation.
+
+    detected_peaks, anno: peaks of one recording, or lists with the peaks
+    of a batch of recordings (one array per recording).
+    return_delays: also return the distance of every detection.
+
+    For one recording the median is returned as int, like calcMedianDelay.
+    For a batch an array with one truncated median per recording is
+    returned (nan where a recording has no detections or annotations) and
+    the delays are returned as a list of arrays.
+    """
+    if is_batch(detected_peaks):
+        det, det_offsets = flatten(detected_peaks)
+        ann, anno_offsets = flatten(anno)
+        delays = nearest_delays(det, det_offsets, ann, anno_offsets)
+        medians = np.trunc(segment_median(delays, det_offsets))
+        if return_delays:
+            return medians, np.split(delays, det_offsets[1:-1])
+        return medians
+
+    det = np.asarray(detected_peaks)
+    ann = np.asarray(anno)
+    delays = nearest_delays(det, np.array([0, len(det)]),
+                            ann, np.array([0, len(ann)]))
+    m = int(np.median(delays))
+    if return_delays:
+        return m, delays
     return m
 
 
+def is_batch(peaks):
+    """
+    True if `peaks` is a sequence of per-recording peak arrays rather than
+    the peaks of a single recording.
+    """
+    return (isinstance(peaks, (list, tuple)) and len(peaks) > 0 and
+            np.ndim(peaks[0]) > 0)
+
+
+def flatten(peaks):
+    """
+    Concatenates a list of ragged peak arrays into one flat array plus an
+    offsets array, so that recording r is values[offsets[r]:offsets[r+1]].
+    """
+    lengths = [len(p) for p in peaks]
+    offsets = np.zeros(len(peaks) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    if offsets[-1] == 0:
+        return np.array([], dtype=np.int64), offsets
+    return np.concatenate([np.asarray(p) for p in peaks]), offsets
+
+
+def segment_ids(offsets):
+    """Recording index of every element of a flat array given its offsets."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def segment_keys(values, seg, lo, span):
+    """
+    Maps values of recording `seg` to seg*span + (value - lo), so that one
+    sorted array holds all recordings one after the other.
+    """
+    return seg * span + (values - lo)
+
+
+def segment_argsort(values, seg):
+    """
+    Indices that sort `values` within each recording, keeping recordings in
+    order and equal values in their original order. Two stable argsorts are
+    much faster than np.lexsort on large arrays.
+    """
+    if np.all((values[1:] >= values[:-1]) | (seg[1:] != seg[:-1])):
+        # Peaks usually come sorted already
+        return np.arange(len(values))
+    order = np.argsort(values, kind='stable')
+    return order[np.argsort(seg[order], kind='stable')]
+
+
+def segment_median(values, offsets):
+    """
+    Median of each recording of a flat array. Empty recordings give nan.
+    """
+    values = np.asarray(values, dtype=float)
+    n = np.diff(offsets)
+    seg = segment_ids(offsets)
+    s = values[segment_argsort(values, seg)]
+    medians = np.full(len(n), np.nan)
+    ok = n > 0
+    lo = offsets[:-1][ok] + (n[ok] - 1) // 2
+    hi = offsets[:-1][ok] + n[ok] // 2
+    medians[ok] = (s[lo] + s[hi]) / 2
+    return medians
+
+
+def nearest_delays(detected, det_offsets, anno, anno_offsets):
+    """
+    Distance in samples from every detection to its nearest annotation in
+    the same recording, for flat ragged arrays with offsets.
+
+    Each recording's annotations are sorted once and every detection is
+    located with one searchsorted call over all recordings, which is
+    O((N+M) log M) instead of O(N*M). Detections of recordings without
+    annotations get nan.
+    """
+    detected = np.asarray(detected)
+    anno = np.asarray(anno)
+    det_seg = segment_ids(det_offsets)
+    anno_seg = segment_ids(anno_offsets)
+    delays = np.full(len(detected), np.nan)
+    if len(detected) == 0 or len(anno) == 0:
+        return delays
+
+    lo = min(detected.min(), anno.min())
+    span = max(detected.max(), anno.max()) - lo + 1
+    anno_sorted = anno[segment_argsort(anno, anno_seg)]
+    keys = segment_keys(anno_sorted, anno_seg, lo, span)
+    pos = np.searchsorted(keys, segment_keys(detected, det_seg, lo, span))
+
+    # Restrict the two neighbours to the annotations of the same recording
+    first = anno_offsets[:-1][det_seg]
+    last = anno_offsets[1:][det_seg] - 1
+    has_anno = last >= first
+    left = np.clip(pos - 1, first, last)[has_anno]
+    right = np.clip(pos, first, last)[has_anno]
+    det = detected[has_anno]
+    delays[has_anno] = np.minimum(np.abs(det - anno_sorted[left]),
+                                  np.abs(det - anno_sorted[right]))
+    return delays
+
+
 def trim_after_detection(detections, annotations, start_index, end_index):
 
     # start_index = annotated index to start at after trimming
@@ -30,3 +154,96 @@ def trim_after_detection(detections, annotations, start_index, end_index):
     detections_trimmed = detections[ (detections >= det_start_posn) & (detections <= det_end_posn) ] # remove detections with positions outwith range
     
     return detections_trimmed, annotations_trimmed
+
+
+def nearest_pairs(annotation, detections):
+    """
+    Pairs every annotation with its nearest detection using sorted arrays.
+
+    For each annotation the nearest detection is found with a binary search
+    (ties go to the detection that comes first in `detections`, as argmin
+    does). When several annotations share the same nearest detection only the
+    one with the smallest distance is kept, so each detection is used at most
+    once. Runs in O((N+M) log M) instead of the O(N*M) scan.
+
+    returns:
+    anno_idx : index into `annotation` of each unique pair
+    det_idx  : index into `detections` of each unique pair
+    dist     : absolute distance in samples of each unique pair
+    The pairs are ordered by the first annotation that chose each detection.
+    """
+    annotation = np.asarray(annotation)
+    detections = np.asarray(detections)
+    return segment_nearest_pairs(annotation, np.array([0, len(annotation)]),
+                                 detections, np.array([0, len(detections)]))
+
+
+def segment_unique(values, offsets):
+    """
+    Sorted unique values of each recording of a flat array.
+
+    returns the unique values, their offsets and the index in `values` of
+    the first occurrence of each unique value.
+    """
+    values = np.asarray(values)
+    seg = segment_ids(offsets)
+    order = segment_argsort(values, seg)
+    v = values[order]
+    s = seg[order]
+    keep = np.r_[True, (v[1:] != v[:-1]) | (s[1:] != s[:-1])][:len(v)]
+    counts = np.bincount(s[keep], minlength=len(offsets) - 1)
+    unique_offsets = np.zeros(len(offsets), dtype=np.int64)
+    unique_offsets[1:] = np.cumsum(counts)
+    return v[keep], unique_offsets, order[keep]
+
+
+def segment_nearest_pairs(annotation, anno_offsets, detections, det_offsets):
+    """
+    nearest_pairs for flat ragged arrays with offsets: every annotation is
+    only paired with detections of the same recording.
+
+    returns flat anno_idx, det_idx and dist as nearest_pairs, grouped by
+    recording. Use segment_ids(anno_offsets)[anno_idx] for the recording of
+    each pair.
+    """
+    annotation = np.asarray(annotation)
+    detections = np.asarray(detections)
+    empty = np.array([], dtype=int)
+    if len(annotation) == 0 or len(detections) == 0:
+        return empty, empty, np.array([], dtype=np.result_type(annotation, detections))
+
+    # Unique detection values keep the index of their first occurrence, which
+    # is the one np.argmin would return among equal values.
+    values, value_offsets, first_idx = segment_unique(detections, det_offsets)
+    value_seg = segment_ids(value_offsets)
+    anno_seg = segment_ids(anno_offsets)
+    lo = min(values.min(), annotation.min())
+    span = max(values.max(), annotation.max()) - lo + 1
+    pos = np.searchsorted(segment_keys(values, value_seg, lo, span),
+                          segment_keys(annotation, anno_seg, lo, span))
+
+    # Restrict the two neighbours to the detections of the same recording
+    first = value_offsets[:-1][anno_seg]
+    last = value_offsets[1:][anno_seg] - 1
+    has_det = last >= first
+    anno_idx = np.flatnonzero(has_det)
+    if len(anno_idx) == 0:
+        return empty, empty, np.array([], dtype=np.result_type(annotation, detections))
+    anno = annotation[anno_idx]
+    left = np.clip(pos - 1, first, last)[anno_idx]
+    right = np.clip(pos, first, last)[anno_idx]
+    d_left = np.abs(values[left] - anno)
+    d_right = np.abs(values[right] - anno)
+    take_right = (d_right < d_left) | ((d_right == d_left) &
+                                       (first_idx[right] < first_idx[left]))
+    nearest = np.where(take_right, right, left)
+    dist = np.where(take_right, d_right, d_left)
+
+    # Keep the closest annotation per detection (earliest on ties)
+    order = np.lexsort((anno_idx, dist, nearest))
+    starts = np.flatnonzero(np.r_[True, nearest[order][1:] != nearest[order][:-1]])
+    best = order[starts]
+    first_seen = np.minimum.reduceat(anno_idx[order], starts)
+    best = best[np.lexsort((first_seen, anno_seg[anno_idx[best]]))]
+
+    return anno_idx[best], first_idx[nearest[best]], dist[best]
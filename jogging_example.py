@@ -3,7 +3,7 @@ Plots an example of the ECGs for Einthoven and the Chest Strap setup to
 demonstrate the difference of noise level between the setups.
 """
 from pathlib import Path
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 import matplotlib.pyplot as plt
 from ecgdetectors import Detectors
 from tqdm import tqdm
@@ -12,7 +12,7 @@ save_path = Path(__file__).resolve().parent / 'results'
 FS = 250
 subject = 9
 experiment = 'jogging'
-ecg = GUDb(subject, experiment) #
+ecg = CachedGUDb(subject, experiment) #
 annotated_peaks = ecg.anno_cables
 time = ecg.t
 
@@ -2,6 +2,7 @@ import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from paired_hrv import PairedHRV
 from utils import save_figs_as_pdf
 
 # Map the name of the method to the name used in the paper
@@ -14,58 +15,57 @@ method_to_name = {'Elgendi_et_al': 'two_average',
                   'WQRS': 'wqrs'}
 
 
-def get_data_method(df, method, metric):
-    dfr = df[(df['method'] == method) | (df['method']=='Annotated')]
-    # Only keep the metric at hand
-    drop_cols = [m for m in metrics if m != metric]
-    dfr = dfr.drop(columns=drop_cols)
-    dfr['annotated'] = np.nan
-
-    for idx in dfr['subject_idx'].unique():
-        for experiment in experiments:
-            try:
-                annotated = dfr[(dfr['subject_idx']==idx) &
-                                (dfr['method'] == 'Annotated') &
-                                (dfr['experiment'] == experiment)][metric].iloc[0]
-            except IndexError:
-                print(f'Subject {idx}, Annotated, experiment {experiment}, metric {metric} is missing')
-            else:
-                dfr.loc[(dfr['subject_idx']==idx) &
-                         (dfr['method'] == method) &
-                         (dfr['experiment'] == experiment), ['annotated']] = annotated
+def paired_data(df, reference=None):
+    """
+    PairedHRV of a table of HRV results, with the annotated values of
+    `reference` (e.g. reference_hrv.ReferenceMemo.table) when given.
+    """
+    pairs = PairedHRV(df, metrics, reference)
+    for idx, experiment in pairs.missing.itertuples(index=False):
+        print(f'Subject {idx}, Annotated, experiment {experiment} is missing')
+    return pairs
+
 
-    # We don't need the annotated rows anymore
-    dfr = dfr[dfr['method']!='Annotated']
-    return dfr
+def ccc_lookup(df_ccc):
+    """CCC of every (method, metric, experiment) of a CCC table."""
+    keys = zip(df_ccc['method'], df_ccc['metric'], df_ccc['experiment'])
+    return dict(zip(keys, df_ccc['ccc']))
 
 
-def plot_regression(df, df_ccc, metric, method, ax=None, skip_exp=[], lfontsize='medium'):
+def plot_regression(pairs, ccc, metric, method, ax=None, skip_exp=[],
+                    lfontsize='medium'):
+    """
+    pairs: PairedHRV of the setup (see paired_data)
+    ccc: CCC table of the setup or its ccc_lookup
+    """
     if ax is None:
         fig, ax = plt.subplots(layout='constrained')
-    dfr = get_data_method(df, method, metric)
-    df_ccc = df_ccc.query('method == @method and metric == @metric')
+    if isinstance(ccc, pd.DataFrame):
+        ccc = ccc_lookup(ccc)
     for experiment in experiments:
         if experiment in skip_exp: continue
-        ccc = df_ccc.query('experiment == @experiment')['ccc'].iloc[0]
-        ccc =  (int(ccc*100) % 100) / 100 # Get two decimal point without rounding
-        data = dfr[dfr['experiment']==experiment]
-        label = f'{experiment} ({ccc:.2f})'
-        sns.regplot(data=data, x='annotated', y=metric, ci=None, ax=ax,
+        value = ccc[method, metric, experiment]
+        value = (int(value*100) % 100) / 100 # Get two decimal point without rounding
+        data = pairs.pairs(method, metric, experiment)
+        label = f'{experiment} ({value:.2f})'
+        sns.regplot(data=data, x='annotated', y='detected', ci=None, ax=ax,
                     label=label, scatter_kws={"s": 10})
 
-    x = [dfr['annotated'].min(), dfr['annotated'].max()]
+    annotated = pairs.annotated[pairs.rows(method), pairs.column[metric]]
+    x = [np.nanmin(annotated), np.nanmax(annotated)]
     ax.plot(x, x, linestyle=':')
+    ax.set_ylabel(metric)
     ax.set_title(method_to_name[method])
     ax.legend(loc='best', fontsize=lfontsize)
     return ax
 
 
-def plot_regressions(df, df_ccc, metric, skip_exp=[]):
+def plot_regressions(pairs, ccc, metric, skip_exp=[]):
     rows, cols = 2, 4
     fig, axs = plt.subplots(rows, cols, layout='constrained', figsize=(19.2, 9.8))
 
     for method, ax in zip(methods, axs.flat):
-        plot_regression(df, df_ccc, metric, method, ax, skip_exp)
+        plot_regression(pairs, ccc, metric, method, ax, skip_exp)
 
     for i in range(rows):
         for j in range(cols):
@@ -81,11 +81,13 @@ def plot_regressions(df, df_ccc, metric, skip_exp=[]):
     return fig
 
 
-def plot_setup_regressions(df, df_ccc, fn, skip_exp=[]):
+def plot_setup_regressions(df, df_ccc, fn, skip_exp=[], reference=None):
+    pairs = paired_data(df, reference)
+    ccc = ccc_lookup(df_ccc)
     figs = []
     for metric in metrics:
         print('Plotting ', metric)
-        fig = plot_regressions(df, df_ccc, metric, skip_exp)
+        fig = plot_regressions(pairs, ccc, metric, skip_exp)
         figs.append(fig)
         plt.close(fig)
 
@@ -97,7 +99,7 @@ def plot_all_regressions():
     plt.close('all')
 
     df = pd.read_csv('datahrv/chest_strap_setup_subset_HRV_notEngzee.csv')
-    df = df.drop(columns=['index'] + ['HRV_SDRMSSD.1']) # data cleaning
+    df = df.drop(columns=['index'] + ['HRV_SDRMSSD.1'], errors='ignore') # data cleaning
     df_ccc = pd.read_csv('datahrv/ccc_chest_strap_df.csv')
     plot_setup_regressions(df, df_ccc, 'figures/regressions_chest_strap.pdf')
 
@@ -109,8 +111,10 @@ def plot_all_regressions():
 def plot_paper_regression_one_fig():
     plt.close('all')
     df = pd.read_csv('datahrv/chest_strap_setup_subset_HRV_notEngzee.csv')
-    df = df.drop(columns=['index'] + ['HRV_SDRMSSD.1']) # data cleaning
+    df = df.drop(columns=['index'] + ['HRV_SDRMSSD.1'], errors='ignore') # data cleaning
     df_ccc = pd.read_csv('datahrv/ccc_chest_strap_df.csv')
+    pairs = paired_data(df)
+    ccc = ccc_lookup(df_ccc)
     rows, cols = 3, 7
     _, axs = plt.subplots(rows, cols, layout='constrained', figsize=(24, 8))
     metrics = ['HRV_MeanNN', 'HRV_TINN', 'HRV_LFHF']
@@ -119,7 +123,8 @@ def plot_paper_regression_one_fig():
 
     for i, metric in enumerate(metrics):
         for method, ax in zip(methods, axs[i,:].flat):
-            plot_regression(df, df_ccc, metric, method, ax, lfontsize='xx-small')
+            plot_regression(pairs, ccc, metric, method, ax,
+                            lfontsize='xx-small')
         for j in range(cols):
             axs[i,j].set_ylabel(metric.split('_')[1])
             axs[i,j].set_xlabel('annotated ' + metric.split('_')[1])
@@ -132,15 +137,17 @@ def plot_paper_regression_one_fig():
 def plot_paper_regression():
     plt.close('all')
     df = pd.read_csv('datahrv/chest_strap_setup_subset_HRV_notEngzee.csv')
-    df = df.drop(columns=['index'] + ['HRV_SDRMSSD.1']) # data cleaning
+    df = df.drop(columns=['index'] + ['HRV_SDRMSSD.1'], errors='ignore') # data cleaning
     df_ccc = pd.read_csv('datahrv/ccc_chest_strap_df.csv')
+    pairs = paired_data(df)
+    ccc = ccc_lookup(df_ccc)
     rows, cols = 2, 4
     metrics = ['HRV_MeanNN', 'HRV_TINN', 'HRV_LFHF']
 
     for metric in metrics:
         _, axs = plt.subplots(rows, cols, layout='constrained', figsize=(12.2, 6))
         for method, ax in zip(methods, axs.flat):
-            plot_regression(df, df_ccc, metric, method, ax, lfontsize='small')
+            plot_regression(pairs, ccc, metric, method, ax, lfontsize='small')
             ax.set_ylabel(metric.split('_')[1])
             ax.set_xlabel('annotated ' + metric.split('_')[1])
         axs[-1,-1].axis('off')
@@ -5,7 +5,7 @@ import os
 import ecgdetectors
 import matplotlib.pyplot as plt
 import neurokit2 as nk
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 from jf.sensitivity_analysis import evaluate as sensitivity
 from jf.jf_analysis import evaluate as jf
 
@@ -16,7 +16,7 @@ experiments = ['sitting', 'maths', 'walking', 'hand_bike', 'jogging']
 methods = ['neurokit', 'pantompkins1985', 'hamilton2002', 'zong2003',
            'christov2004', 'elgendi2010', 'engzeemod2012', 'kalidas2017',
            'nabian2018', 'rodrigues2021']
-ecg_class = GUDb(0, experiments[-1])
+ecg_class = CachedGUDb(0, experiments[-1])
 
 # Anotated R-peaks and data
 annotated_peaks = ecg_class.anno_cs
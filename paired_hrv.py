@@ -0,0 +1,113 @@
+"""
+Detected HRV next to the annotated HRV, joined once.
+
+The CCC, Bland-Altman, bootstrap and regression code all compare the HRV of
+every detector with the annotated HRV of the same subject and experiment.
+PairedHRV does this join with a single merge of a table of HRV results
+(columns subject_idx, method, experiment and the metrics, as written by
+export_HRV.py) and keeps the result as arrays, one row per (method,
+experiment, subject) and one column per metric, sorted by method and
+experiment. The rows of a method, or of a (method, experiment), are then a
+contiguous slice found in O(1), and a metric is a column.
+"""
+import numpy as np
+import pandas as pd
+from utils import export_metrics
+
+
+class PairedHRV:
+    """
+    Pairs of detected and annotated HRV of one setup.
+
+    df: table of HRV results
+    metrics: HRV_ names of the metrics to keep
+    reference: table of the annotated HRV with the columns subject_idx,
+    experiment and the metrics, e.g. reference_hrv.ReferenceMemo.table;
+    by default the rows of `reference_method` in `df`
+
+    methods, experiments: detectors and experiments in the order they first
+    appear in `df`
+    group: (method, experiment) index of every row,
+    method_index * len(experiments) + experiment_index; rows are sorted by it
+    subjects: subject_idx of every row
+    detected, annotated: arrays of shape (rows, metrics); the annotated
+    values are NaN where the reference has no row (listed in `missing`)
+    """
+
+    def __init__(self, df, metrics=export_metrics, reference=None,
+                 setup=None, reference_method='Annotated'):
+        self.setup = setup
+        self.metrics = list(metrics)
+        self.column = {metric: j for j, metric in enumerate(self.metrics)}
+        keys = ['subject_idx', 'experiment']
+        if reference is None:
+            reference = df[df['method'] == reference_method]
+        detected = df.loc[df['method'] != reference_method,
+                          ['method'] + keys + self.metrics]
+        self.methods = pd.unique(detected['method'])
+        self.experiments = pd.unique(df['experiment'])
+
+        pairs = detected.merge(reference[keys + self.metrics], on=keys,
+                               how='left', suffixes=('', '_annotated'),
+                               indicator=True)
+        method_idx = pd.Categorical(pairs['method'], categories=self.methods).codes
+        experiment_idx = pd.Categorical(pairs['experiment'],
+                                        categories=self.experiments).codes
+        group = method_idx * len(self.experiments) + experiment_idx
+        order = np.lexsort((pairs['subject_idx'].to_numpy(), group))
+        pairs = pairs.iloc[order]
+
+        self.group = group[order]
+        self.subjects = pairs['subject_idx'].to_numpy()
+        self.detected = pairs[self.metrics].to_numpy(dtype=float)
+        self.annotated = pairs[[f'{m}_annotated' for m in self.metrics]].to_numpy(
+            dtype=float)
+        self.missing = pairs.loc[pairs['_merge'] == 'left_only',
+                                 keys].drop_duplicates(ignore_index=True)
+        self.method_index = {method: i for i, method in enumerate(self.methods)}
+        self.experiment_index = {e: i for i, e in enumerate(self.experiments)}
+        n_groups = len(self.methods) * len(self.experiments)
+        self.starts = np.searchsorted(self.group, np.arange(n_groups + 1))
+
+    def __len__(self):
+        return len(self.group)
+
+    def rows(self, method, experiment=None):
+        """Slice of the rows of a method, or of a (method, experiment)."""
+        n = len(self.experiments)
+        g = self.method_index[method] * n
+        if experiment is None:
+            return slice(self.starts[g], self.starts[g + n])
+        g += self.experiment_index[experiment]
+        return slice(self.starts[g], self.starts[g + 1])
+
+    def experiment_of(self, rows=slice(None)):
+        return self.experiments[self.group[rows] % len(self.experiments)]
+
+    def pairs(self, method, metric, experiment=None):
+        """
+        Values of one method and metric as a DataFrame with the columns
+        subject_idx, experiment, annotated and detected.
+        """
+        rows = self.rows(method, experiment)
+        j = self.column[metric]
+        return pd.DataFrame({'subject_idx': self.subjects[rows],
+                             'experiment': self.experiment_of(rows),
+                             'annotated': self.annotated[rows, j],
+                             'detected': self.detected[rows, j]})
+
+    def select(self, metrics=None, skip_methods=(), skip_experiments=()):
+        """
+        Rows and metrics to analyse.
+
+        returns group, subjects, annotated and detected of the rows that are
+        not of `skip_methods` or `skip_experiments`, with the columns of
+        `metrics` (all by default).
+        """
+        n = len(self.experiments)
+        keep = (~np.isin(self.methods, skip_methods)[self.group // n] &
+                ~np.isin(self.experiments, skip_experiments)[self.group % n])
+        cols = (slice(None) if metrics is None else
+                [self.column[m] for m in metrics])
+        return (self.group[keep], self.subjects[keep],
+                self.annotated[keep][:, cols], self.detected[keep][:, cols])
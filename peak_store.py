@@ -0,0 +1,144 @@
+"""
+Single-file store of the detected and annotated peaks of a setup.
+
+All peaks of a setup are kept in `{setup}_peaks.bin` as concatenated
+delta-encoded int32 positions, and `{setup}_peaks_index.json` maps every
+(subject, experiment, method) to its offset and length in that file. Reading
+one recording seeks to its offset, so it costs one small read regardless of
+the number of recordings. Running this script migrates the per-recording .npy
+files in `results/rr_detection` into the store.
+"""
+import json
+import os
+from pathlib import Path
+import numpy as np
+from utils import subjects, experiments, methods_names, make_peaks_file_name
+
+store_path = Path(__file__).resolve().parent / 'results/rr_detection'
+
+
+def peak_key(s, experiment, method):
+    return f'{s}/{experiment}/{method}'
+
+
+class PeakStore:
+    """
+    Ragged store of peaks keyed by (subject, experiment, method). Use
+    method='annotated' for the annotated peaks, as make_peaks_file_name does.
+    Appends are buffered until flush(); appending an existing key replaces
+    it, and compact() drops the replaced data from the file.
+    """
+
+    def __init__(self, setup, path=store_path):
+        self.setup = setup
+        self.path = Path(path)
+        self.data_file = self.path / f'{setup}_peaks.bin'
+        self.index_file = self.path / f'{setup}_peaks_index.json'
+        try:
+            with open(self.index_file) as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+        self.pending = {}
+
+    def __contains__(self, key):
+        return peak_key(*key) in self.index or peak_key(*key) in self.pending
+
+    def keys(self):
+        """List of (subject, experiment, method) in the store."""
+        keys = list(self.index) + [k for k in self.pending if k not in self.index]
+        return [(int(s), e, m) for s, e, m in (k.split('/') for k in keys)]
+
+    def read(self, s, experiment, method):
+        """Peaks of one recording. Raises KeyError if they are not stored."""
+        key = peak_key(s, experiment, method)
+        if key in self.pending:
+            return self.pending[key].copy()
+        offset, length = self.index[key]
+        deltas = np.fromfile(self.data_file, dtype=np.int32, count=length,
+                             offset=offset * 4)
+        return np.cumsum(deltas, dtype=np.int64)
+
+    def append(self, s, experiment, method, peaks):
+        self.pending[peak_key(s, experiment, method)] = np.asarray(peaks,
+                                                                   dtype=np.int64)
+
+    def append_many(self, items):
+        """Appends (subject, experiment, method, peaks) tuples and flushes."""
+        for s, experiment, method, peaks in items:
+            self.append(s, experiment, method, peaks)
+        self.flush()
+
+    def flush(self):
+        """Writes the pending peaks in one append and updates the index."""
+        if not self.pending:
+            return
+        self.path.mkdir(parents=True, exist_ok=True)
+        offset = self.data_file.stat().st_size // 4 if self.data_file.exists() else 0
+        chunks = []
+        for key, peaks in self.pending.items():
+            deltas = np.diff(peaks, prepend=0)
+            chunks.append(deltas.astype(np.int32))
+            self.index[key] = [offset, len(deltas)]
+            offset += len(deltas)
+        with open(self.data_file, 'ab') as f:
+            np.concatenate(chunks).tofile(f)
+        self.pending = {}
+        self.write_index()
+
+    def write_index(self):
+        tmp = self.index_file.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        tmp.replace(self.index_file)
+
+    def compact(self):
+        """
+        Rewrites the data file without replaced peaks. The new data file and
+        index are written next to the old ones and then moved over them, so
+        an error while writing leaves the store as it was.
+        """
+        self.flush()
+        if not self.index:
+            return
+        index = {}
+        offset = 0
+        tmp = self.data_file.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            for key, (start, length) in self.index.items():
+                deltas = np.fromfile(self.data_file, dtype=np.int32,
+                                     count=length, offset=start * 4)
+                deltas.tofile(f)
+                index[key] = [offset, length]
+                offset += length
+        os.replace(tmp, self.data_file)
+        self.index = index
+        self.write_index()
+
+
+def migrate(setup, read_path=store_path, store=None):
+    """
+    Moves the per-recording .npy peak files of a setup into a PeakStore.
+    The .npy files are left in place.
+    """
+    if store is None:
+        store = PeakStore(setup, read_path)
+    n_files = 0
+    for s in subjects:
+        for experiment in experiments:
+            for method in ['annotated'] + list(methods_names):
+                fn = read_path / make_peaks_file_name(s, setup, experiment, method)
+                try:
+                    peaks = np.load(fn)
+                except FileNotFoundError:
+                    continue
+                store.append(s, experiment, method, peaks)
+                n_files += 1
+    store.flush()
+    print(f'{n_files} peak files of setup {setup} migrated into {store.data_file}')
+    return store
+
+
+if __name__ == '__main__':
+    migrate('einthoven')
+    migrate('chest_strap')
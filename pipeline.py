@@ -0,0 +1,345 @@
+"""
+Incremental runner of the whole workflow.
+
+The scripts of the analysis form a chain: rr_peak_detection.py ->
+compute_hrv.py -> export_HRV.py -> ccc.py (R/ccc.R before), bland_altman.py
+and bootstrap.py -> ccc_barplot.py, mregression.py and ccc_and_jf.py. Here
+they are stages of a DAG. Every stage declares its input files, the modules
+of its code, its parameters and its outputs, and its fingerprint is a hash
+of all of them. A stage only runs when its fingerprint changed since its
+last successful run or one of its outputs is missing. The outputs of a
+stage are the inputs of the next ones, so a change propagates downstream,
+and stops as soon as a stage writes the same outputs as before.
+Fingerprints are kept in results/pipeline_state.json; file hashes are only
+recomputed for files whose size or modification time changed.
+
+The exported HRV tables in datahrv/ are the frozen inputs of the paper. The
+statistics stages read them as they are, and the publish stages, which copy
+the new exports over them, are only part of the pipeline with --publish.
+
+Usage: python pipeline.py [stage ...] [--force] [--dry-run] [--jobs N]
+[--publish]
+Without stages, every stage is brought up to date; with stages, only these
+and the stages they depend on.
+"""
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from dataclasses import dataclass, field
+from pathlib import Path
+from time import perf_counter
+
+parent_path = Path(__file__).resolve().parent
+state_file = parent_path / 'results/pipeline_state.json'
+setups = ['einthoven', 'chest_strap']
+FS = 250
+
+# Exported HRV of each setup as the CCC and the figures read it. These are
+# the tracked inputs of the paper, only overwritten with publish=True.
+published = {
+    'einthoven': 'datahrv/einthoven_subset_HRV_not_jogging_with_Engzee.csv',
+    'chest_strap': 'datahrv/chest_strap_setup_subset_HRV_notEngzee.csv'}
+ccc_tables = {setup: f'datahrv/ccc_{setup}_df.csv' for setup in setups}
+# Recordings left out of the statistics, as export_HRV.py leaves them out
+skipped = {'einthoven': {'skip_experiments': ['jogging']},
+           'chest_strap': {'skip_methods': ['Engzee']}}
+
+
+@dataclass
+class Stage:
+    """
+    One step of the pipeline. Paths are relative to the repository.
+    inputs: data files read by the stage
+    code: source files whose changes make the stage stale
+    params: parameters of the run, any JSON-serializable dict
+    outputs: files written by the stage
+    action: function that runs the stage
+    """
+    name: str
+    action: object
+    inputs: list = field(default_factory=list)
+    code: list = field(default_factory=list)
+    params: dict = field(default_factory=dict)
+    outputs: list = field(default_factory=list)
+
+
+class FileHashes:
+    """
+    SHA-256 of files, reused while the size and the modification time of a
+    file do not change.
+    """
+
+    def __init__(self, known=None):
+        self.known = {} if known is None else known
+
+    def __call__(self, path):
+        fn = parent_path / path
+        try:
+            st = fn.stat()
+        except FileNotFoundError:
+            return None
+        stamp = [st.st_size, st.st_mtime_ns]
+        entry = self.known.get(path)
+        if entry is not None and entry[:2] == stamp:
+            return entry[2]
+        h = hashlib.sha256()
+        with open(fn, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        self.known[path] = stamp + [h.hexdigest()]
+        return h.hexdigest()
+
+
+def fingerprint(stage, file_hash):
+    """Hash of the inputs, code and parameters of a stage."""
+    h = hashlib.sha256(stage.name.encode())
+    for path in stage.inputs + stage.code:
+        h.update(f'|{path}:{file_hash(path)}'.encode())
+    h.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+def package_version(name):
+    from importlib.metadata import version, PackageNotFoundError
+    try:
+        return version(name)
+    except PackageNotFoundError:
+        return 'unknown'
+
+
+# %% Stage actions. Modules are imported when a stage runs, so that a dry run
+# does not need the dependencies of every stage.
+def run_detection(setup, jobs):
+    from rr_peak_detection import run_detection
+    run_detection(setup, jobs)
+
+
+def run_hrv(setup, jobs, engine, metrics):
+    import numpy as np
+    import compute_hrv
+    from utils import experiments, methods_names
+    # compute_hrv.py sets these in its main block
+    compute_hrv.read_path = parent_path / 'results/rr_detection'
+    compute_hrv.save_path = parent_path / 'results/HRV'
+    compute_hrv.experiments = experiments
+    compute_hrv.FS = FS
+    compute_hrv.compute_hrv(setup, np.array(methods_names), jobs, engine,
+                            metrics)
+
+
+def run_export(setup, engine):
+    from export_HRV import export_hrv
+    export_hrv(setup, engine=engine)
+
+
+def run_publish(setup):
+    shutil.copyfile(parent_path / f'results/HRV/{setup}_subset_HRV.csv',
+                    parent_path / published[setup])
+
+
+def run_ccc(setup):
+    from ccc import save_ccc
+    save_ccc(setup, parent_path / published[setup], **skipped[setup])
+
+
+def run_bland_altman(setup):
+    from bland_altman import save_bland_altman
+    save_bland_altman(setup, parent_path / published[setup], **skipped[setup])
+
+
+def run_bootstrap(setup, jobs):
+    from bootstrap import save_bootstrap
+    save_bootstrap(setup, parent_path / published[setup], jobs=jobs,
+                   **skipped[setup])
+
+
+def run_ccc_barplot():
+    import ccc_barplot
+    ccc_barplot.make_paper_plot()
+
+
+def run_regressions():
+    import mregression
+    mregression.plot_paper_regression()
+
+
+def run_ccc_jf():
+    import ccc_and_jf
+    ccc_and_jf.save_figures()
+
+
+def make_stages(jobs=1, engine='neurokit', metrics=None, publish=False):
+    """
+    Stages of the pipeline in a topological order. The publish stages,
+    which overwrite the exported HRV in datahrv/, are only included with
+    `publish`.
+    """
+    from utils import export_metrics
+    metrics = export_metrics if metrics is None else metrics
+    evaluation = ['jf/evaluation.py', 'jf/util.py', 'jf/jf_analysis.py',
+                  'jf/sensitivity_analysis.py']
+    hrv_code = ['compute_hrv.py', 'hrv_metrics.py', 'hrv_time.py',
+                'hrv_frequency.py', 'sampen.py', 'reference_hrv.py',
+                'peak_store.py', 'utils.py', 'jf/util.py']
+    stages = []
+    for setup in setups:
+        peaks = [f'results/rr_detection/{setup}_peaks.bin',
+                 f'results/rr_detection/{setup}_peaks_index.json']
+        jf_table = f'results/rr_detection/sensitivity_jf_{setup}.csv'
+        hrv_table = f'results/HRV/{setup}_HRV_results.csv'
+        subset = f'results/HRV/{setup}_subset_HRV.csv'
+        stages += [
+            Stage(f'detection_{setup}', lambda s=setup: run_detection(s, jobs),
+                  code=['rr_peak_detection.py', 'detection_cache.py',
+                        'gudb_cache.py', 'peak_store.py',
+                        'utils.py'] + evaluation,
+                  params={'fs': FS, 'py-ecg-detectors':
+                          package_version('py-ecg-detectors')},
+                  outputs=peaks + [jf_table]),
+            Stage(f'hrv_{setup}',
+                  lambda s=setup: run_hrv(s, jobs, engine, metrics),
+                  inputs=peaks, code=hrv_code,
+                  params={'fs': FS, 'engine': engine, 'metrics': metrics,
+                          'neurokit2': package_version('neurokit2')},
+                  outputs=[hrv_table]),
+            Stage(f'export_{setup}', lambda s=setup: run_export(s, engine),
+                  inputs=[hrv_table] + peaks,
+                  code=['export_HRV.py', 'reference_hrv.py', 'peak_store.py',
+                        'utils.py'],
+                  params={'engine': engine},
+                  outputs=[subset])]
+        if publish:
+            stages.append(Stage(f'publish_{setup}',
+                                lambda s=setup: run_publish(s),
+                                inputs=[subset], outputs=[published[setup]]))
+        stages += [
+            Stage(f'ccc_{setup}', lambda s=setup: run_ccc(s),
+                  inputs=[published[setup]],
+                  code=['ccc.py', 'paired_hrv.py', 'utils.py'],
+                  outputs=[ccc_tables[setup]]),
+            Stage(f'bland_altman_{setup}', lambda s=setup: run_bland_altman(s),
+                  inputs=[published[setup]],
+                  code=['bland_altman.py', 'ccc.py', 'paired_hrv.py',
+                        'utils.py'],
+                  outputs=[f'datahrv/bland_altman_{setup}_df.csv']),
+            Stage(f'bootstrap_{setup}', lambda s=setup: run_bootstrap(s, jobs),
+                  inputs=[published[setup], jf_table],
+                  code=['bootstrap.py', 'ccc.py', 'paired_hrv.py', 'utils.py'],
+                  params={'resamples': 10000, 'seed': 0},
+                  outputs=[f'datahrv/ccc_bootstrap_{setup}_df.csv',
+                           f'datahrv/jf_bootstrap_{setup}_df.csv'])]
+
+    stages += [
+        Stage('ccc_barplot', run_ccc_barplot,
+              inputs=[ccc_tables['chest_strap']],
+              code=['ccc_barplot.py', 'utils.py'],
+              outputs=['figures/ccc_barplot.pdf']),
+        Stage('regressions', run_regressions,
+              inputs=[published['chest_strap'], ccc_tables['chest_strap']],
+              code=['mregression.py', 'paired_hrv.py', 'utils.py'],
+              outputs=[f'figures/regression_HRV_{m}.pdf'
+                       for m in ('MeanNN', 'TINN', 'LFHF')]),
+        Stage('ccc_jf', run_ccc_jf,
+              inputs=[f'results/rr_detection/sensitivity_jf_{setup}.csv'
+                      for setup in setups] + list(ccc_tables.values()),
+              code=['ccc_and_jf.py'],
+              outputs=[f'figures/ccc_jf_{name}.pdf' for name in
+                       ('chest_strap', 'einthoven', 'both', 'both_overlay')])]
+    return stages
+
+
+def required(stages, targets):
+    """Names of the target stages and of the stages they depend on."""
+    producer = {out: stage for stage in stages for out in stage.outputs}
+    names = {stage.name: stage for stage in stages}
+    unknown = [t for t in targets if t not in names]
+    if unknown:
+        raise ValueError(f'Unknown stages {unknown}, the stages are '
+                         f'{list(names)}')
+    needed = set()
+    todo = list(targets)
+    while todo:
+        name = todo.pop()
+        if name in needed:
+            continue
+        needed.add(name)
+        todo += [producer[path].name for path in names[name].inputs
+                 if path in producer]
+    return needed
+
+
+def run(stages, targets=None, force=False, dry_run=False):
+    """
+    Runs the stale stages among `targets` (names, None for all) and the
+    stages they depend on. Returns the names of the stages that ran, or
+    would run with dry_run.
+    """
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        state = {'files': {}, 'stages': {}}
+    file_hash = FileHashes(state['files'])
+    needed = None if targets is None else required(stages, targets)
+    producer = {out: stage.name for stage in stages for out in stage.outputs}
+    # The scripts use paths relative to the repository, the working
+    # directory of the caller is restored afterwards
+    cwd = os.getcwd()
+    os.chdir(parent_path)
+    ran = []
+    try:
+        for stage in stages:
+            if needed is not None and stage.name not in needed:
+                continue
+            key = fingerprint(stage, file_hash)
+            missing = [p for p in stage.outputs
+                       if not (parent_path / p).exists()]
+            # In a dry run the stale stages upstream have not rewritten
+            # the inputs
+            upstream = dry_run and any(producer.get(p) in ran
+                                       for p in stage.inputs)
+            if (not force and not missing and not upstream and
+                    state['stages'].get(stage.name) == key):
+                print(f'{stage.name}: up to date')
+                continue
+            ran.append(stage.name)
+            if dry_run:
+                print(f'{stage.name}: stale')
+                continue
+            print(f'{stage.name}: running')
+            t0 = perf_counter()
+            stage.action()
+            print(f'{stage.name}: done in {perf_counter() - t0:.1f} s')
+            state['stages'][stage.name] = key
+            # Save after every stage, so a failure keeps the finished ones
+            state_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(state_file, 'w') as f:
+                json.dump(state, f, indent=1)
+    finally:
+        os.chdir(cwd)
+    return ran
+
+
+if __name__ == '__main__':
+    import matplotlib
+    matplotlib.use('Agg')  # figures are only saved
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('stages', nargs='*',
+                        help='stages to bring up to date, all by default')
+    parser.add_argument('--force', action='store_true',
+                        help='run the stages even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='only list the stale stages')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help='processes of the detection and HRV stages')
+    parser.add_argument('--engine', default='neurokit',
+                        help="HRV engine of compute_hrv, 'neurokit' or "
+                             "'native'")
+    parser.add_argument('--publish', action='store_true',
+                        help='overwrite the exported HRV of the paper in '
+                             'datahrv/ with the new exports')
+    args = parser.parse_args()
+    run(make_stages(args.jobs, args.engine, publish=args.publish),
+        args.stages or None, args.force, args.dry_run)
@@ -5,12 +5,12 @@ from pathlib import Path
 import numpy as np
 import matplotlib.pyplot as plt
 from tqdm import tqdm
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 from utils import save_figs_as_pdf
 
 
 def plot_single_case(s, experiment, setup):
-    ecg = GUDb(s, experiment)
+    ecg = CachedGUDb(s, experiment)
 
     if setup == 'Einthoven':
         annotated = ecg.anno_cables_exists
@@ -0,0 +1,142 @@
+"""
+Persistent memo of the HRV of the annotated peaks.
+
+The annotations never change, so their HRV is the same on every run. Every
+entry stores the reference HRV of one (setup, subject, experiment) for one
+metric set and engine, together with the hash of the annotated peaks it was
+computed from. The file name holds a hash of the metric set, the engine,
+the neurokit2 version and the source of the HRV modules, so an upgrade of
+neurokit2 or a change of the engine code starts new entries, and an entry
+is only used while the annotations still have its hash. The key is in effect
+(subject, experiment, setup, annotation hash, metric set, engine version). compute_hrv.py fills the memo and only computes the missing entries;
+export_HRV.py, mregression.py and the CCC take their reference values from
+it with ReferenceMemo.table.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+from importlib.metadata import version, PackageNotFoundError
+import numpy as np
+import pandas as pd
+
+memo_path = Path(__file__).resolve().parent / 'results/HRV/reference_hrv'
+# Modules whose code gives the HRV of both engines
+engine_code = ['hrv_metrics.py', 'hrv_time.py', 'hrv_frequency.py',
+               'sampen.py', 'jf/util.py']
+engine_versions = {}
+
+
+def annotation_hash(peaks, fs):
+    """Hash of the annotated peaks and their sampling rate."""
+    peaks = np.ascontiguousarray(peaks, dtype=np.int64)
+    h = hashlib.sha256(f'{fs}|'.encode())
+    h.update(memoryview(peaks).cast('B'))
+    return h.hexdigest()
+
+
+def engine_version(engine):
+    """neurokit2 version and hash of the HRV code, for an engine name."""
+    if engine not in engine_versions:
+        try:
+            nk_version = version('neurokit2')
+        except PackageNotFoundError:
+            nk_version = 'unknown'
+        h = hashlib.sha256(f'{engine}|{nk_version}|'.encode())
+        root = Path(__file__).resolve().parent
+        for fn in engine_code:
+            h.update((root / fn).read_bytes())
+        engine_versions[engine] = f'{engine}-{nk_version}-{h.hexdigest()[:12]}'
+    return engine_versions[engine]
+
+
+def metrics_hash(metrics, engine):
+    """
+    Short hash of a metric set (None for every metric) and of the version
+    of the engine that computes it.
+    """
+    names = 'all' if metrics is None else '|'.join(metrics)
+    name = f'{engine_version(engine)}|{names}'
+    return hashlib.sha256(name.encode()).hexdigest()[:16]
+
+
+class ReferenceMemo:
+    """
+    On-disk memo of the reference HRV, one JSON file per entry in
+    `{memo_dir}/{setup}`. An entry of a (subject, experiment, metric set) is
+    replaced when the annotations change. `hits` and `misses` count the
+    lookups of this instance.
+    """
+
+    def __init__(self, memo_dir=memo_path):
+        self.memo_dir = Path(memo_dir)
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, setup, s, experiment, metrics, engine):
+        return (self.memo_dir / setup /
+                f'{s}_{experiment}_{metrics_hash(metrics, engine)}.json')
+
+    def get(self, setup, s, experiment, peaks, fs, metrics, engine='neurokit'):
+        """Returns the memoized HRV of the annotated `peaks` or None."""
+        try:
+            with open(self.path(setup, s, experiment, metrics, engine)) as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            entry = None
+        if entry is None or entry['annotation'] != annotation_hash(peaks, fs):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(zip(entry['metrics'], entry['values']))
+
+    def put(self, setup, s, experiment, peaks, fs, metrics, hrv,
+            engine='neurokit'):
+        """Stores `hrv`, a dict of HRV_ name to value, of the annotated peaks."""
+        fn = self.path(setup, s, experiment, metrics, engine)
+        fn.parent.mkdir(parents=True, exist_ok=True)
+        entry = {'subject_idx': int(s), 'experiment': experiment,
+                 'engine': engine_version(engine),
+                 'annotation': annotation_hash(peaks, fs),
+                 'metrics': list(hrv),
+                 'values': [float(v) for v in hrv.values()]}
+        tmp = fn.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(entry, f)
+        os.replace(tmp, fn)  # atomic, safe with several processes
+
+    def table(self, setup, metrics, store=None, fs=250, engine='neurokit'):
+        """
+        Reference HRV of all memoized subjects and experiments of a setup as
+        a DataFrame with the columns subject_idx, experiment and `metrics`.
+        Only entries of exactly the metric set `metrics` computed by the
+        current version of `engine` are used, so there is one per subject
+        and experiment. With a PeakStore `store`, entries of annotations
+        that changed since are left out.
+        """
+        rows = []
+        pattern = f'*_{metrics_hash(metrics, engine)}.json'
+        for fn in sorted((self.memo_dir / setup).glob(pattern)):
+            with open(fn) as f:
+                entry = json.load(f)
+            values = dict(zip(entry['metrics'], entry['values']))
+            s, experiment = entry['subject_idx'], entry['experiment']
+            if store is not None:
+                try:
+                    peaks = store.read(s, experiment, 'annotated')
+                except KeyError:
+                    continue
+                if entry['annotation'] != annotation_hash(peaks, fs):
+                    continue
+            rows.append([s, experiment] + [values[m] for m in metrics])
+        columns = ['subject_idx', 'experiment'] + list(metrics)
+        table = pd.DataFrame(rows, columns=columns)
+        return table.sort_values(['subject_idx', 'experiment'],
+                                 ignore_index=True)
+
+    def clear(self, setup):
+        for fn in (self.memo_dir / setup).glob('*.json'):
+            fn.unlink()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
@@ -1,89 +1,147 @@
 """
 Detects QRS peaks for all subjects, conditions, and setups.
 """
+import os
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import seaborn as sns
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
 from tqdm import tqdm
-from ecgdetectors import Detectors
-from jf.jf_analysis import evaluate as jf
-from jf.sensitivity_analysis import evaluate as sens
-from utils import subjects, experiments, methods_names, make_peaks_file_name
+from detection_cache import CachedDetectors
+from jf.evaluation import evaluate_batch
+from jf.util import flatten
+from utils import subjects, experiments, methods_names, ResultBuilder
+from peak_store import PeakStore
 
 save_path = Path(__file__).resolve().parent / 'results/rr_detection'
 fs = 250
 # %% Initialize Porr detectors
-detectors = Detectors(fs)
+detectors = CachedDetectors(fs)
 methods = detectors.get_detector_list()
 
 
-def detect_peaks(setup):
-    # Allocate arrays that later compose the DF
-    sensitivity = []
-    JF = []
-    methods_name = []
-    experiments_name = []
-    subject_idx = []
+def load_setup(ecg_class, setup):
+    """Returns (anno_exists, annotated_peaks, data) of a recording."""
+    if setup == 'einthoven':
+        return (ecg_class.anno_cables_exists, ecg_class.anno_cables,
+                ecg_class.einthoven_II)
+    elif setup == 'chest_strap':
+        return (ecg_class.anno_cs_exists, ecg_class.anno_cs,
+                ecg_class.cs_V2_V1)
+
+
+def detect_single(task):
+    """
+    Runs one detector on one recording. `task` is
+    (subject, experiment, setup, method index). Used by the process pool.
+    Returns the peaks and whether they came from the detection cache.
+    """
+    s, experiment, setup, i = task
+    _, _, data = load_setup(CachedGUDb(s, experiment), setup)
+
+    # Find peaks
+    hits = detectors.cache.hits
+    peaks = np.array(methods[i][1](data))
+    return peaks, detectors.cache.hits > hits
+
+
+def run_detection(setup, jobs=1):
+    """
+    Detects the peaks of all subjects, conditions and methods, saves them in
+    the PeakStore of the setup and evaluates them. With jobs > 1 the
+    (subject, condition, method) tasks run in a pool of `jobs` processes;
+    jobs=None, 0 or 1 runs them in this process. Results are collected in
+    task order, so the output does not depend on the number of jobs.
+    Returns the table saved in sensitivity_jf_{setup}.csv.
+    """
+    store = PeakStore(setup, save_path)
+    annotated = []
+    tasks = []
+    task_record = []
 
     for s in tqdm(subjects, desc='Subject'):
-        for experiment in tqdm(experiments, desc='Condition'):
-            ecg_class = GUDb(s, experiment)
-
-            # Anotated R-peaks and data
-            if setup == 'einthoven':
-                anno_exists = ecg_class.anno_cables_exists
-                annotated_peaks = ecg_class.anno_cables
-                data = ecg_class.einthoven_II
+        for experiment in tqdm(experiments, desc='Condition', leave=False):
+            ecg_class = CachedGUDb(s, experiment)
 
-            elif setup == 'chest_strap':
-                anno_exists = ecg_class.anno_cs_exists
-                annotated_peaks = ecg_class.anno_cs
-                data = ecg_class.cs_V2_V1
+            # Anotated R-peaks
+            anno_exists, annotated_peaks, _ = load_setup(ecg_class, setup)
 
             if not anno_exists:
                 tqdm.write(f'No annotation for subject {s}, condition {experiment}. '
                            'Skipping it.')
                 continue
 
-            fs = ecg_class.fs
-
-            # tolerance window in samples
-            W = int(fs / 10)
-
-            fn = make_peaks_file_name(s, setup, experiment, 'annotated')
-            np.save(save_path / fn, annotated_peaks)
-
-            for i, method in enumerate(tqdm(methods, desc='Method', leave=False)):
-
-                # Find peaks
-                detected_peaks = np.array(method[1](data))
+            store.append(s, experiment, 'annotated', annotated_peaks)
+            annotated.append(np.asarray(annotated_peaks))
 
-                fn = make_peaks_file_name(s, setup, experiment, methods_names[i])
-                np.save(save_path / fn, detected_peaks)
+            for i in range(len(methods)):
+                tasks.append((s, experiment, setup, i))
+                task_record.append(len(annotated) - 1)
 
-                # Compute sensitivity
-                if len(detected_peaks) > 10:
+    if jobs is None or jobs <= 1:
+        peaks = map(detect_single, tasks)
+        executor = None
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        peaks = executor.map(detect_single, tasks, chunksize=1)
 
-                    experiments_name.append(experiment)
-                    methods_name.append(methods_names[i])
-                    subject_idx.append(s)
-
-                    results = sens(detected_peaks, annotated_peaks, W)
-                    sensitivity.append(results[0])
-
-                    JF.append(jf(detected_peaks, annotated_peaks, fs, None)['jf'])
+    # Peaks of all records and methods, evaluated together at the end
+    detected = []
+    det_record = []
+    methods_name = []
+    experiments_name = []
+    subject_idx = []
+    cache_hits = 0
+    try:
+        for task, record, (detected_peaks, hit) in tqdm(
+                zip(tasks, task_record, peaks), total=len(tasks),
+                desc='Detection'):
+            s, experiment, _, i = task
+            cache_hits += hit
+            store.append(s, experiment, methods_names[i], detected_peaks)
+            # Only evaluate methods with enough detections
+            if len(detected_peaks) > 10:
+                detected.append(detected_peaks)
+                det_record.append(record)
+                experiments_name.append(experiment)
+                methods_name.append(methods_names[i])
+                subject_idx.append(s)
+    finally:
+        if executor is not None:
+            # Also stops the pool when a task failed
+            executor.shutdown(cancel_futures=True)
+    if executor is not None:
+        # The workers counted their own lookups
+        detectors.cache.hits += cache_hits
+        detectors.cache.misses += len(tasks) - cache_hits
+    print('Detection cache:', detectors.cache.stats())
+    store.compact()
+
+    # tolerance window in samples
+    W = int(fs / 10)
+
+    # Compute sensitivity and JF for all records and methods in one call
+    det_values, det_offsets = flatten(detected)
+    anno_values, anno_offsets = flatten(annotated)
+    results = evaluate_batch(det_values, det_offsets, anno_values, anno_offsets,
+                             fs, W, det_record=det_record)
 
     # Arrange into pandas array
-    data_dict = {'sensitivity': np.array(sensitivity),
-                 'JF': np.array(JF)*100,
-                 'method': np.array(methods_name),
-                 'experiment': np.array(experiments_name),
-                 'subject_idx': np.array(subject_idx)}
-    data = pd.DataFrame.from_dict(data_dict)
+    rows = ResultBuilder()
+    rows.add_rows(sensitivity=results['sensitivity'].to_numpy(),
+                  JF=results['jf'].to_numpy()*100,
+                  method=methods_name,
+                  experiment=experiments_name,
+                  subject_idx=subject_idx)
+    data = rows.to_frame()
     data.to_csv(save_path / f'sensitivity_jf_{setup}.csv')
+    return data
+
+
+def detect_peaks(setup, jobs=1):
+    data = run_detection(setup, jobs)
 
     # Sensitivity and JF plots
     plt.close('all')
@@ -111,5 +169,6 @@ def detect_peaks(setup):
 
 
 if __name__ == '__main__':
-    detect_peaks('chest_strap')
-    detect_peaks('einthoven')
+    jobs = os.cpu_count()
+    detect_peaks('chest_strap', jobs)
+    detect_peaks('einthoven', jobs)
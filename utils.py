@@ -2,6 +2,7 @@
 Utilities to detect and calculate HRV measures.
 """
 import numpy as np
+import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 from matplotlib.backends.backend_pdf import PdfPages
@@ -12,6 +13,12 @@ experiments = ['sitting', 'maths', 'walking', 'hand_bike', 'jogging']
 methods_names = ['Elgendi_et_al', 'Matched_filter', 'Wavelet_transform',
                  'Engzee', 'Christov', 'Hamilton', 'Pan_Tompkins',
                  'WQRS']
+# HRV metrics kept for the statistical analysis (export_HRV.py)
+export_metrics = ['HRV_MeanNN', 'HRV_SDNN', 'HRV_RMSSD', 'HRV_SDSD', 'HRV_CVSD',
+                  'HRV_CVNN', 'HRV_TINN', 'HRV_HTI', 'HRV_SDRMSSD',
+                  'HRV_pNN20', 'HRV_pNN50', 'HRV_IQRNN', 'HRV_LF', 'HRV_HF',
+                  'HRV_LFHF', 'HRV_LFn', 'HRV_HFn', 'HRV_LnHF', 'HRV_SD1',
+                  'HRV_SD2', 'HRV_SD1SD2', 'HRV_SampEn', 'HRV_TP']
 
 
 def save_figs_as_pdf(figs, fn):
@@ -31,7 +38,7 @@ def make_peaks_file_name(s, setup, experiment, method):
 
 
 def confusion_matrix(annotated_peaks,
-                     detected_peaks, tolerance_window):
+                     detected_peaks, tolerance_window, chunk_size=None):
     """
     Computes performance measures for peak detection.
 
@@ -41,15 +48,33 @@ def confusion_matrix(annotated_peaks,
     detected_peaks -> 1D ndarray with the detected peaks in samples
     tolerance_window -> float with the number of samples to tolerate for the
     detection of a true positive peak.
+    chunk_size -> int with the number of annotated peaks processed at once.
+    Bounds the size of the temporary arrays; None processes all at once.
+
+    Every (annotated, detected) pair closer than `tolerance_window` counts
+    as a true positive. Instead of building the full annotated x detected
+    difference matrix, the detected peaks are sorted once and the pairs
+    within the window of each annotated peak are counted with two binary
+    searches, so memory is O(N+M).
 
     References
     ----------
     This function is based on what is described in:
     """
-
-    tp = np.sum(
-        np.abs(
-            (annotated_peaks[:, None] - detected_peaks[None, :])) < tolerance_window)
+    annotated_peaks = np.asarray(annotated_peaks)
+    detected_peaks = np.sort(np.asarray(detected_peaks))
+    if chunk_size is None:
+        chunk_size = max(len(annotated_peaks), 1)
+
+    tp = np.int64(0)
+    for start in range(0, len(annotated_peaks), chunk_size):
+        chunk = annotated_peaks[start:start + chunk_size]
+        # Detections d with chunk - tolerance_window < d < chunk + tolerance_window
+        lower = np.searchsorted(detected_peaks, chunk - tolerance_window,
+                                side='right')
+        upper = np.searchsorted(detected_peaks, chunk + tolerance_window,
+                                side='left')
+        tp += np.sum(upper - lower)
 
     fp = len(detected_peaks) - tp
 
@@ -62,6 +87,73 @@ def confusion_matrix(annotated_peaks,
     return sensitivity, positive_predictivity, tp, fp, fn
 
 
+class ResultBuilder:
+    """
+    Collects per-record result rows column by column and builds a single
+    DataFrame at the end, instead of growing a DataFrame with pd.concat.
+
+    Parameters
+    ----------
+    categorical -> column names stored with a categorical dtype. Categories
+    keep the order in which they first appear.
+    """
+
+    def __init__(self, categorical=('method', 'experiment')):
+        self.categorical = categorical
+        self.columns = {}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    def add_row(self, values=None, **labels):
+        """
+        Adds one row. `values` is a dict, a Series or a one-row DataFrame
+        (like the output of nk.hrv); `labels` are extra columns. Columns
+        missing in this row, or in earlier rows, are filled with NaN.
+        """
+        if isinstance(values, pd.DataFrame):
+            values = values.iloc[0].to_dict()
+        elif values is None:
+            values = {}
+        row = {**values, **labels}
+        for name in row:
+            if name not in self.columns:
+                self.columns[name] = [np.nan] * self.n_rows
+        for name, column in self.columns.items():
+            column.append(row.get(name, np.nan))
+        self.n_rows += 1
+
+    def add_rows(self, **columns):
+        """Adds several rows given as equally long columns."""
+        if not columns:
+            return
+        lengths = {len(v) for v in columns.values()}
+        if len(lengths) != 1:
+            raise ValueError('All columns must have the same length')
+        n = lengths.pop()
+        for name in columns:
+            if name not in self.columns:
+                self.columns[name] = [np.nan] * self.n_rows
+        for name, column in self.columns.items():
+            column.extend(columns[name] if name in columns else [np.nan] * n)
+        self.n_rows += n
+
+    def extend(self, other):
+        """Appends the rows of another ResultBuilder."""
+        self.add_rows(**other.columns)
+
+    def to_frame(self):
+        data = {}
+        for name, column in self.columns.items():
+            if name in self.categorical:
+                categories = pd.unique(pd.Series(column, dtype=object).dropna())
+                data[name] = pd.Categorical(column, categories=categories)
+            else:
+                data[name] = column
+        return pd.DataFrame(data)
+
+
 def read_info():
     """
     Returns dictionary with information about the QRS detection analysis.
@@ -4,18 +4,17 @@ Functions to visualize the ECG and the annotations.
 from itertools import product
 from pathlib import Path
 import pandas as pd
-from ecg_gudb_database import GUDb
+from gudb_cache import CachedGUDb
 import matplotlib.pyplot as plt
 from cycler import cycler
-from ecgdetectors import Detectors
-from jf.jf_analysis import evaluate as jf
-from jf.sensitivity_analysis import evaluate as sens
+from detection_cache import CachedDetectors
+from jf.evaluation import evaluate
 from utils import experiments
 
 
 save_path = Path(__file__).resolve().parent /  'results'
 FS = 250
-detectors = Detectors(FS)
+detectors = CachedDetectors(FS)
 detectors_d = {
     'pan_tompkins': detectors.pan_tompkins_detector,
     'two_average': detectors.two_average_detector,
@@ -47,7 +46,7 @@ def auto_ylim(ax, margin=0.1):
 
 
 def load_data(subject, experiment, setup):
-    ecg = GUDb(subject, experiment)
+    ecg = CachedGUDb(subject, experiment)
 
     if setup == 'chest_strap':
         data = ecg.cs_V2_V1 * 1000
@@ -82,9 +81,9 @@ def plot_single_case(subject, experiment, setup, methods):
     jfs, sensibilities = {}, {}
     for detector in methods:
         detected_peaks = detectors_d[detector](data)
-        jfs[detector] = jf(detected_peaks,
-                           annotated_peaks, FS, None)['jf']
-        sensibilities[detector] = sens(detected_peaks, annotated_peaks, FS/10)[0]
+        results = evaluate(detected_peaks, annotated_peaks, FS, FS/10)
+        jfs[detector] = results.jf
+        sensibilities[detector] = results.sensitivity
         ax.plot(time[detected_peaks], data[detected_peaks], ls='None',
                 label=detector, ms=ms)
 
@@ -0,0 +1,223 @@
+"""
+HRV over a sliding window for long recordings.
+
+Instead of one value per recording, MeanNN, SDNN, RMSSD, SDSD and pNNx are
+computed over the beats of the last `window` seconds every `step` seconds.
+All of them are sums over the RR intervals and their successive differences
+in the window, so they follow from running sums that add the beats entering
+the window and subtract the ones leaving it:
+
+- RollingHRV keeps these sums for a stream of peaks, one beat at a time.
+- windowed_hrv computes every window of many recordings in one pass, from
+  prefix sums of the flat RR intervals, so every window costs O(1)
+  whatever its length.
+
+The metrics of a window are those of nk.hrv_time on the peaks in the window
+(the peaks p with end - window < p <= end), with the HRV_ prefix.
+"""
+from collections import deque
+import numpy as np
+import pandas as pd
+from jf.util import flatten, segment_ids, segment_argsort
+from hrv_time import rr_intervals
+from peak_store import PeakStore, store_path
+
+window_metrics = ['MeanNN', 'SDNN', 'RMSSD', 'SDSD', 'pNN50', 'pNN20']
+
+
+def metrics_from_sums(n, s1, s2, d1, d2, over, shift=0):
+    """
+    Windowed metrics from the sums over the window: n intervals, the sum
+    and sum of squares of the intervals minus `shift` (s1, s2) and of their
+    successive differences (d1, d2), and `over`, a dict of threshold x to the
+    number of absolute differences above x.
+    """
+    n = np.asarray(n, dtype=float)
+    n_diff = n - 1
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out = {'MeanNN': s1 / n + shift,
+               'SDNN': np.sqrt(np.maximum(s2 - s1**2 / n, 0) / (n - 1)),
+               'RMSSD': np.sqrt(d2 / n_diff),
+               'SDSD': np.sqrt(np.maximum(d2 - d1**2 / n_diff, 0) /
+                               (n_diff - 1))}
+        out['SDSD'] = np.where(n_diff > 1, out['SDSD'], np.nan)
+        for x, count in over.items():
+            out[f'pNN{x}'] = count / n * 100  # len(diff) + 1, as neurokit2
+    valid = n >= 2  # nk.hrv needs three peaks
+    return {f'HRV_{k}': np.where(valid, v, np.nan) for k, v in out.items()}
+
+
+class RollingHRV:
+    """
+    Windowed HRV of a stream of peaks. push() adds a peak and drops the
+    peaks older than `window` seconds, updating the running sums in O(1)
+    amortized time; metrics() returns the HRV of the current window.
+    """
+
+    def __init__(self, fs=250, window=60, thresholds=(50, 20)):
+        self.fs = fs
+        self.window = window * fs
+        self.thresholds = thresholds
+        self.peaks = deque()
+        self.rri = deque()
+        self.diff = deque()
+        self.shift = None  # first interval, keeps the sums of squares small
+        self.s1 = self.s2 = self.d1 = self.d2 = 0.0
+        self.over = {x: 0 for x in thresholds}
+
+    def push(self, peak):
+        if self.peaks and peak < self.peaks[-1]:
+            raise ValueError('Peaks must be increasing')
+        if self.peaks:
+            rri = (peak - self.peaks[-1]) / self.fs * 1000
+            if self.shift is None:
+                self.shift = rri
+            if self.rri:
+                self.add_diff(rri - self.rri[-1], 1)
+            self.rri.append(rri)
+            self.s1 += rri - self.shift
+            self.s2 += (rri - self.shift)**2
+        self.peaks.append(peak)
+        while self.peaks[0] <= peak - self.window:
+            self.peaks.popleft()
+            if self.rri:
+                rri = self.rri.popleft()
+                self.s1 -= rri - self.shift
+                self.s2 -= (rri - self.shift)**2
+            if self.diff:
+                self.add_diff(self.diff[0], -1)
+
+    def add_diff(self, diff, sign):
+        if sign > 0:
+            self.diff.append(diff)
+        else:
+            self.diff.popleft()
+        self.d1 += sign * diff
+        self.d2 += sign * diff**2
+        for x in self.thresholds:
+            self.over[x] += sign * (abs(diff) > x)
+
+    def metrics(self):
+        """HRV of the peaks in the window as a dict of HRV_ name to value."""
+        out = metrics_from_sums(len(self.rri), self.s1, self.s2, self.d1,
+                                self.d2, self.over, self.shift or 0)
+        return {k: float(v) for k, v in out.items()}
+
+
+def window_bounds(peaks, offsets, fs, window, step):
+    """
+    Sliding windows of every recording of flat, sorted peaks. The windows
+    of a recording end every `step` seconds from `window` seconds up to its
+    last peak.
+
+    returns the window offsets (windows of recording r are
+    win_offsets[r]:win_offsets[r+1]), the end of every window in seconds and
+    the flat indices lo, hi of its peaks, peaks[lo:hi].
+    """
+    n = np.diff(offsets)
+    seg = segment_ids(offsets)
+    last = np.where(n > 0, peaks[np.maximum(offsets[1:] - 1, 0)], 0) / fs
+    n_win = np.where(last >= window,
+                     np.floor((last - window) / step).astype(np.int64) + 1, 0)
+    win_offsets = np.zeros(len(n) + 1, dtype=np.int64)
+    win_offsets[1:] = np.cumsum(n_win)
+    win_seg = segment_ids(win_offsets)
+    end = window + (np.arange(win_offsets[-1]) - win_offsets[:-1][win_seg]) * step
+
+    # One sorted array holds the peaks of all recordings one after the other
+    span = (peaks.max() + 1 if len(peaks) else 1) + 1
+    keys = seg * span + peaks.astype(float)
+    start = np.maximum((end - window) * fs, -0.5)
+    lo = np.searchsorted(keys, win_seg * span + start, side='right')
+    hi = np.searchsorted(keys, win_seg * span + end * fs, side='right')
+    return win_offsets, end, lo, hi
+
+
+def windowed_hrv(peaks, offsets=None, fs=250, window=60, step=30,
+                 thresholds=(50, 20)):
+    """
+    Windowed HRV of many recordings.
+
+    peaks: flat array of the peaks of all recordings in samples, with
+    `offsets` as given by jf.util.flatten. A list of peak arrays can be given
+    instead, with offsets=None.
+    fs: sampling rate
+    window, step: length of the windows and time between them in seconds
+    thresholds: x of the pNNx metrics in ms
+
+    returns a DataFrame with one row per window, with the columns 'record'
+    (index of the recording), 'time' (end of the window in seconds from the
+    first sample) and the HRV_ metrics. Windows with fewer than three peaks,
+    or of recordings whose peaks decrease, are nan.
+    """
+    if offsets is None:
+        peaks, offsets = flatten(peaks)
+    peaks = np.asarray(peaks)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    seg = segment_ids(offsets)
+    rri, rri_offsets, increasing = rr_intervals(peaks, offsets, fs)
+    peaks = peaks[segment_argsort(peaks, seg)]
+    win_offsets, end, lo, hi = window_bounds(peaks, offsets, fs, window, step)
+    win_seg = segment_ids(win_offsets)
+
+    # Centre the intervals of each recording, the metrics do not change
+    rri_seg = segment_ids(rri_offsets)
+    n_rri = np.diff(rri_offsets)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        shift = np.bincount(rri_seg, weights=rri, minlength=len(n_rri)) / n_rri
+    shift = np.nan_to_num(shift)
+    centred = rri - shift[rri_seg]
+    # diff[j] = rri[j+1] - rri[j] within a recording, 0 at its last interval
+    diff = np.zeros(len(rri))
+    same = rri_seg[1:] == rri_seg[:-1]
+    diff[:-1][same] = np.diff(rri)[same]
+
+    def prefix(values):
+        out = np.zeros(len(values) + 1)
+        np.cumsum(values, out=out[1:])
+        return out
+
+    # Peaks lo..hi-1 of recording r have the intervals lo-r..hi-r-2 and the
+    # differences lo-r..hi-r-3
+    first = lo - win_seg
+    stop = np.maximum(hi - win_seg - 1, first)
+    stop_diff = np.maximum(stop - 1, first)
+    def window_sum(values, stop):
+        p = prefix(values)
+        return p[stop] - p[first]
+
+    over = {x: window_sum(np.abs(diff) > x, stop_diff) for x in thresholds}
+    out = metrics_from_sums(stop - first,
+                            window_sum(centred, stop), window_sum(centred**2, stop),
+                            window_sum(diff, stop_diff), window_sum(diff**2, stop_diff),
+                            over, shift[win_seg])
+    table = {'record': win_seg, 'time': end}
+    table.update({k: np.where(increasing[win_seg], v, np.nan)
+                  for k, v in out.items()})
+    return pd.DataFrame(table)
+
+
+def windowed_hrv_setup(setup, fs=250, window=60, step=30, path=store_path):
+    """
+    Windowed HRV of every (subject, experiment, method) in the peak store of
+    a setup, read in one pass. The columns 'record' of windowed_hrv are
+    replaced by subject_idx, experiment and method.
+    """
+    store = PeakStore(setup, path)
+    keys = store.keys()
+    peaks, offsets = flatten([store.read(*key) for key in keys])
+    df = windowed_hrv(peaks, offsets, fs, window, step)
+    labels = pd.DataFrame(keys, columns=['subject_idx', 'experiment', 'method'])
+    labels['method'] = labels['method'].replace('annotated', 'Annotated')
+    df = labels.iloc[df['record']].reset_index(drop=True).join(
+        df.drop(columns='record'))
+    return df
+
+
+if __name__ == '__main__':
+    save_path = store_path.parent / 'HRV'
+    for setup in ('einthoven', 'chest_strap'):
+        df = windowed_hrv_setup(setup)
+        fn = save_path / f'{setup}_windowed_HRV.csv'
+        df.to_csv(fn, index=False)
+        print(f'{len(df)} windows of setup {setup} written into {fn}')